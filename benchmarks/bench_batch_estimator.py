@@ -0,0 +1,60 @@
+"""
+Benchmark of LLMBatchEstimator.apply (several instructions and the aggregation of their labels) on the local fake
+LLM, for each aggregation mode, with and without the cascade mode ('exist' and 'all' only).
+Usage (from the repository root):
+    python -m benchmarks.bench_batch_estimator --sizes 100 1000 --num_instructions 3 --latency 0.01
+"""
+import argparse
+import json
+import time
+from easydict import EasyDict as edict
+
+from benchmarks.common import fake_llm_config, synthetic_texts
+from dataset.base_dataset import DatasetBase
+from estimator.estimator_llm_batch import LLMBatchEstimator
+
+
+def run(opt, size: int, aggregation_mode: str, cascade: bool) -> dict:
+    dataset = DatasetBase(edict({'name': 'benchmark', 'label_schema': ['Yes', 'No'], 'records_path': None}))
+    dataset.add(synthetic_texts(size), 0)
+    estimator_config = edict({'llm': fake_llm_config('fake-annotator', 0, latency=opt.latency,
+                                                     latency_sigma=opt.latency_sigma, error_rate=opt.error_rate),
+                              'num_workers': opt.num_workers, 'prompt': 'prompts/predictor/prediction.prompt',
+                              'mode': 'annotation', 'mini_batch_size': opt.mini_batch_size})
+    estimator = LLMBatchEstimator(edict({'instructions': [f'Instruction {i}' for i in range(opt.num_instructions)],
+                                         'aggregation_mode': aggregation_mode, 'cascade': cascade,
+                                         'estimator_config': estimator_config}))
+    start_time = time.perf_counter()
+    records = estimator.apply(dataset, 0)
+    apply_sec = time.perf_counter() - start_time
+    result = {'samples': size, 'aggregation_mode': aggregation_mode, 'cascade': cascade,
+              'num_instructions': opt.num_instructions, 'num_workers': estimator.num_workers,
+              'mini_batch_size': opt.mini_batch_size, 'apply_sec': apply_sec, 'records_per_sec': len(records) / apply_sec}
+    if cascade:
+        result['short_circuit_rate'] = estimator.cascade_stats['short_circuit_rate']
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default=[100, 1000], nargs='+', type=int, help='Number of samples')
+    parser.add_argument('--aggregation_modes', default=['exist', 'all', 'majority', 'confidence'], nargs='+',
+                        type=str, help='The aggregation modes')
+    parser.add_argument('--num_instructions', default=3, type=int, help='Number of instructions')
+    parser.add_argument('--num_workers', default=2, type=int, help='Number of workers of each instruction')
+    parser.add_argument('--mini_batch_size', default=1, type=int, help='Samples per request')
+    parser.add_argument('--latency', default=0.005, type=float, help='Median latency of a fake LLM request (sec)')
+    parser.add_argument('--latency_sigma', default=0.5, type=float, help='Sigma of the lognormal latency')
+    parser.add_argument('--error_rate', default=0, type=float, help='Probability that a fake LLM request fails')
+    parser.add_argument('--output', default='', type=str, help='Path to save the results (json)')
+    opt = parser.parse_args()
+
+    results = []
+    for size in opt.sizes:
+        for aggregation_mode in opt.aggregation_modes:
+            for cascade in ([False, True] if aggregation_mode in ['exist', 'all'] else [False]):
+                result = run(opt, size, aggregation_mode, cascade)
+                print(result)
+                results.append(result)
+    if opt.output != '':
+        json.dump({'benchmark': 'batch_estimator', 'results': results}, open(opt.output, 'w'), indent=2)
@@ -0,0 +1,72 @@
+"""
+Benchmark of Dedup.cluster_data against the previous implementation (k=30 nearest neighbours and a Python loop).
+The embeddings are synthetic (gaussian clusters), so the benchmark doesn't load the embeddings model.
+Usage (from the repository root):
+    python -m benchmarks.bench_cluster_data --sizes 1000 5000 20000
+"""
+import argparse
+import json
+import time
+import faiss
+import numpy as np
+
+from utils.dedup import Dedup
+
+
+def legacy_cluster_data(index, xb, th):
+    """
+    The previous implementation of Dedup.cluster_data
+    """
+    distances, indices = index.search(xb, 30)
+    clusters = []
+    visited = set()
+    for i in range(len(xb)):
+        if i in visited:
+            continue
+        neighbors = [idx for idx, distance in zip(indices[i], distances[i]) if distance <= th]
+        new_cluster = {i}
+        for neighbor in neighbors:
+            if neighbor not in visited:
+                visited.add(neighbor)
+                new_cluster.add(neighbor)
+        clusters.append(new_cluster)
+    return clusters
+
+
+def synthetic_embeddings(size: int, dim: int, cluster_size: int) -> np.ndarray:
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(max(1, size // cluster_size), dim)).astype(np.float32)
+    assignment = rng.integers(0, len(centers), size=size)
+    return centers[assignment] + rng.normal(scale=0.05, size=(size, dim)).astype(np.float32)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default=[1000, 5000, 20000], nargs='+', type=int, help='Number of samples')
+    parser.add_argument('--dim', default=64, type=int, help='Embeddings dimension')
+    parser.add_argument('--cluster_size', default=50, type=int, help='Average number of samples in a cluster')
+    parser.add_argument('--threshold', default=0.5, type=float, help='The dedup threshold')
+    parser.add_argument('--output', default='', type=str, help='Path to save the results (json)')
+    opt = parser.parse_args()
+
+    results = []
+    for size in opt.sizes:
+        xb = synthetic_embeddings(size, opt.dim, opt.cluster_size)
+        index = faiss.IndexFlatL2(opt.dim)
+        index.add(xb)
+        dedup = Dedup({'dedup_threshold': opt.threshold})
+        dedup.index, dedup.xb = index, xb
+
+        start_time = time.perf_counter()
+        clusters = dedup.cluster_data(None)
+        vectorized_sec = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        legacy_clusters = legacy_cluster_data(index, xb, opt.threshold)
+        legacy_sec = time.perf_counter() - start_time
+        result = {'samples': size, 'vectorized_sec': vectorized_sec, 'legacy_sec': legacy_sec,
+                  'speedup': legacy_sec / vectorized_sec, 'num_clusters': len(clusters),
+                  'legacy_num_clusters': len(legacy_clusters)}
+        print(result)
+        results.append(result)
+    if opt.output != '':
+        json.dump({'benchmark': 'cluster_data', 'results': results}, open(opt.output, 'w'), indent=2)
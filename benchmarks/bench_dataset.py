@@ -0,0 +1,62 @@
+"""
+Micro-benchmark of the DatasetBase operations of an optimization step: add (a new batch of samples), update (the
+annotations and the predictions of the records up to the current batch) and get_leq / __getitem__ (the records
+of the estimators). The dataset grows batch by batch, the reported times are the totals over all the batches.
+Usage (from the repository root):
+    python -m benchmarks.bench_dataset --sizes 1000 10000 100000 --batch_size 100
+"""
+import argparse
+import json
+import time
+import numpy as np
+import pandas as pd
+from easydict import EasyDict as edict
+
+from benchmarks.common import synthetic_texts
+from dataset.base_dataset import DatasetBase
+
+
+def run(size: int, batch_size: int, label_schema: list[str]) -> dict:
+    dataset = DatasetBase(edict({'name': 'benchmark', 'label_schema': label_schema, 'records_path': None}))
+    texts = synthetic_texts(size)
+    rng = np.random.default_rng(0)
+    timings = {'add_sec': 0, 'get_batch_sec': 0, 'get_leq_sec': 0, 'update_sec': 0}
+    num_batches = (size + batch_size - 1) // batch_size
+    for batch_id in range(num_batches):
+        start_time = time.perf_counter()
+        dataset.add(texts[batch_id * batch_size:(batch_id + 1) * batch_size], batch_id)
+        timings['add_sec'] += time.perf_counter() - start_time
+
+        # The annotator labels the current batch, the predictor predicts all the batches up to the current one
+        start_time = time.perf_counter()
+        annotator_records = dataset[batch_id]
+        timings['get_batch_sec'] += time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        predictor_records = dataset.get_leq(batch_id)
+        timings['get_leq_sec'] += time.perf_counter() - start_time
+
+        annotator_records['annotation'] = rng.choice(label_schema, len(annotator_records))
+        predictor_records['prediction'] = rng.choice(label_schema, len(predictor_records))
+        start_time = time.perf_counter()
+        dataset.update(annotator_records)
+        dataset.update(predictor_records)
+        timings['update_sec'] += time.perf_counter() - start_time
+    return {'samples': size, 'batch_size': batch_size, 'num_batches': num_batches, **timings,
+            'total_sec': sum(timings.values()), 'final_size': len(dataset)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default=[1000, 10000, 100000], nargs='+', type=int, help='Number of samples')
+    parser.add_argument('--batch_size', default=100, type=int, help='Number of samples in a batch')
+    parser.add_argument('--label_schema', default=['Yes', 'No'], nargs='+', type=str, help='The labels')
+    parser.add_argument('--output', default='', type=str, help='Path to save the results (json)')
+    opt = parser.parse_args()
+
+    results = []
+    for size in opt.sizes:
+        result = run(size, opt.batch_size, opt.label_schema)
+        print(result)
+        results.append(result)
+    if opt.output != '':
+        json.dump({'benchmark': 'dataset', 'results': results}, open(opt.output, 'w'), indent=2)
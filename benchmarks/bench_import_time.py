@@ -0,0 +1,74 @@
+"""
+Import-time benchmark of the CLI entry points, based on `python -X importtime`. Each module is imported in a fresh
+interpreter, the benchmark reports the cumulative import time, the slowest imports, and the optional backends
+(W&B, argilla, sentence-transformers, faiss, scikit-learn, the LLM providers packages) that were imported although
+the config did not select them.
+The exit code is 1 if the import time is above the target or a backend is imported eagerly. The same check runs
+under pytest in tests/test_import_time.py.
+Usage (from the repository root):
+    python -m benchmarks.bench_import_time --target_ms 1500 --repeats 3
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+# Optional backends that must be imported only when the config selects them
+LAZY_MODULES = ['wandb', 'argilla', 'sentence_transformers', 'faiss', 'sklearn', 'langchain_openai',
+                'langchain_google_genai', 'langchain_community.chat_models', 'transformers', 'torch']
+# The CLI entry points and their import time target (ms)
+ENTRY_MODULES = ['optimization_pipeline', 'optimization_agent']
+TARGET_MS = 1500
+
+
+def import_time(module: str) -> dict:
+    """
+    Import the module in a fresh interpreter with -X importtime
+    :param module: The module name
+    :return: The cumulative import time of the module (ms), and the self and cumulative time (ms) of every import
+    """
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                             capture_output=True, text=True, check=True)
+    imports = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        imports[name.strip()] = {'self_ms': int(self_us) / 1000, 'cumulative_ms': int(cumulative_us) / 1000}
+    return {'total_ms': imports[module]['cumulative_ms'], 'imports': imports}
+
+
+def measure(module: str, repeats: int, top: int) -> dict:
+    runs = [import_time(module) for _ in range(repeats)]
+    # The fastest run is the least noisy one
+    best = min(runs, key=lambda run: run['total_ms'])
+    slowest = sorted(best['imports'].items(), key=lambda item: item[1]['self_ms'], reverse=True)[:top]
+    eager = [name for name in LAZY_MODULES if name in best['imports']]
+    return {'module': module, 'total_ms': best['total_ms'], 'all_runs_ms': [run['total_ms'] for run in runs],
+            'slowest_imports': [{'name': name, **times} for name, times in slowest], 'eager_backends': eager}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--modules', default=ENTRY_MODULES, nargs='+', help='The modules to import')
+    parser.add_argument('--target_ms', default=TARGET_MS, type=float, help='The import time target of each module (ms)')
+    parser.add_argument('--repeats', default=3, type=int, help='Number of repeats')
+    parser.add_argument('--top', default=10, type=int, help='Number of the slowest imports to report')
+    parser.add_argument('--output', default='', type=str, help='Path to save the results (json)')
+    opt = parser.parse_args()
+
+    results = []
+    passed = True
+    for module in opt.modules:
+        result = measure(module, opt.repeats, opt.top)
+        result['passed'] = result['total_ms'] <= opt.target_ms and len(result['eager_backends']) == 0
+        passed = passed and result['passed']
+        print(f"{module}: {result['total_ms']:.0f}ms (target {opt.target_ms:.0f}ms), "
+              f"eager backends: {result['eager_backends']}, passed: {result['passed']}")
+        for item in result['slowest_imports']:
+            print(f"    {item['name']}: {item['self_ms']:.1f}ms")
+        results.append(result)
+    if opt.output != '':
+        json.dump({'benchmark': 'import_time', 'target_ms': opt.target_ms, 'results': results},
+                  open(opt.output, 'w'), indent=2)
+    sys.exit(0 if passed else 1)
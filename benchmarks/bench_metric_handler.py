@@ -0,0 +1,55 @@
+"""
+Benchmark of the metrics judge (MetricHandler.score_records) on the local fake LLM: the scoring time of each
+scoring mode ('sequential', 'concurrent' and 'fused') as a function of the number of metrics. The metrics are
+generated by the metric generator chain (the fake LLM returns num_metrics metrics).
+Usage (from the repository root):
+    python -m benchmarks.bench_metric_handler --num_metrics 1 3 6 --num_samples 100 --latency 0.05
+"""
+import argparse
+import json
+import time
+from pathlib import Path
+import pandas as pd
+from easydict import EasyDict as edict
+
+from benchmarks.common import fake_llm_config, synthetic_texts
+from metric_generator.metric_gen import MetricHandler
+from utils.llm_chain import MetaChain
+
+
+def build_metric_handler(opt, num_metrics: int) -> MetricHandler:
+    llm_params = {'latency': opt.latency, 'latency_sigma': opt.latency_sigma, 'error_rate': opt.error_rate}
+    meta_chain = MetaChain(edict({'meta_prompts': {'folder': Path('prompts/meta_prompts_generation')},
+                                  'llm': fake_llm_config('fake-metrics', 0, array_lengths={'metrics_list': num_metrics},
+                                                         **llm_params)}))
+    config = edict({'num_metrics': num_metrics, 'llm': fake_llm_config('fake-judge', 1, **llm_params)})
+    return MetricHandler(config, meta_chain.chain.metric_generator, 'Benchmark task')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_metrics', default=[1, 3, 6], nargs='+', type=int, help='Number of metrics')
+    parser.add_argument('--modes', default=['sequential', 'concurrent', 'fused'], nargs='+', type=str,
+                        help='The scoring modes')
+    parser.add_argument('--num_samples', default=100, type=int, help='Number of samples')
+    parser.add_argument('--num_workers', default=5, type=int, help='Number of workers')
+    parser.add_argument('--latency', default=0.01, type=float, help='Median latency of a fake LLM request (sec)')
+    parser.add_argument('--latency_sigma', default=0.5, type=float, help='Sigma of the lognormal latency')
+    parser.add_argument('--error_rate', default=0, type=float, help='Probability that a fake LLM request fails')
+    parser.add_argument('--output', default='', type=str, help='Path to save the results (json)')
+    opt = parser.parse_args()
+
+    records = pd.DataFrame({'text': synthetic_texts(opt.num_samples)})
+    results = []
+    for num_metrics in opt.num_metrics:
+        metric_handler = build_metric_handler(opt, num_metrics)
+        for mode in opt.modes:
+            start_time = time.perf_counter()
+            scores = metric_handler.score_records(records, opt.num_workers, mode)
+            result = {'num_metrics': len(metric_handler.metrics), 'mode': mode, 'num_samples': opt.num_samples,
+                      'num_workers': opt.num_workers, 'score_sec': time.perf_counter() - start_time,
+                      'num_scores': sum(len(metric_scores) for metric_scores in scores.values())}
+            print(result)
+            results.append(result)
+    if opt.output != '':
+        json.dump({'benchmark': 'metric_handler', 'results': results}, open(opt.output, 'w'), indent=2)
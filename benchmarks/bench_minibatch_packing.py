@@ -0,0 +1,87 @@
+"""
+Benchmark of the mini-batch packing of LLMEstimator: fixed number of samples per request (mini_batch_size) against
+token-budget packing (mini_batch_tokens). The dataset is synthetic (mixed-length samples) and the LLM is a local
+fake model with a simple cost model: each request costs a fixed overhead (the prompt instructions) plus its tokens,
+its latency grows with its tokens, and requests that exceed the context window fail.
+Usage (from the repository root):
+    python -m benchmarks.bench_minibatch_packing --num_samples 2000 --mini_batch_size 32 --mini_batch_tokens 3000
+"""
+import argparse
+import heapq
+import json
+import numpy as np
+import pandas as pd
+from easydict import EasyDict as edict
+
+from estimator.estimator_llm import LLMEstimator, get_token_counter
+
+
+class FakeLLM:
+    """
+    A local fake LLM that simulates the latency and the cost of the requests
+    """
+
+    def __init__(self, opt):
+        self.opt = opt
+        self.count_tokens = get_token_counter(opt.model_name)
+
+    def request(self, chain_input: dict) -> dict:
+        input_tokens = self.opt.prompt_tokens + self.count_tokens(chain_input['samples'])
+        output_tokens = self.opt.output_tokens_per_sample * chain_input['batch_size']
+        return {'failed': input_tokens + output_tokens > self.opt.context_window,
+                'latency': self.opt.request_latency + self.opt.token_latency * (input_tokens + output_tokens),
+                'cost': input_tokens * self.opt.input_token_price + output_tokens * self.opt.output_token_price}
+
+
+def synthetic_dataset(num_samples: int) -> pd.DataFrame:
+    # Mostly short samples with a long tail of long samples
+    rng = np.random.default_rng(0)
+    num_words = np.clip(rng.lognormal(mean=3.5, sigma=1.2, size=num_samples), 3, 3000).astype(int)
+    return pd.DataFrame({'text': [' '.join(['word'] * n) for n in num_words]})
+
+
+def run(estimator: LLMEstimator, llm: FakeLLM, dataset: pd.DataFrame, num_workers: int) -> dict:
+    mini_batches = estimator.pack_mini_batches(dataset)
+    requests = [llm.request(estimator.build_mini_batch_input(dataset, mini_batch)) for mini_batch in mini_batches]
+    # The requests are sent by num_workers workers, each request starts as soon as a worker is free
+    workers = [0.0] * num_workers
+    for request in requests:
+        heapq.heappush(workers, heapq.heappop(workers) + request['latency'])
+    wall_time = max(workers)
+    failed_samples = sum(len(mini_batch) for mini_batch, request in zip(mini_batches, requests) if request['failed'])
+    return {'num_requests': len(requests), 'failed_requests': sum(request['failed'] for request in requests),
+            'failed_samples': failed_samples, 'cost': sum(request['cost'] for request in requests),
+            'wall_time_sec': wall_time, 'samples_per_sec': (len(dataset) - failed_samples) / wall_time}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_samples', default=2000, type=int, help='Number of samples')
+    parser.add_argument('--mini_batch_size', default=32, type=int, help='Samples per request (the cap in packing)')
+    parser.add_argument('--mini_batch_tokens', default=3000, type=int, help='Tokens budget per request')
+    parser.add_argument('--num_workers', default=5, type=int, help='Number of concurrent requests')
+    parser.add_argument('--model_name', default='gpt-3.5-turbo-1106', type=str, help='The tokenizer model')
+    parser.add_argument('--context_window', default=4096, type=int, help='The fake LLM context window')
+    parser.add_argument('--prompt_tokens', default=150, type=int, help='The prompt tokens (without the samples)')
+    parser.add_argument('--output_tokens_per_sample', default=10, type=int, help='The output tokens per sample')
+    parser.add_argument('--request_latency', default=0.5, type=float, help='The fixed latency of a request (sec)')
+    parser.add_argument('--token_latency', default=0.0005, type=float, help='The latency of a token (sec)')
+    parser.add_argument('--input_token_price', default=1e-6, type=float, help='The price of an input token')
+    parser.add_argument('--output_token_price', default=2e-6, type=float, help='The price of an output token')
+    parser.add_argument('--output', default='', type=str, help='Path to save the results (json)')
+    opt = parser.parse_args()
+
+    dataset = synthetic_dataset(opt.num_samples)
+    llm = FakeLLM(opt)
+    results = []
+    for mini_batch_size, mini_batch_tokens in [(1, 0), (opt.mini_batch_size, 0),
+                                               (opt.mini_batch_size, opt.mini_batch_tokens)]:
+        estimator = LLMEstimator(edict({'llm': {'name': opt.model_name}, 'mini_batch_size': mini_batch_size,
+                                        'mini_batch_tokens': mini_batch_tokens, 'mode': 'prediction',
+                                        'num_workers': opt.num_workers, 'instruction': 'Classify the sample'}))
+        result = {'mini_batch_size': mini_batch_size, 'mini_batch_tokens': mini_batch_tokens,
+                  **run(estimator, llm, dataset, opt.num_workers)}
+        print(result)
+        results.append(result)
+    if opt.output != '':
+        json.dump({'benchmark': 'minibatch_packing', 'results': results}, open(opt.output, 'w'), indent=2)
@@ -0,0 +1,94 @@
+"""
+Micro-benchmark of the scores writing in the multiscore eval function (eval_utils.set_multiscore_function).
+The metrics results are synthetic, so the benchmark measures only the pandas overhead.
+Usage (from the repository root):
+    python -m benchmarks.bench_multiscore --sizes 10000 100000 --num_metrics 5
+"""
+import argparse
+import json
+import time
+import numpy as np
+import pandas as pd
+
+from eval.eval_utils import set_multiscore_function
+
+
+class SyntheticMetricHandler:
+    """
+    A metric handler that returns precomputed results, mimics MetricHandler.score_records
+    """
+
+    def __init__(self, num_metrics: int, index: pd.Index, discard_rate: float = 0.05):
+        self.metrics = [{'metric_name': f'metric_{i}'} for i in range(num_metrics)]
+        rng = np.random.default_rng(0)
+        self.results = {}
+        for metric in self.metrics:
+            kept_index = index[rng.random(len(index)) > discard_rate]
+            self.results[metric['metric_name']] = {i: {'metric_score': float(rng.integers(1, 6)),
+                                                       'metric_reason': 'reason'} for i in kept_index}
+
+    def score_records(self, records: pd.DataFrame, num_workers: int = 1, mode: str = 'sequential') -> dict:
+        return self.results
+
+
+def legacy_multiscore_function(metric_handler):
+    """
+    The previous implementation: 'Discarded' pre-filled columns and a .loc assignment per row per metric
+    """
+
+    def wrapper(dataset):
+        generation_dataset = dataset.copy()
+        generation_dataset['text'] = '###User input:\n' + generation_dataset['text'] + '\n####model prediction:\n' + \
+                                     generation_dataset['prediction']
+        metric_names = [metric['metric_name'] for metric in metric_handler.metrics]
+        for metric_name in metric_names:
+            generation_dataset['{}_{}'.format('score', metric_name)] = 'Discarded'
+            generation_dataset['{}_{}'.format('reasoning', metric_name)] = 'Discarded'
+        all_results = metric_handler.score_records(generation_dataset)
+        for metric_name, res in all_results.items():
+            for index, score in res.items():
+                generation_dataset.loc[index, '{}_{}'.format('score', metric_name)] = score['metric_score']
+                generation_dataset.loc[index, '{}_{}'.format('reasoning', metric_name)] = score['metric_reason']
+        columns_to_copy = ['{}_{}'.format('score', metric_name) for metric_name in metric_names] + \
+                          ['{}_{}'.format('reasoning', metric_name) for metric_name in metric_names]
+        dataset[columns_to_copy] = generation_dataset[columns_to_copy]
+        return dataset
+
+    return wrapper
+
+
+def synthetic_dataset(size: int) -> pd.DataFrame:
+    # Non contiguous index, as in the eval dataset after filtering the discarded records
+    return pd.DataFrame({'text': [f'sample text {i}' for i in range(size)],
+                         'prediction': [f'prediction {i}' for i in range(size)]},
+                        index=np.arange(size) * 2)
+
+
+def measure(func, dataset: pd.DataFrame) -> float:
+    start_time = time.perf_counter()
+    func(dataset.copy())
+    return time.perf_counter() - start_time
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default=[10000, 100000], nargs='+', type=int, help='Number of rows')
+    parser.add_argument('--num_metrics', default=5, type=int, help='Number of metrics')
+    parser.add_argument('--max_legacy_rows', default=20000, type=int,
+                        help='The legacy implementation is skipped above this size (it is very slow)')
+    parser.add_argument('--output', default='', type=str, help='Path to save the results (json)')
+    opt = parser.parse_args()
+
+    results = []
+    for size in opt.sizes:
+        dataset = synthetic_dataset(size)
+        metric_handler = SyntheticMetricHandler(opt.num_metrics, dataset.index)
+        result = {'rows': size, 'num_metrics': opt.num_metrics,
+                  'vectorized_sec': measure(set_multiscore_function(metric_handler), dataset)}
+        if size <= opt.max_legacy_rows:
+            result['legacy_sec'] = measure(legacy_multiscore_function(metric_handler), dataset)
+            result['speedup'] = result['legacy_sec'] / result['vectorized_sec']
+        print(result)
+        results.append(result)
+    if opt.output != '':
+        json.dump({'benchmark': 'multiscore', 'results': results}, open(opt.output, 'w'), indent=2)
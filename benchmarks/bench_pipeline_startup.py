@@ -0,0 +1,74 @@
+"""
+Startup-time benchmark of OptimizationPipeline.__init__. The meta-prompts chains are built lazily, the benchmark
+reports the startup time, the number of chains that were built during the startup, and the time it takes to build
+all the chains the eager way (the output schemes module executed and a new LLM client built for each chain).
+No LLM request is sent, but the LLM clients are created (a dummy API key is enough).
+Usage (from the repository root):
+    OPENAI_API_KEY=dummy python -m benchmarks.bench_pipeline_startup --repeats 5
+"""
+import argparse
+import json
+import time
+
+import utils.config
+import utils.llm_chain
+from optimization_pipeline import OptimizationPipeline
+from utils.config import load_yaml, override_config
+from utils.llm_chain import MetaChain
+
+
+def clear_registries():
+    utils.config.llm_clients.clear()
+    utils.llm_chain.schema_modules.clear()
+
+
+def measure_startup(config) -> dict:
+    clear_registries()
+    start_time = time.perf_counter()
+    pipeline = OptimizationPipeline(config, 'Benchmark task', 'Benchmark prompt')
+    init_sec = time.perf_counter() - start_time
+    chains = pipeline.meta_chain.chain
+    num_built = len(chains.built_chains())
+    start_time = time.perf_counter()
+    for name in chains:
+        chains[name]
+    return {'init_sec': init_sec, 'num_chains': len(chains), 'num_built_at_init': num_built,
+            'build_remaining_chains_sec': time.perf_counter() - start_time}
+
+
+def measure_eager(config) -> float:
+    # The previous MetaChain: every chain executes the output schemes module and builds its own LLM client
+    chains = MetaChain(config).chain
+    start_time = time.perf_counter()
+    for name in chains:
+        clear_registries()
+        chains[name]
+    return time.perf_counter() - start_time
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--basic_config_path', default='config/config_default.yml', type=str,
+                        help='Configuration file path')
+    parser.add_argument('--batch_config_path', default='', type=str, help='Batch configuration file path')
+    parser.add_argument('--repeats', default=5, type=int, help='Number of repeats')
+    parser.add_argument('--output', default='', type=str, help='Path to save the results (json)')
+    opt = parser.parse_args()
+
+    if opt.batch_config_path == '':
+        config_params = load_yaml(opt.basic_config_path)
+    else:
+        config_params = override_config(opt.batch_config_path, config_file=opt.basic_config_path)
+    config_params.use_wandb = False
+    if config_params.annotator.method == 'argilla':
+        # The argilla annotator connects to the argilla server, it is replaced by the dummy estimator
+        config_params.annotator.method = ''
+
+    results = []
+    for _ in range(opt.repeats):
+        result = measure_startup(config_params)
+        result['eager_chains_sec'] = measure_eager(config_params)
+        print(result)
+        results.append(result)
+    if opt.output != '':
+        json.dump({'benchmark': 'pipeline_startup', 'results': results}, open(opt.output, 'w'), indent=2)
@@ -0,0 +1,130 @@
+"""
+End-to-end benchmark of OptimizationPipeline.step on the local fake LLM (no requests are sent). Each run starts from a
+synthetic dataset and runs a few optimization steps, the step wall-clock time is broken down by stage (annotator,
+predictor, eval_score, add_history, run_step_prompt, save_state, and the step_prompt/samples_context/step_samples
+stages of run_step_prompt).
+The flows are the classification pipeline (config_offline.yml) and the generation pipeline with a ranker eval (as in
+run_generation_pipeline.py). The sweeps change one parameter at a time around the base point (the first value of each
+list): the dataset size, the num_workers and the predictor mini_batch_size (classification only). The metrics count
+sweep of the metrics judge is in bench_metric_handler.py.
+Usage (from the repository root):
+    python -m benchmarks.bench_pipeline_step --dataset_sizes 100 1000 --num_workers 5 20 --mini_batch_sizes 1 10 \
+        --num_steps 3 --latency 0.05 --output pipeline_step.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import tempfile
+import time
+import numpy as np
+
+from benchmarks.common import fake_llm_config, synthetic_texts
+from optimization_pipeline import OptimizationPipeline
+from utils.config import override_config
+
+STAGES = ['annotator', 'predictor', 'eval_score', 'add_history', 'run_step_prompt', 'step_prompt', 'samples_context',
+          'step_samples', 'save_state']
+
+
+def build_config(opt, flow: str, dataset_size: int, num_workers: int, mini_batch_size: int):
+    """
+    Build the pipeline config of the flow, all the LLMs are fake LLMs
+    """
+    llm_params = {'latency': opt.latency, 'latency_sigma': opt.latency_sigma, 'error_rate': opt.error_rate}
+    if flow == 'classification':
+        config = override_config('config/config_diff/config_offline.yml')
+        config.annotator.config.llm = fake_llm_config('fake-annotator', 1, **llm_params)
+        config.annotator.config.num_workers = num_workers
+    else:
+        config = override_config('config/config_diff/config_generation.yml')
+        ranker_config = override_config('config/config_diff/config_ranking.yml')
+        # The generated outputs are scored by the ranker predictor (see run_generation_pipeline.py)
+        config.eval.function_name = 'ranking'
+        config.eval.function_params = ranker_config.predictor.config
+        config.eval.function_params.llm = fake_llm_config('fake-ranker', 3, labels=ranker_config.dataset.label_schema,
+                                                          **llm_params)
+        config.eval.function_params.num_workers = num_workers
+        config.eval.function_params.instruction = 'Rank the model prediction'
+        config.eval.function_params.label_schema = ranker_config.dataset.label_schema
+    config.use_wandb = False
+    config.llm = fake_llm_config('fake-meta', 0, array_lengths={'samples': config.meta_prompts.samples_generation_batch},
+                                 **llm_params)
+    config.predictor.config.llm = fake_llm_config('fake-predictor', 2, labels=config.dataset.label_schema,
+                                                  **llm_params)
+    config.predictor.config.num_workers = num_workers
+    config.predictor.config.mini_batch_size = mini_batch_size
+    config.predictor.config.use_cache = False
+    config.eval.llm = fake_llm_config('fake-eval', 4, **llm_params)
+    config.meta_prompts.num_workers = num_workers
+    # New samples are generated in every step
+    config.dataset.max_samples = dataset_size + config.meta_prompts.num_generated_samples * (opt.num_steps + 1)
+    config.stop_criteria.max_usage = 0
+    return config
+
+
+def run(opt, flow: str, dataset_size: int, num_workers: int, mini_batch_size: int) -> dict:
+    config = build_config(opt, flow, dataset_size, num_workers, mini_batch_size)
+    steps = []
+    with tempfile.TemporaryDirectory() as output_path, contextlib.redirect_stdout(io.StringIO()):
+        start_time = time.perf_counter()
+        pipeline = OptimizationPipeline(config, 'Benchmark task', 'Benchmark prompt', output_path=output_path)
+        init_sec = time.perf_counter() - start_time
+        pipeline.dataset.add(synthetic_texts(dataset_size), 0)
+        for i in range(opt.num_steps):
+            start_time = time.perf_counter()
+            stop = pipeline.step(i, opt.num_steps)
+            steps.append({'step_sec': time.perf_counter() - start_time, **pipeline.stage_timings})
+            if stop:
+                break
+        pipeline.close()
+    result = {'flow': flow, 'dataset_size': dataset_size, 'num_workers': num_workers,
+              'mini_batch_size': mini_batch_size, 'num_steps': len(steps), 'init_sec': init_sec,
+              'step_sec': float(np.mean([step['step_sec'] for step in steps]))}
+    # The mean time of each stage, over the steps that ran it
+    for stage in STAGES:
+        timings = [step[stage] for step in steps if stage in step]
+        if len(timings) > 0:
+            result[f'{stage}_sec'] = float(np.mean(timings))
+    result['steps'] = steps
+    return result
+
+
+def sweep_points(opt, flow: str) -> list[tuple]:
+    """
+    Return the (dataset_size, num_workers, mini_batch_size) points of the flow sweeps, one parameter changes at a time
+    """
+    # The generation predictor output is parsed as a single sample, so its mini-batch size is 1
+    axes = [opt.dataset_sizes, opt.num_workers, opt.mini_batch_sizes if flow == 'classification' else [1]]
+    base = tuple(values[0] for values in axes)
+    points = [base]
+    for i, values in enumerate(axes):
+        for value in values[1:]:
+            points.append(base[:i] + (value,) + base[i + 1:])
+    return points
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--flows', default=['classification', 'generation'], nargs='+', type=str,
+                        help='The pipeline flows (classification and/or generation)')
+    parser.add_argument('--dataset_sizes', default=[100, 1000], nargs='+', type=int, help='Initial dataset sizes')
+    parser.add_argument('--num_workers', default=[5, 20], nargs='+', type=int, help='Number of workers')
+    parser.add_argument('--mini_batch_sizes', default=[1, 10], nargs='+', type=int,
+                        help='Predictor mini-batch sizes (classification flow)')
+    parser.add_argument('--num_steps', default=3, type=int, help='Number of optimization steps in each run')
+    parser.add_argument('--latency', default=0, type=float,
+                        help='Median latency of a fake LLM request (sec), 0 measures only the pipeline overhead')
+    parser.add_argument('--latency_sigma', default=0.5, type=float, help='Sigma of the lognormal latency')
+    parser.add_argument('--error_rate', default=0, type=float, help='Probability that a fake LLM request fails')
+    parser.add_argument('--output', default='', type=str, help='Path to save the results (json)')
+    opt = parser.parse_args()
+
+    results = []
+    for flow in opt.flows:
+        for dataset_size, num_workers, mini_batch_size in sweep_points(opt, flow):
+            result = run(opt, flow, dataset_size, num_workers, mini_batch_size)
+            print({key: value for key, value in result.items() if key != 'steps'})
+            results.append(result)
+    if opt.output != '':
+        json.dump({'benchmark': 'pipeline_step', 'results': results}, open(opt.output, 'w'), indent=2)
@@ -0,0 +1,38 @@
+"""
+Shared helpers of the benchmarks that run on the local fake LLM (llm type 'fake', see utils/fake_llm.py)
+"""
+import numpy as np
+from easydict import EasyDict as edict
+
+WORDS = np.array(['service', 'order', 'delivery', 'late', 'great', 'price', 'quality', 'support', 'product', 'movie',
+                  'plot', 'actor', 'address', 'phone', 'account', 'refund', 'friendly', 'slow', 'broken', 'city'])
+
+
+def fake_llm_config(name: str, seed: int = 0, latency: float = 0, latency_sigma: float = 0.5,
+                    error_rate: float = 0, **kwargs) -> edict:
+    """
+    Return the config of a fake LLM
+    :param name: The model name (the chains with the same config share the same fake model)
+    :param seed: The responses seed
+    :param latency: The median latency of a request in seconds (lognormal distribution), 0 means no latency
+    :param latency_sigma: The sigma of the lognormal latency distribution
+    :param error_rate: The probability that a request fails
+    :param kwargs: Additional fake LLM options (e.g. array_lengths, labels, drop_rate)
+    """
+    if latency > 0:
+        latency_config = {'distribution': 'lognormal', 'median': latency, 'sigma': latency_sigma}
+    else:
+        latency_config = {'distribution': 'constant', 'value': 0}
+    return edict({'type': 'fake', 'name': name, 'seed': seed, 'latency': latency_config, 'error_rate': error_rate,
+                  **kwargs})
+
+
+def synthetic_texts(num_samples: int, seed: int = 0) -> list[str]:
+    """
+    Return synthetic samples with mixed lengths (mostly short samples with a long tail of long samples)
+    :param num_samples: The number of samples
+    :param seed: The random seed
+    """
+    rng = np.random.default_rng(seed)
+    num_words = np.clip(rng.lognormal(mean=2.5, sigma=0.8, size=num_samples), 3, 500).astype(int)
+    return [f'{i} ' + ' '.join(rng.choice(WORDS, n)) for i, n in enumerate(num_words)]
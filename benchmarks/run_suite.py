@@ -0,0 +1,118 @@
+"""
+Run the benchmarks suite and save all the results in a single JSON file (with the git commit and the environment), so
+the results of different versions can be compared. The LLM is the local fake LLM, no requests are sent.
+Each benchmark runs in its own interpreter. With --compare, the timings (the '*_sec' results) are compared to a
+previous suite results file, and the exit code is 1 if any timing is slower by more than the tolerance.
+Usage (from the repository root):
+    python -m benchmarks.run_suite --preset quick --output benchmarks_results.json
+    python -m benchmarks.run_suite --preset quick --compare benchmarks_results.json --tolerance 0.25
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+# The arguments of each benchmark in each preset ('full' runs the benchmarks defaults)
+BENCHMARKS = {
+    'pipeline_step': {'quick': ['--dataset_sizes', '100', '500', '--num_workers', '5', '20', '--mini_batch_sizes', '1',
+                                '10', '--num_steps', '3'],
+                      'full': []},
+    'metric_handler': {'quick': ['--num_metrics', '1', '3', '6', '--num_samples', '50'], 'full': []},
+    'batch_estimator': {'quick': ['--sizes', '100'], 'full': []},
+    'dataset': {'quick': ['--sizes', '1000', '10000'], 'full': []},
+    'cluster_data': {'quick': ['--sizes', '1000', '5000'], 'full': []},
+    'multiscore': {'quick': ['--sizes', '10000'], 'full': []},
+    'minibatch_packing': {'quick': ['--num_samples', '1000'], 'full': []},
+    'pipeline_startup': {'quick': ['--repeats', '2'], 'full': []},
+    'import_time': {'quick': ['--repeats', '2'], 'full': []},
+}
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return ''
+
+
+def run_benchmark(name: str, args: list[str]) -> dict:
+    """
+    Run a single benchmark in a new interpreter
+    :param name: The benchmark name (the benchmarks/bench_<name>.py module)
+    :param args: The benchmark arguments
+    :return: The benchmark results, its run time, and the error (if it failed)
+    """
+    env = dict(os.environ)
+    # The startup benchmark builds the OpenAI clients (no request is sent)
+    env.setdefault('OPENAI_API_KEY', 'dummy')
+    with tempfile.TemporaryDirectory() as output_dir:
+        output_path = os.path.join(output_dir, f'{name}.json')
+        start_time = time.perf_counter()
+        process = subprocess.run([sys.executable, '-m', f'benchmarks.bench_{name}', *args, '--output', output_path],
+                                 capture_output=True, text=True, env=env)
+        result = {'args': args, 'run_sec': time.perf_counter() - start_time, 'exit_code': process.returncode}
+        if os.path.isfile(output_path):
+            result['results'] = json.load(open(output_path, 'r'))['results']
+        else:
+            result['results'] = []
+            result['error'] = process.stderr[-2000:]
+    return result
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[dict]:
+    """
+    Compare the timings of the benchmarks results to the baseline results. The results of a benchmark are matched by
+    their position, if they were run with the same arguments
+    :param results: The current suite results
+    :param baseline: The baseline suite results
+    :param tolerance: The allowed relative slowdown
+    :return: The list of the regressions
+    """
+    regressions = []
+    for name, benchmark in results['benchmarks'].items():
+        baseline_benchmark = baseline['benchmarks'].get(name, None)
+        if baseline_benchmark is None or baseline_benchmark['args'] != benchmark['args']:
+            continue
+        for i, (result, baseline_result) in enumerate(zip(benchmark['results'], baseline_benchmark['results'])):
+            for key, value in result.items():
+                baseline_value = baseline_result.get(key, None)
+                if not key.endswith('_sec') or not isinstance(value, (int, float)) or not baseline_value:
+                    continue
+                ratio = value / baseline_value
+                if ratio > 1 + tolerance:
+                    regressions.append({'benchmark': name, 'result': i, 'metric': key, 'baseline': baseline_value,
+                                        'current': value, 'ratio': ratio})
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--preset', default='quick', choices=['quick', 'full'], help='The benchmarks arguments preset')
+    parser.add_argument('--benchmarks', default=list(BENCHMARKS.keys()), nargs='+', type=str,
+                        help='The benchmarks to run')
+    parser.add_argument('--compare', default='', type=str, help='A previous suite results file to compare with')
+    parser.add_argument('--tolerance', default=0.25, type=float, help='The allowed relative slowdown in --compare')
+    parser.add_argument('--output', default='', type=str, help='Path to save the results (json)')
+    opt = parser.parse_args()
+
+    suite = {'commit': git_commit(), 'timestamp': datetime.now().isoformat(), 'preset': opt.preset,
+             'python': platform.python_version(), 'platform': platform.platform(), 'benchmarks': {}}
+    for name in opt.benchmarks:
+        print(f'Running {name}')
+        suite['benchmarks'][name] = run_benchmark(name, BENCHMARKS[name][opt.preset])
+        status = 'failed' if 'error' in suite['benchmarks'][name] else 'done'
+        print(f"    {status} in {suite['benchmarks'][name]['run_sec']:.1f}s")
+    if opt.output != '':
+        json.dump(suite, open(opt.output, 'w'), indent=2)
+
+    if opt.compare != '':
+        regressions = compare(suite, json.load(open(opt.compare, 'r')), opt.tolerance)
+        for regression in regressions:
+            print(f"Regression in {regression['benchmark']} (result {regression['result']}) {regression['metric']}: "
+                  f"{regression['baseline']:.4f}s -> {regression['current']:.4f}s (x{regression['ratio']:.2f})")
+        sys.exit(1 if len(regressions) > 0 else 0)
@@ -4,8 +4,11 @@ import pandas as pd
 from pathlib import Path
 from datetime import datetime
 import csv
+import random
+import numpy as np
 
-from utils.dedup import Dedup
+from utils.dedup import Dedup, DatasetIndex
+from dataset.records_store import RecordsStore
 
 class DatasetBase:
     """
@@ -13,11 +16,6 @@ class DatasetBase:
     """
 
     def __init__(self, config):
-        if config.records_path is None:
-            self.records = pd.DataFrame(columns=['id', 'text', 'prediction',
-                                                 'annotation', 'metadata', 'score', 'batch_id'])
-        else:
-            self.records = pd.read_csv(config.records_path)
         dt_string = datetime.now().strftime("%d_%m_%Y_%H_%M_%S")
 
         self.name = config.name + '__' + dt_string
@@ -25,30 +23,50 @@ class DatasetBase:
         self.dedup = Dedup(config)
         self.sample_size = config.get("sample_size", 3)
         self.semantic_sampling = config.get("semantic_sampling", False)
+        self.cross_batch_dedup = config.get('cross_batch_dedup', False)
+        self.dedup_stats = {}
         if not config.get('dedup_new_samples', False):
             self.remove_duplicates = self._null_remove
+        # The records index is maintained only if it is used (semantic sampling or dedup)
+        if self.semantic_sampling or config.get('dedup_new_samples', False):
+            self.index = DatasetIndex(self.dedup, **config.get('index', {}))
+        else:
+            self.index = None
+
+        if config.records_path is None:
+            self.store = RecordsStore()
+        else:
+            self.store = RecordsStore.from_frame(pd.read_csv(config.records_path))
+        self.rebuild_index()
+
+    @property
+    def records(self) -> pd.DataFrame:
+        """
+        Return all the records as a dataframe (a copy, changes should be done with update/modify/apply)
+        """
+        return self.store.to_frame()
+
+    @records.setter
+    def records(self, records: pd.DataFrame):
+        self.store = RecordsStore.from_frame(records)
 
     def __len__(self):
         """
         Return the number of samples in the dataset.
         """
-        return len(self.records)
+        return len(self.store)
 
     def __getitem__(self, batch_idx):
         """
         Return the batch idx.
         """
-        extract_records = self.records[self.records['batch_id'] == batch_idx]
-        extract_records = extract_records.reset_index(drop=True)
-        return extract_records
+        return self.store.to_frame(self.store.batch_rows(batch_idx))
 
     def get_leq(self, batch_idx):
         """
         Return all the records up to batch_idx (includes).
         """
-        extract_records = self.records[self.records['batch_id'] <= batch_idx]
-        extract_records = extract_records.reset_index(drop=True)
-        return extract_records
+        return self.store.to_frame(self.store.batch_rows(batch_idx, leq=True))
 
     def add(self, sample_list: dict = None, batch_id: int = None, records: pd.DataFrame = None):
         """
@@ -58,9 +76,20 @@ class DatasetBase:
         :param records: dataframes, update using pandas
         """
         if records is None:
-            records = pd.DataFrame([{'id': len(self.records) + i, 'text': sample, 'batch_id': batch_id} for
+            next_id = self.store.max_id + 1
+            records = pd.DataFrame([{'id': next_id + i, 'text': sample, 'batch_id': batch_id} for
                        i, sample in enumerate(sample_list)])
-        self.records = pd.concat([self.records, records], ignore_index=True)
+        self.store.append(records)
+        if self.index is not None:
+            self.index.add(records['id'].tolist(), records['text'].tolist())
+
+    def rebuild_index(self):
+        """
+        Rebuild the records index from all the dataset records
+        """
+        if self.index is not None:
+            self.index.reset()
+            self.index.add(self.store.column('id').tolist(), self.store.column('text').tolist())
 
     def update(self, records: pd.DataFrame):
         """
@@ -70,33 +99,31 @@ class DatasetBase:
         if len(records) == 0:
             return
 
-        # Set 'id' as the index for both DataFrames
-        records.set_index('id', inplace=True)
-        self.records.set_index('id', inplace=True)
-
         # Update using 'id' as the key
-        self.records.update(records)
-
-        # Remove null annotations
-        if len(self.records.loc[self.records["annotation"]=="Discarded"]) > 0:
-            discarded_annotation_records = self.records.loc[self.records["annotation"]=="Discarded"]
-            #TODO: direct `discarded_annotation_records` to another dataset to be used later for corner-cases
-            self.records = self.records.loc[self.records["annotation"]!="Discarded"]
+        updated_rows = self.store.update(records)
 
-        # Reset index
-        self.records.reset_index(inplace=True)
+        # Remove null annotations (only the updated records can become discarded)
+        discarded_rows = updated_rows[self.store.column('annotation', updated_rows) == "Discarded"]
+        if len(discarded_rows) > 0:
+            #TODO: direct the discarded records to another dataset to be used later for corner-cases
+            discarded_ids = self.store.column('id', discarded_rows).tolist()
+            self.store.remove(discarded_rows)
+            if self.index is not None:
+                self.index.remove(discarded_ids)
 
     def modify(self, index: int, record: dict):
         """
         Modify a record in the dataset.
+        :param index: The record id
+        :param record: The new values of the record columns
         """
-        self.records[index] = record
+        self.store.update(pd.DataFrame([{**record, 'id': index}]))
 
     def apply(self, function, column_name: str):
         """
         Apply function on each record.
         """
-        self.records[column_name] = self.records.apply(function, axis=1)
+        self.store.set_column(column_name, self.records.apply(function, axis=1))
 
     def save_dataset(self, path: Path):
         self.records.to_csv(path, index=False, quoting=csv.QUOTE_NONNUMERIC)
@@ -108,19 +135,33 @@ class DatasetBase:
         """
         if os.path.isfile(path):
             self.records = pd.read_csv(path, dtype={'annotation': str, 'prediction': str, 'batch_id': int})
+            self.rebuild_index()
         else:
             logging.warning('Dataset dump not found, initializing from zero')
 
     def remove_duplicates(self, samples: list) -> list:
         """
         Remove (soft) duplicates from the given samples
+        In cross-batch mode, samples that are near-duplicates of existing records are removed as well
         :param samples: The samples
         :return: The samples without duplicates
         """
+        if len(samples) == 0:
+            return samples
         dd = self.dedup.copy()
         df = pd.DataFrame(samples, columns=['text'])
         df_dedup = dd.sample(df, operation_function=min)
-        return df_dedup['text'].tolist()
+        dedup_samples = df_dedup['text'].tolist()
+        num_batch_duplicates = len(samples) - len(dedup_samples)
+        num_dataset_duplicates = 0
+        if self.cross_batch_dedup:
+            is_duplicate = self.index.is_duplicate(dedup_samples)
+            num_dataset_duplicates = sum(is_duplicate)
+            dedup_samples = [sample for sample, duplicate in zip(dedup_samples, is_duplicate) if not duplicate]
+        logging.info(f'Dedup: removed {num_batch_duplicates} duplicates within the new samples and '
+                     f'{num_dataset_duplicates} duplicates of existing records')
+        self.dedup_stats = {'batch_duplicates': num_batch_duplicates, 'dataset_duplicates': num_dataset_duplicates}
+        return dedup_samples
 
     def _null_remove(self, samples: list) -> list:
         # Identity function that returns the input unmodified
@@ -134,13 +175,15 @@ class DatasetBase:
         """
         n = n or self.sample_size
         if self.semantic_sampling:
-            dd = self.dedup.copy()
-            df_samples = dd.sample(self.records).head(n)
+            # One random record from each semantic cluster
+            sampled_ids = [random.choice(cluster) for cluster in self.index.get_clusters()]
+            sampled_rows = np.sort(self.store.get_rows(sampled_ids))[:n]
+            df_samples = self.store.to_frame(sampled_rows)
 
             if len(df_samples) < n:
-                df_samples = self.records.head(n)
+                df_samples = self.store.to_frame(self.store.alive_rows()[:n])
         else:
-            df_samples = self.records.sample(n)
+            df_samples = self.store.to_frame(np.random.choice(self.store.alive_rows(), n, replace=False))
         return df_samples
 
     @staticmethod
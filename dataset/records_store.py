@@ -0,0 +1,225 @@
+import numpy as np
+import pandas as pd
+
+
+class RecordsStore:
+    """
+    A columnar storage engine for the dataset records. Each column is a preallocated numpy array (int64 for the id
+    and batch_id, object otherwise) that grows by doubling its capacity, so appends are amortized O(1).
+    Records are located by id with a hash map, removed records are only marked as deleted (the columns are compacted
+    when most of the rows are deleted), and since the batches are appended in order, batch_id queries are a binary
+    search followed by a slice, instead of a boolean mask over all the records.
+    """
+
+    default_columns = ['id', 'text', 'prediction', 'annotation', 'metadata', 'score', 'batch_id']
+    int_columns = ['id', 'batch_id']
+
+    def __init__(self, columns: list[str] = None):
+        """
+        Initialize a new (empty) instance of the RecordsStore class.
+        :param columns: The columns names
+        """
+        self.capacity = 0
+        self.size = 0
+        self.num_deleted = 0
+        self.alive = np.zeros(0, dtype=bool)
+        self.data = {}
+        for column in (columns or self.default_columns):
+            self.add_column(column)
+        self.id_to_row = {}
+        self.sorted_batches = True
+
+    @classmethod
+    def from_frame(cls, records: pd.DataFrame):
+        """
+        Create a new store from a dataframe
+        :param records: The records
+        """
+        store = cls(list(dict.fromkeys(cls.default_columns + list(records.columns))))
+        store.append(records)
+        return store
+
+    def __len__(self):
+        return self.size - self.num_deleted
+
+    @property
+    def columns(self) -> list[str]:
+        return list(self.data.keys())
+
+    def add_column(self, column: str):
+        """
+        Add an empty column
+        :param column: The column name
+        """
+        if column in self.int_columns:
+            self.data[column] = np.zeros(self.capacity, dtype=np.int64)
+        else:
+            self.data[column] = np.full(self.capacity, np.nan, dtype=object)
+
+    def empty_value(self, column: str):
+        """
+        Return the value of an empty cell of the column (0 for the int columns, NaN otherwise)
+        :param column: The column name
+        """
+        return 0 if column in self.int_columns else np.nan
+
+    def reserve(self, capacity: int):
+        """
+        Make sure the columns can hold capacity rows, the capacity is (at least) doubled when it grows
+        :param capacity: The required capacity
+        """
+        if capacity <= self.capacity:
+            return
+        new_capacity = max(capacity, 2 * self.capacity, 1024)
+        for column, values in self.data.items():
+            if column in self.int_columns:
+                new_values = np.zeros(new_capacity, dtype=np.int64)
+            else:
+                new_values = np.full(new_capacity, np.nan, dtype=object)
+            new_values[:self.size] = values[:self.size]
+            self.data[column] = new_values
+        alive = np.zeros(new_capacity, dtype=bool)
+        alive[:self.size] = self.alive[:self.size]
+        self.alive = alive
+        self.capacity = new_capacity
+
+    def append(self, records: pd.DataFrame):
+        """
+        Append records to the store. The columns that are not in the records are set to their empty value
+        :param records: The records, must contain an 'id' column
+        """
+        if len(records) == 0:
+            return
+        for column in records.columns:
+            if column not in self.data:
+                self.add_column(column)
+        self.reserve(self.size + len(records))
+        start, end = self.size, self.size + len(records)
+        for column in self.data:
+            if column not in records.columns:
+                self.data[column][start:end] = self.empty_value(column)
+                continue
+            values = records[column].to_numpy()
+            if column in self.int_columns:
+                values = values.astype(np.int64)
+            self.data[column][start:end] = values
+        self.alive[start:end] = True
+        batch_ids = self.data['batch_id'][start:end]
+        if (start > 0 and batch_ids[0] < self.data['batch_id'][start - 1]) or np.any(np.diff(batch_ids) < 0):
+            self.sorted_batches = False
+        for row, record_id in enumerate(self.data['id'][start:end].tolist(), start):
+            self.id_to_row[record_id] = row
+        self.size = end
+
+    def get_rows(self, ids) -> np.ndarray:
+        """
+        Return the rows of the given ids, -1 for ids that are not in the store
+        :param ids: The records ids
+        """
+        return np.array([self.id_to_row.get(record_id, -1) for record_id in ids], dtype=np.int64)
+
+    def update(self, records: pd.DataFrame) -> np.ndarray:
+        """
+        Update records by their id. Like pandas update, only non-null values are written, and columns that are
+        not in the store are ignored
+        :param records: The records, must contain an 'id' column
+        :return: The rows that were updated
+        """
+        rows = self.get_rows(records['id'].astype(np.int64).tolist())
+        valid = rows >= 0
+        for column in records.columns:
+            if column == 'id' or column not in self.data:
+                continue
+            values = records[column].to_numpy()
+            mask = valid & pd.notna(values)
+            if column in self.int_columns:
+                self.data[column][rows[mask]] = values[mask].astype(np.int64)
+            else:
+                self.data[column][rows[mask]] = values[mask]
+        return rows[valid]
+
+    def set_column(self, column: str, values):
+        """
+        Set the values of a column for all the (non deleted) records
+        :param column: The column name
+        :param values: The values, in the records order
+        """
+        if column not in self.data:
+            self.add_column(column)
+        self.data[column][self.alive_rows()] = np.asarray(values)
+
+    def remove(self, rows: np.ndarray):
+        """
+        Remove records by their rows
+        :param rows: The rows to remove
+        """
+        rows = rows[self.alive[rows]]
+        if len(rows) == 0:
+            return
+        self.alive[rows] = False
+        self.num_deleted += len(rows)
+        for record_id in self.data['id'][rows].tolist():
+            del self.id_to_row[record_id]
+        if self.num_deleted > self.size // 2:
+            self.compact()
+
+    def compact(self):
+        """
+        Drop the deleted rows from the columns, the freed rows are reset to the empty value
+        """
+        rows = self.alive_rows()
+        for column in self.data:
+            self.data[column][:len(rows)] = self.data[column][rows]
+            self.data[column][len(rows):self.size] = self.empty_value(column)
+        self.alive[:len(rows)] = True
+        self.alive[len(rows):] = False
+        self.size = len(rows)
+        self.num_deleted = 0
+        self.id_to_row = {record_id: row for row, record_id in enumerate(self.data['id'][:self.size].tolist())}
+
+    def alive_rows(self, start: int = 0, end: int = None) -> np.ndarray:
+        """
+        Return the non deleted rows in the range [start, end)
+        """
+        end = self.size if end is None else end
+        if self.num_deleted == 0:
+            return np.arange(start, end)
+        return np.flatnonzero(self.alive[start:end]) + start
+
+    def batch_rows(self, batch_id: int, leq: bool = False) -> np.ndarray:
+        """
+        Return the rows of the batch (or all the batches up to the batch, includes)
+        :param batch_id: The batch id
+        :param leq: If True, return the rows of all the batches up to batch_id
+        """
+        batch_ids = self.data['batch_id'][:self.size]
+        if not self.sorted_batches:
+            mask = (batch_ids <= batch_id) if leq else (batch_ids == batch_id)
+            return np.flatnonzero(mask & self.alive[:self.size])
+        end = int(np.searchsorted(batch_ids, batch_id, side='right'))
+        start = 0 if leq else int(np.searchsorted(batch_ids, batch_id, side='left'))
+        return self.alive_rows(start, end)
+
+    def column(self, column: str, rows: np.ndarray = None) -> np.ndarray:
+        """
+        Return the values of a column
+        :param column: The column name
+        :param rows: The rows, all the records if None
+        """
+        return self.data[column][self.alive_rows() if rows is None else rows]
+
+    def to_frame(self, rows: np.ndarray = None) -> pd.DataFrame:
+        """
+        Materialize records as a dataframe
+        :param rows: The rows, all the records if None
+        :return: A dataframe of the records, with a new index
+        """
+        rows = self.alive_rows() if rows is None else rows
+        return pd.DataFrame({column: values[rows] for column, values in self.data.items()}).infer_objects()
+
+    @property
+    def max_id(self) -> int:
+        """
+        Return the maximal record id, -1 if the store is empty
+        """
+        return int(self.column('id').max()) if len(self) > 0 else -1
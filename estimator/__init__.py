@@ -1,6 +1,5 @@
 import pandas as pd
 
-from .estimator_argilla import ArgillaEstimator
 from .estimator_llm import LLMEstimator
 from .estimator_llm_batch import LLMBatchEstimator
 from dataset.base_dataset import DatasetBase
@@ -28,6 +27,7 @@ class DummyEstimator:
 
 def give_estimator(opt):
     if opt.method == 'argilla':
+        from .estimator_argilla import ArgillaEstimator  # argilla is imported only if it is the selected annotator
         return ArgillaEstimator(opt.config)
     elif opt.method == 'llm':
         return LLMEstimator(opt.config)
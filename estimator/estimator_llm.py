@@ -1,7 +1,41 @@
 from utils.llm_chain import ChainWrapper, get_chain_metadata
+from estimator.prediction_cache import PredictionCache
 from pathlib import Path
 from dataset.base_dataset import DatasetBase
 import pandas as pd
+import numpy as np
+import logging
+
+token_counters = {}
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+
+def get_token_counter(model_name: str, llm_type: str = ''):
+    """
+    Return a function that counts the tokens of a text with the model tokenizer. If the tokenizer is not available
+    (e.g. a non-OpenAI model, or the encoding can't be downloaded), the tokens are estimated by the text length.
+    The fake (offline) LLM always uses the estimate, so the tokenizer encoding is never downloaded
+    :param model_name: The model name
+    :param llm_type: The LLM type
+    """
+    if llm_type.lower() == 'fake':
+        return estimate_tokens
+    if model_name not in token_counters:
+        try:
+            import tiktoken
+            try:
+                encoding = tiktoken.encoding_for_model(model_name)
+            except KeyError:
+                encoding = tiktoken.get_encoding('cl100k_base')
+            token_counters[model_name] = lambda text: len(encoding.encode(text, disallowed_special=()))
+        except Exception as e:
+            logging.warning(f'Tokenizer is not available ({repr(e)}), the tokens are estimated by the text length')
+            token_counters[model_name] = estimate_tokens
+    return token_counters[model_name]
+
 
 class LLMEstimator:
     """
@@ -16,12 +50,23 @@ class LLMEstimator:
         self.opt = opt
         self.chain = None
         self.mini_batch_size = opt.mini_batch_size
+        # If > 0, the mini-batches are packed up to this number of tokens (and up to mini_batch_size samples)
+        self.mini_batch_tokens = opt.get('mini_batch_tokens', 0)
+        # Samples that are missing from their mini-batch results are sent again up to max_parse_retries times
+        self.max_parse_retries = opt.get('max_parse_retries', 2)
+        self.parse_stats = {}
         self.mode = opt.mode
         self.num_workers = opt.num_workers
+        # A concurrency limiter shared with other estimators (set by LLMBatchEstimator)
+        self.limiter = None
         if 'instruction' in opt.keys():
             self.cur_instruct = opt.instruction
         else:
             self.cur_instruct = None
+        if opt.get('use_cache', False):
+            self.cache = PredictionCache()
+        else:
+            self.cache = None
 
     @staticmethod
     def generate_sample_text(sample_id: int, text: str) -> str:
@@ -53,29 +98,130 @@ class LLMEstimator:
         self.chain = ChainWrapper(self.opt.llm, self.opt.prompt, chain_metadata['json_schema'],
                                   chain_metadata['parser_func'])
 
+    def pack_mini_batches(self, record: pd.DataFrame, mini_batch_size: int = None) -> list[list[int]]:
+        """
+        Split the records into mini-batches. By default, each mini-batch has mini_batch_size samples. If
+        mini_batch_tokens is set, the samples are sorted by their length and each mini-batch is filled up to the
+        tokens budget (and up to mini_batch_size samples), a longer sample is sent alone
+        :param record: The records
+        :param mini_batch_size: The (maximal) number of samples in a mini-batch, self.mini_batch_size if None
+        :return: A list of mini-batches, each one is a list of the records ids (the record index)
+        """
+        mini_batch_size = mini_batch_size or self.mini_batch_size
+        ids = record.index.tolist()
+        if self.mini_batch_tokens <= 0:
+            return [ids[i:i + mini_batch_size] for i in range(0, len(ids), mini_batch_size)]
+        count_tokens = get_token_counter(self.opt.llm.get('name', ''), self.opt.llm.get('type', ''))
+        num_tokens = np.array([count_tokens(self.generate_sample_text(i, text)) for i, text in record['text'].items()])
+        mini_batches = []
+        cur_batch, cur_tokens = [], 0
+        for position in np.argsort(num_tokens, kind='stable'):
+            if len(cur_batch) > 0 and (cur_tokens + num_tokens[position] > self.mini_batch_tokens or
+                                       len(cur_batch) >= mini_batch_size):
+                mini_batches.append(cur_batch)
+                cur_batch, cur_tokens = [], 0
+            cur_batch.append(ids[position])
+            cur_tokens += num_tokens[position]
+        if len(cur_batch) > 0:
+            mini_batches.append(cur_batch)
+        return mini_batches
+
+    def build_mini_batch_input(self, record: pd.DataFrame, mini_batch: list[int]) -> dict:
+        """
+        Build the chain input of a mini-batch
+        :param record: The records
+        :param mini_batch: The ids of the mini-batch records
+        :return: The chain input
+        """
+        samples = ''.join(self.generate_sample_text(i, record.loc[i, 'text']) for i in mini_batch)
+        return {'batch_size': len(mini_batch), 'task_instruction': self.cur_instruct, 'samples': samples}
+
+    def parse_mini_batch(self, mini_batch: list[int], result: dict) -> tuple[dict, list[int]]:
+        """
+        Match the results of a mini-batch to its records ids, and update the parse statistics of the mini-batch size
+        :param mini_batch: The ids of the mini-batch records
+        :param result: The chain result, None if the request failed
+        :return: A dict with the prediction of each id, and the list of the missing ids. Ids that are duplicated
+        with different predictions are considered missing, ids that are not in the mini-batch are ignored. If the
+        request failed, no id is considered missing (the request was already retried by the chain)
+        """
+        stats = self.parse_stats.setdefault(len(mini_batch), {'batches': 0, 'samples': 0, 'failed_batches': 0,
+                                                               'missing': 0, 'duplicates': 0, 'out_of_range': 0})
+        stats['batches'] += 1
+        if result is None:
+            # The request failed (after all the retries), this is not a parse failure
+            stats['failed_batches'] += 1
+            return {}, []
+        stats['samples'] += len(mini_batch)
+        expected_ids = set(mini_batch)
+        predictions = {}
+        conflicts = set()
+        for res in result['results']:
+            try:
+                sample_id = int(res['id'])
+            except (KeyError, TypeError, ValueError):
+                stats['out_of_range'] += 1
+                continue
+            if sample_id not in expected_ids:
+                stats['out_of_range'] += 1
+            elif sample_id in predictions:
+                stats['duplicates'] += 1
+                if predictions[sample_id] != res['prediction']:
+                    conflicts.add(sample_id)
+            else:
+                predictions[sample_id] = res['prediction']
+        for sample_id in conflicts:
+            del predictions[sample_id]
+        missing = [sample_id for sample_id in mini_batch if sample_id not in predictions]
+        stats['missing'] += len(missing)
+        return predictions, missing
+
+    def get_parse_failure_rates(self) -> dict:
+        """
+        Return the parse failure rate (the share of the samples without a valid prediction in the parsed results) of
+        each mini-batch size
+        """
+        return {size: stats['missing'] / stats['samples'] for size, stats in sorted(self.parse_stats.items())
+                if stats['samples'] > 0}
+
     def apply_dataframe(self, record: pd.DataFrame):
         """
-        Apply the estimator on a dataframe
+        Apply the estimator on a dataframe. Samples that are missing from the results of their mini-batch are sent
+        again in smaller mini-batches, up to max_parse_retries times. The samples of failed requests (after the
+        retries of the chain) are not sent again, they are marked as Discarded. The retries bypass the LLM cache, since a
+        mini-batch of a single sample has the same prompt as in the previous attempt
         :param record: The record
         """
-        chain_input = ''
-        mini_batch_inputs = []
         record[self.mode] = 'Discarded'
-        # prepare all the inputs for the chains
-        for i, row in record.iterrows():
-            chain_input += self.generate_sample_text(i, row['text'])
-            if ((i + 1) % self.mini_batch_size) == 0:
-                mini_batch_inputs.append({'batch_size': self.mini_batch_size, 'task_instruction': self.cur_instruct,
-                                          'samples': chain_input})
-                chain_input = ''
-        if not (chain_input == ''):
-            mini_batch_inputs.append({'batch_size': self.mini_batch_size, 'task_instruction': self.cur_instruct,
-                                      'samples': chain_input})
-
-        all_results = self.chain.batch_invoke(mini_batch_inputs, self.num_workers)
-        union_results = [element for sublist in all_results for element in sublist['results']]
-        for res in union_results:
-            record.loc[res['id'], self.mode] = res['prediction']
+        mini_batches = self.pack_mini_batches(record)
+        num_failed = 0
+        for attempt in range(self.max_parse_retries + 1):
+            # prepare all the inputs for the chains
+            mini_batch_inputs = [self.build_mini_batch_input(record, mini_batch) for mini_batch in mini_batches]
+            all_results = self.chain.batch_invoke(mini_batch_inputs, self.num_workers, get_index=True,
+                                                  limiter=self.limiter, refresh_cache=attempt > 0)
+            results = {res['index']: res['result'] for res in all_results}
+            missing = []
+            for i, mini_batch in enumerate(mini_batches):
+                if results.get(i) is None:
+                    num_failed += len(mini_batch)
+                predictions, mini_batch_missing = self.parse_mini_batch(mini_batch, results.get(i))
+                for sample_id, prediction in predictions.items():
+                    record.loc[sample_id, self.mode] = prediction
+                missing += mini_batch_missing
+            if len(missing) == 0:
+                break
+            if attempt == self.max_parse_retries:
+                logging.warning(f'{len(missing)} samples are missing from the results after all the retries, '
+                                f'they are marked as Discarded')
+                break
+            mini_batch_size = max(1, max(len(mini_batch) for mini_batch in mini_batches) // 2)
+            logging.info(f'{len(missing)} samples are missing from the results, sending them again in mini-batches '
+                         f'of up to {mini_batch_size} samples')
+            mini_batches = self.pack_mini_batches(record.loc[missing], mini_batch_size)
+        if num_failed > 0:
+            logging.warning(f'{num_failed} samples are in failed requests, they are marked as Discarded')
+        logging.info(f'Parse failure rate by mini-batch size: {self.get_parse_failure_rates()}')
         return record
 
     def apply(self, dataset: DatasetBase, idx: int, leq: bool = False):
@@ -92,4 +238,34 @@ class LLMEstimator:
             batch_records = dataset.get_leq(idx)
         else:
             batch_records = dataset[idx]
-        return self.apply_dataframe(batch_records)
+        return self.apply_records(batch_records)
+
+    def apply_records(self, batch_records: pd.DataFrame):
+        """
+        Apply the estimator on the given records (with the prediction cache, if it is used)
+        :param batch_records: The records, with a RangeIndex
+        """
+        if self.cache is None:
+            return self.apply_dataframe(batch_records)
+        return self.apply_cached(batch_records)
+
+    def apply_cached(self, record: pd.DataFrame):
+        """
+        Apply the estimator on a dataframe, only the records that are not in the cache are sent to the LLM
+        :param record: The record
+        """
+        chain_key = PredictionCache.chain_key(self.cur_instruct, self.chain.prompt.template, self.opt.llm, self.mode)
+        texts = record['text'].tolist()
+        cached_results = self.cache.lookup(chain_key, texts)
+        logging.info(f'Prediction cache: {len(cached_results)} hits out of {len(texts)} records '
+                     f'(total hit rate {self.cache.hit_rate:.2%})')
+        missing_mask = [i not in cached_results for i in range(len(record))]
+        missing_records = record[missing_mask].reset_index(drop=True)
+        record[self.mode] = 'Discarded'
+        for i, result in cached_results.items():
+            record.loc[i, self.mode] = result
+        if len(missing_records) > 0:
+            missing_records = self.apply_dataframe(missing_records)
+            self.cache.update(chain_key, missing_records['text'].tolist(), missing_records[self.mode].tolist())
+            record.loc[missing_mask, self.mode] = missing_records[self.mode].values
+        return record
@@ -1,6 +1,11 @@
 from estimator.estimator_llm import LLMEstimator
 from dataset.base_dataset import DatasetBase
+from utils.llm_chain import ConcurrencyLimiter
 import pandas as pd
+import numpy as np
+import concurrent.futures
+import logging
+import time
 
 
 class LLMBatchEstimator:
@@ -14,10 +19,27 @@ class LLMBatchEstimator:
         :param opt: The configuration file (EasyDict)
         """
         self.llm_estimators = [LLMEstimator(opt.estimator_config) for _ in range(len(opt.instructions))]
+        # All the estimators run concurrently, with a global cap on the number of concurrent requests
+        self.num_workers = opt.get('num_workers', opt.estimator_config.num_workers * len(opt.instructions))
+        self.limiter = ConcurrencyLimiter(self.num_workers)
         for i, estimator in enumerate(self.llm_estimators):
             estimator.cur_instruct = opt.instructions[i]
+            estimator.num_workers = self.num_workers
+            estimator.limiter = self.limiter
         self.mode = opt.estimator_config.mode
         self.aggregation_mode = opt.aggregation_mode
+        # The estimators weights in the 'weighted' and 'confidence' aggregation modes
+        self.weights = np.array(opt.get('weights', [1] * len(self.llm_estimators)), dtype=float)
+        # In the 'confidence' aggregation mode, records with a lower confidence are discarded
+        self.min_confidence = opt.get('min_confidence', 0.5)
+        # In cascade mode ('exist' and 'all' only), the instructions run one after the other in the cascade order,
+        # and only the undecided records are sent to the next instruction
+        self.cascade = opt.get('cascade', False)
+        self.cascade_order = opt.get('cascade_order', list(range(len(self.llm_estimators))))
+        if self.cascade and self.aggregation_mode not in ['exist', 'all']:
+            raise Exception(f'Cascade mode is not supported for the aggregation class {self.aggregation_mode}')
+        self.cascade_stats = {}
+        self.instructions_stats = {}
 
     def calc_usage(self) -> float:
         """"
@@ -25,23 +47,101 @@ class LLMBatchEstimator:
         """
         return sum([estimator.calc_usage() for estimator in self.llm_estimators])
 
-    def get_aggregation_function(self):
+    def build_label_matrix(self, update_datasets: list[pd.DataFrame]) -> np.ndarray:
+        """
+        Collect the outputs of all the estimators into a single label matrix
+        :param update_datasets: The results of each one of the estimators
+        :return: A 2-D array (records x estimators) of the labels (as strings), the records are in the order of the
+        first estimator results
+        """
+        ids = update_datasets[0]['id']
+        columns = [update_datasets[0][self.mode].to_numpy()]
+        for df in update_datasets[1:]:
+            columns.append(df.set_index('id')[self.mode].reindex(ids).to_numpy())
+        return np.column_stack(columns).astype(str)
+
+    def aggregate(self, labels: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Aggregate the label matrix of the estimators with NumPy reductions
+        :param labels: The label matrix (records x estimators)
+        :return: The aggregated label of each record, and its confidence (the (weighted) share of the estimators
+        that agree with it)
+        """
+        num_records, num_estimators = labels.shape
+        # Categorical codes, the categories are sorted so the codes order is the labels order
+        codes, categories = pd.factorize(labels.ravel(), sort=True)
+        codes = codes.reshape(num_records, num_estimators)
+        if self.aggregation_mode in ['exist', 'all']:
+            is_yes = labels == 'Yes'
+            decision = is_yes.any(axis=1) if self.aggregation_mode == 'exist' else is_yes.all(axis=1)
+            result = np.where(decision, 'Yes', 'No')
+            return result, (labels == result[:, None]).mean(axis=1)
+        if self.aggregation_mode == 'mean':
+            values = pd.to_numeric(pd.Series(labels.ravel()), errors='coerce').to_numpy().reshape(labels.shape)
+            return values.mean(axis=1), np.ones(num_records)
         if self.aggregation_mode == 'max':
-            return lambda record: max(record)
+            result_codes = codes.max(axis=1)
         elif self.aggregation_mode == 'min':
-            return lambda record: min(record)
-        elif self.aggregation_mode == 'mean':
-            return lambda record: sum(record) / len(record)
+            result_codes = codes.min(axis=1)
         elif self.aggregation_mode == 'median':
-            return lambda record: sorted(record)[len(record) // 2]
-        elif self.aggregation_mode == 'majority':
-            return lambda record: max(set(record), key=record.count)
-        elif self.aggregation_mode == 'exist':
-            return lambda record: 'Yes' if any([t == 'Yes' for t in record]) else 'No'
-        elif self.aggregation_mode == 'all':
-            return lambda record: 'Yes' if all([t == 'Yes' for t in record]) else 'No'
+            result_codes = np.sort(codes, axis=1)[:, num_estimators // 2]
+        elif self.aggregation_mode in ['majority', 'weighted', 'confidence']:
+            votes = np.zeros((num_records, len(categories)))
+            weights = self.weights if self.aggregation_mode != 'majority' else np.ones(num_estimators)
+            np.add.at(votes, (np.arange(num_records)[:, None], codes), weights[None, :])
+            result_codes = votes.argmax(axis=1)
+            confidence = votes[np.arange(num_records), result_codes] / weights.sum()
+            result = np.asarray(categories, dtype=object)[result_codes]
+            if self.aggregation_mode == 'confidence':
+                result[confidence < self.min_confidence] = 'Discarded'
+            return result, confidence
         else:
             raise Exception(f'Unknown aggregation class {self.aggregation_mode}')
+        result = np.asarray(categories, dtype=object)[result_codes]
+        return result, (codes == result_codes[:, None]).mean(axis=1)
+
+    def apply_estimator(self, estimator: LLMEstimator, records: pd.DataFrame) -> pd.DataFrame:
+        """
+        Apply a single instruction estimator on the records, and keep its latency and cost
+        :param estimator: The estimator
+        :param records: The records, with a RangeIndex
+        :return: The estimator results
+        """
+        usage = estimator.calc_usage()
+        start_time = time.time()
+        result = estimator.apply_records(records)
+        self.instructions_stats[estimator.cur_instruct] = {'latency': time.time() - start_time,
+                                                           'usage': estimator.calc_usage() - usage,
+                                                           'num_records': len(records)}
+        return result
+
+    def apply_cascade(self, records: pd.DataFrame) -> pd.DataFrame:
+        """
+        Apply the estimators one after the other (in the cascade order), only the records that are still undecided
+        are sent to the next estimator: in 'exist' mode a record is decided by its first 'Yes', and in 'all' mode by
+        its first answer that is not 'Yes'
+        :param records: The records, with a RangeIndex
+        :return: The records with the aggregated results
+        """
+        decided_label, default_label = ('Yes', 'No') if self.aggregation_mode == 'exist' else ('No', 'Yes')
+        labels = np.full(len(records), default_label, dtype=object)
+        positions = np.arange(len(records))
+        num_calls = 0
+        for i in self.cascade_order:
+            if len(positions) == 0:
+                break
+            num_calls += len(positions)
+            result = self.apply_estimator(self.llm_estimators[i], records.iloc[positions].reset_index(drop=True))
+            is_yes = (result[self.mode] == 'Yes').to_numpy()
+            decided = is_yes if self.aggregation_mode == 'exist' else ~is_yes
+            labels[positions[decided]] = decided_label
+            positions = positions[~decided]
+        total_calls = len(records) * len(self.llm_estimators)
+        self.cascade_stats = {'num_calls': num_calls, 'total_calls': total_calls,
+                              'short_circuit_rate': 1 - num_calls / total_calls}
+        logging.info(f'Batch estimator cascade stats: {self.cascade_stats}')
+        records[self.mode] = labels
+        return records
 
     def apply(self, dataset: DatasetBase, idx: int, leq: bool = False):
         """
@@ -51,18 +151,24 @@ class LLMBatchEstimator:
         :param idx: The current batch index
         :param leq: If True, apply on all the batches up to idx (includes), otherwise apply only on idx
         """
-        update_datasets = [estimator.apply(dataset, idx, leq) for estimator in self.llm_estimators]
-        res_dataset = update_datasets[0]
-        if res_dataset.empty:
-            return res_dataset
-        for i, df in enumerate(update_datasets[1:]):
-            # Merge the dataframes on the 'id' column
-            merged_df = pd.merge(res_dataset, df[['id', self.mode]], on='id', how='left', suffixes=('_left', '_right'))
-            if i == 0:
-                res_dataset[self.mode] = merged_df.apply(lambda row: [str(row['{}_left'.format(self.mode)])] +
-                                                                     [str(row['{}_right'.format(self.mode)])], axis=1)
-            else:
-                res_dataset[self.mode] = merged_df.apply(lambda row: row['{}_left'.format(self.mode)] +
-                                                                     [str(row['{}_right'.format(self.mode)])], axis=1)
-        res_dataset[self.mode] = res_dataset[self.mode].apply(self.get_aggregation_function())
+        for estimator in self.llm_estimators:
+            if estimator.chain is None:
+                estimator.init_chain(dataset.label_schema)
+        if leq:
+            records = dataset.get_leq(idx)
+        else:
+            records = dataset[idx]
+        if records.empty:
+            return records
+        self.instructions_stats = {}
+        if self.cascade:
+            res_dataset = self.apply_cascade(records)
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.llm_estimators)) as executor:
+                update_datasets = list(executor.map(lambda estimator: self.apply_estimator(estimator, records.copy()),
+                                                    self.llm_estimators))
+            res_dataset = update_datasets[0]
+            labels = self.build_label_matrix(update_datasets)
+            res_dataset[self.mode], res_dataset['{}_confidence'.format(self.mode)] = self.aggregate(labels)
+        logging.info(f'Batch estimator instructions stats: {self.instructions_stats}')
         return res_dataset
@@ -0,0 +1,91 @@
+import hashlib
+import json
+import logging
+import os.path
+import pickle
+from pathlib import Path
+
+
+def get_hash(value) -> str:
+    """
+    Return a stable hash for the given value
+    :param value: A string, or any json serializable object
+    :return: The hex digest of the value
+    """
+    if not isinstance(value, str):
+        value = json.dumps(value, sort_keys=True, default=str)
+    return hashlib.sha256(value.encode('utf-8')).hexdigest()
+
+
+class PredictionCache:
+    """
+    A content-addressed store of the estimator results. Each entry is keyed by the hash of
+    (instruction, prompt template, llm config, mode) and the hash of the sample text, so the same sample is never
+    sent twice to the LLM with the same prompt
+    """
+
+    def __init__(self):
+        self.store = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def chain_key(instruction: str, prompt_template: str, llm_config: dict, mode: str) -> str:
+        """
+        Return the key of the chain setup
+        :param instruction: The task instruction
+        :param prompt_template: The predictor prompt template
+        :param llm_config: The llm config
+        :param mode: The estimator mode (either 'prediction' or 'annotation')
+        """
+        return get_hash([get_hash(instruction or ''), get_hash(prompt_template), get_hash(llm_config), mode])
+
+    def lookup(self, chain_key: str, texts: list[str]) -> dict:
+        """
+        Find the cached results of the texts
+        :param chain_key: The chain key
+        :param texts: The samples texts
+        :return: A dict from the text position to the cached result, contains only the hits
+        """
+        results = {}
+        for i, text in enumerate(texts):
+            key = (chain_key, get_hash(text))
+            if key in self.store:
+                results[i] = self.store[key]
+        self.hits += len(results)
+        self.misses += len(texts) - len(results)
+        return results
+
+    def update(self, chain_key: str, texts: list[str], results: list[str]):
+        """
+        Add the results to the cache, discarded results are not cached
+        :param chain_key: The chain key
+        :param texts: The samples texts
+        :param results: The results of the samples
+        """
+        for text, result in zip(texts, results):
+            if result == 'Discarded':
+                continue
+            self.store[(chain_key, get_hash(text))] = result
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.
+
+    def save(self, path: Path):
+        """
+        Save the cache entries
+        :param path: path for the pickle file
+        """
+        pickle.dump(self.store, open(path, 'wb'))
+
+    def load(self, path: Path):
+        """
+        Load the cache entries
+        :param path: path for the pickle file
+        """
+        if os.path.isfile(path):
+            self.store.update(pickle.load(open(path, 'rb')))
+        else:
+            logging.warning('Prediction cache dump not found, initializing from zero')
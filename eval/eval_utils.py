@@ -1,4 +1,6 @@
 from estimator.estimator_llm import LLMEstimator
+import numpy as np
+import pandas as pd
 import json
 
 
@@ -28,23 +30,23 @@ def set_ranking_function(params):
     return wrapper
 
 
-def set_multiscore_function(scores_dic, num_workers=1):
+def set_multiscore_function(metric_handler, num_workers=1, mode='sequential'):
     def wrapper(dataset):
-        generation_dataset = dataset.copy()
-        generation_dataset['text'] = '###User input:\n' + generation_dataset['text'] + '\n####model prediction:\n' + \
-                                     generation_dataset['prediction']
-        for metric_name, metric_function in scores_dic.items():
-            generation_dataset['{}_{}'.format('score', metric_name)] = 'Discarded'
-            generation_dataset['{}_{}'.format('reasoning', metric_name)] = 'Discarded'
-        for metric_name, metric_function in scores_dic.items():
-            res = metric_function(generation_dataset, num_workers)
-            for index, score in res.items():
-                generation_dataset.loc[index, '{}_{}'.format('score', metric_name)] = score['metric_score']
-                generation_dataset.loc[index, '{}_{}'.format('reasoning', metric_name)] = score['metric_reason']
-
-        columns_to_copy = ['{}_{}'.format('score', metric_name) for metric_name in scores_dic.keys()] + \
-                          ['{}_{}'.format('reasoning', metric_name) for metric_name in scores_dic.keys()]
-        dataset[columns_to_copy] = generation_dataset[columns_to_copy]
+        records = pd.DataFrame({'text': '###User input:\n' + dataset['text'] + '\n####model prediction:\n' +
+                                        dataset['prediction']}, index=dataset.index)
+        all_results = metric_handler.score_records(records, num_workers, mode)
+        for metric in metric_handler.metrics:
+            metric_name = metric['metric_name']
+            res = all_results.get(metric_name, {})
+            # Missing scores are NaN (ignored by mean), missing reasoning are marked as 'Discarded'
+            scores = np.full(len(dataset), np.nan, dtype=float)
+            reasoning = np.full(len(dataset), 'Discarded', dtype=object)
+            if len(res) > 0:
+                positions = dataset.index.get_indexer(list(res.keys()))
+                scores[positions] = [score['metric_score'] for score in res.values()]
+                reasoning[positions] = [score['metric_reason'] for score in res.values()]
+            dataset['{}_{}'.format('score', metric_name)] = scores
+            dataset['{}_{}'.format('reasoning', metric_name)] = reasoning
         return dataset
 
     return wrapper
@@ -1,7 +1,6 @@
 import json
 import pandas as pd
 import numpy as np
-from sklearn.metrics import confusion_matrix
 import eval.eval_utils as utils
 
 
@@ -18,10 +17,12 @@ class Eval:
         :metric_handler (optional): The metric handler that generate the metrics
         :label_schema (optional): The label schema
         """
+        self.config = config
         self.score_function_name = config.function_name
         self.num_errors = config.num_large_errors
         self.error_threshold = config.error_threshold
         self.num_workers = config.get("num_workers", 1)
+        self.multiscore_mode = config.get("multiscore_mode", 'sequential')
         if metric_handler is not None:
             self.metric_handler = metric_handler
         self.dataset = None
@@ -43,9 +44,8 @@ class Eval:
         elif self.score_function_name == 'ranking':
             return utils.set_ranking_function(self.config.function_params)
         elif self.score_function_name == 'generator':
-            return utils.set_multiscore_function({metric['metric_name']: metric['metric_function']
-                                                  for metric in self.metric_handler.metrics},
-                                                 num_workers=self.num_workers)
+            return utils.set_multiscore_function(self.metric_handler, num_workers=self.num_workers,
+                                                 mode=self.multiscore_mode)
         else:
             raise NotImplementedError("Eval function not implemented")
 
@@ -112,19 +112,47 @@ class Eval:
         if is_score:
             return f"####\n##Prompt Score: {sample['score']:.2f}\n##Prompt:\n{sample['prompt']}\n#################\n"
         else:
-            return f"####\n##Prompt:\n{sample['prompt']}\n{self.large_error_to_str(sample['errors'], num_errors_per_label)}####\n "
+            errors_text = sample['errors_text'] if 'errors_text' in sample else \
+                self.large_error_to_str(sample['errors'], num_errors_per_label)
+            return f"####\n##Prompt:\n{sample['prompt']}\n{errors_text}####\n "
 
-    def add_history(self, prompt: str, task_description: str):
+    def errors_reference(self, errors: pd.DataFrame, num_errors_per_label: int) -> dict:
+        """
+        Return a reference to the errors that is kept in the history instead of the errors records: the records ids,
+        the scores and the errors text (pre-rendered for the meta-prompt)
+        :param errors: The errors records
+        :param num_errors_per_label: The max number of large errors per class in the errors text
+        :return: A dict with the errors reference
+        """
+        return {'error_ids': errors['id'].astype(int).tolist(), 'error_scores': errors['score'].tolist(),
+                'errors_text': self.large_error_to_str(errors, num_errors_per_label)}
+
+    def compact_history(self, num_errors_per_label: int):
+        """
+        Replace the errors records in the history entries (e.g. from a legacy dump) with errors references
+        :param num_errors_per_label: The max number of large errors per class in the errors text
+        """
+        for i, sample in enumerate(self.history):
+            if 'error_ids' not in sample:
+                # Read the errors from the entry itself, a checkpoint HistoryEntry loads them lazily on access
+                errors = sample['errors']
+                sample = {key: value for key, value in sample.items() if key != 'errors'}
+                sample.update(self.errors_reference(errors, num_errors_per_label))
+                self.history[i] = sample
+
+    def add_history(self, prompt: str, task_description: str, num_errors_per_label: int = 0):
         """
         Add the current step information to the history
         :param prompt: The current prompt
         :param task_description: The task description
+        :param num_errors_per_label: The max number of large errors per class in the history errors text
         """
         conf_matrix = None
         large_error_to_str = self.large_error_to_str(self.errors, self.num_errors)
         prompt_input = {'task_description': task_description, 'accuracy': self.mean_score, 'prompt': prompt,
                                          'failure_cases': large_error_to_str}
         if self.score_function_name == 'accuracy':
+            from sklearn.metrics import confusion_matrix
             conf_matrix = confusion_matrix(self.dataset['annotation'],
                                            self.dataset['prediction'], labels=self.label_schema)
             conf_text = f"Confusion matrix columns:{self.label_schema} the matrix data:"
@@ -136,7 +164,8 @@ class Eval:
         analysis = self.analyzer.invoke(prompt_input)
 
         self.history.append({'prompt': prompt, 'score': self.mean_score,
-                             'errors': self.errors, 'confusion_matrix': conf_matrix, 'analysis': analysis['text']})
+                             **self.errors_reference(self.errors, num_errors_per_label),
+                             'confusion_matrix': conf_matrix, 'analysis': analysis['text']})
 
     def extract_errors(self) -> pd.DataFrame:
         """
@@ -1,7 +1,11 @@
-from utils.llm_chain import ChainWrapper
+from utils.llm_chain import ChainWrapper, ConcurrencyLimiter
 from langchain_core.pydantic_v1 import BaseModel, Field
 import pandas as pd
-import pickle
+import concurrent.futures
+import logging
+import time
+
+
 class MetricMetadata(BaseModel):
     metric_score: float = Field(description="The score for the metric")
     metric_reason: str = Field(description="The reason for the metric score")
@@ -22,6 +26,8 @@ class MetricHandler:
         self.config = config
         self.metric_generator = metric_generator
         self.task_description = task_description
+        self.fused_chain = None
+        self.metrics_stats = {}
         self.metrics = self.generate_metrics()
 
     def generate_metrics(self) -> dict:
@@ -33,29 +39,151 @@ class MetricHandler:
         metrics = metrics['metrics_list']
         for metric in metrics:
             prompt = f'{metric["metric_prompt"]}\nThe following input should be evaluated according to the metric guidlines. \n###Evaluated input:\n{{sample}}\n###End'
-            metric['metric_function'] = self.build_score_function(prompt)
+            metric['metric_chain'] = ChainWrapper(self.config.llm, prompt, MetricMetadata)
+            metric['metric_function'] = self.build_score_function(metric['metric_chain'])
         return metrics
 
-    def build_score_function(self, metric_prompt: str):
+    @staticmethod
+    def build_score_function(chain: ChainWrapper):
         """
-        Constructs a scoring function based on the provided configuration.
+        Constructs a scoring function based on the provided metric chain.
 
-        This function initializes a ChainWrapper with the given configuration, prompt file, and MetricMetadata.
-        It then defines a new function that invokes the chain with the input prompt and returns the results.
+        It defines a new function that invokes the chain on each record and returns the results.
 
-        :param metric_prompt: The prompts.
-        :return: A function that takes an input prompt, invokes the chain, and returns the results.
+        :param chain: The metric chain.
+        :return: A function that takes the records, invokes the chain, and returns the results (by the records index).
         """
 
-        chain = ChainWrapper(self.config.llm, metric_prompt, MetricMetadata)
-
-        def new_function(record: pd.DataFrame, num_workers: int = 1):
+        def new_function(record: pd.DataFrame, num_workers: int = 1, limiter: ConcurrencyLimiter = None):
             batch_inputs = []
             # prepare all the inputs for the chains
             for i, row in record.iterrows():
                 batch_inputs.append({'sample': row['text']})
-            all_results = chain.batch_invoke(batch_inputs, num_workers, get_index=True)
-            all_results = {res['index']: res['result'].dict() for res in all_results}
+            all_results = chain.batch_invoke(batch_inputs, num_workers, get_index=True, limiter=limiter)
+            all_results = {record.index[res['index']]: res['result'].dict() for res in all_results}
             return all_results
 
         return new_function
+
+    def build_fused_chain(self) -> ChainWrapper:
+        """
+        Build a judge chain that scores all the metrics of a sample in a single structured-output call
+        """
+        prompt = 'Evaluate the following input according to each one of the metrics below.\n'
+        properties = {}
+        for i, metric in enumerate(self.metrics):
+            metric_prompt = metric['metric_prompt'].replace('{', '{{').replace('}', '}}')
+            prompt += f'###Metric {i}: {metric["metric_name"]}\n{metric_prompt}\n'
+            properties[f'metric_{i}_score'] = {'description': f'The score for the metric: {metric["metric_name"]}',
+                                               'title': f'Metric_{i}_Score', 'type': 'number'}
+            properties[f'metric_{i}_reason'] = {'description': f'The reason for the score of the metric: '
+                                                               f'{metric["metric_name"]}',
+                                                'title': f'Metric_{i}_Reason', 'type': 'string'}
+        prompt += 'The following input should be evaluated according to the metrics guidlines. \n' \
+                  '###Evaluated input:\n{sample}\n###End'
+        json_schema = {'description': 'The scores of all the metrics', 'properties': properties,
+                       'required': list(properties.keys()), 'title': 'Metrics_Scores', 'type': 'object'}
+        return ChainWrapper(self.config.llm, prompt, json_schema)
+
+    def score_sequential(self, records: pd.DataFrame, num_workers: int) -> dict:
+        """
+        Score the records with each one of the metrics, one metric after the other
+        :param records: The records to score
+        :param num_workers: The number of workers
+        :return: A dict with the results of each metric (by the records index)
+        """
+        results = {}
+        for metric in self.metrics:
+            start_time = time.time()
+            results[metric['metric_name']] = metric['metric_function'](records, num_workers)
+            self.metrics_stats[metric['metric_name']]['latency'] = time.time() - start_time
+        return results
+
+    def score_concurrent(self, records: pd.DataFrame, num_workers: int) -> dict:
+        """
+        Score the records with all the metrics concurrently. All the (metric, record) requests share a limiter of
+        num_workers concurrent requests (in async mode if the llm config has async_params). The latency of a metric is
+        the wall-clock time until all its records are scored
+        :param records: The records to score
+        :param num_workers: The number of workers
+        :return: A dict with the results of each metric (by the records index)
+        """
+        limiter = ConcurrencyLimiter(num_workers)
+        start_time = time.time()
+
+        def score_metric(metric):
+            metric_results = metric['metric_function'](records, num_workers, limiter)
+            self.metrics_stats[metric['metric_name']]['latency'] = time.time() - start_time
+            return metric['metric_name'], metric_results
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(self.metrics))) as executor:
+            return dict(executor.map(score_metric, self.metrics))
+
+    def score_fused(self, records: pd.DataFrame, num_workers: int) -> dict:
+        """
+        Score the records with a single judge call per record that scores all the metrics
+        :param records: The records to score
+        :param num_workers: The number of workers
+        :return: A dict with the results of each metric (by the records index)
+        """
+        if self.fused_chain is None:
+            self.fused_chain = self.build_fused_chain()
+        start_time = time.time()
+        batch_inputs = [{'sample': text} for text in records['text']]
+        all_results = self.fused_chain.batch_invoke(batch_inputs, num_workers, get_index=True)
+        latency = time.time() - start_time
+        results = {metric['metric_name']: {} for metric in self.metrics}
+        num_missing = 0
+        for res in all_results:
+            for i, metric in enumerate(self.metrics):
+                score = res['result'].get(f'metric_{i}_score', None)
+                if score is None:
+                    # The judge left out the metric, it is missing from the results (NaN score in the eval)
+                    num_missing += 1
+                    continue
+                results[metric['metric_name']][records.index[res['index']]] = {
+                    'metric_score': score, 'metric_reason': res['result'].get(f'metric_{i}_reason', '')}
+        if num_missing > 0:
+            logging.warning(f'{num_missing} metric scores are missing from the fused judge results')
+        for metric in self.metrics:
+            self.metrics_stats[metric['metric_name']]['latency'] = latency
+        return results
+
+    def score_records(self, records: pd.DataFrame, num_workers: int = 1, mode: str = 'sequential') -> dict:
+        """
+        Score the records with all the metrics
+        :param records: The records to score, with a 'text' column
+        :param num_workers: The number of workers
+        :param mode: The scoring mode, either 'sequential', 'concurrent' or 'fused'
+        :return: A dict with the results of each metric (by the records index)
+        """
+        usage = {metric['metric_name']: metric['metric_chain'].accumulate_usage for metric in self.metrics}
+        fused_usage = 0 if self.fused_chain is None else self.fused_chain.accumulate_usage
+        self.metrics_stats = {metric['metric_name']: {'latency': 0} for metric in self.metrics}
+        if mode == 'sequential':
+            results = self.score_sequential(records, num_workers)
+        elif mode == 'concurrent':
+            results = self.score_concurrent(records, num_workers)
+        elif mode == 'fused':
+            results = self.score_fused(records, num_workers)
+        else:
+            raise NotImplementedError(f'Unknown metrics scoring mode {mode}')
+        for metric in self.metrics:
+            if mode == 'fused':
+                # The fused judge usage can't be split between the metrics
+                metric_usage = self.fused_chain.accumulate_usage - fused_usage
+            else:
+                metric_usage = metric['metric_chain'].accumulate_usage - usage[metric['metric_name']]
+            self.metrics_stats[metric['metric_name']]['usage'] = metric_usage
+        logging.info(f'Metrics scoring ({mode}) stats: {self.metrics_stats}')
+        return results
+
+    def calc_usage(self) -> float:
+        """
+        Calculate the usage of all the metrics chains
+        :return: The total usage value
+        """
+        usage = sum(metric['metric_chain'].accumulate_usage for metric in self.metrics)
+        if self.fused_chain is not None:
+            usage += self.fused_chain.accumulate_usage
+        return usage
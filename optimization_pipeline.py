@@ -3,13 +3,17 @@ from metric_generator.metric_gen import MetricHandler
 from eval.evaluator import Eval
 from dataset.base_dataset import DatasetBase
 from utils.llm_chain import MetaChain
+from utils.rate_limiter import get_rate_limiters_stats
+from utils.step_scheduler import StepScheduler
+from utils.checkpoint import Checkpoint
 from estimator import give_estimator
 from pathlib import Path
 import pickle
 import os
+import concurrent.futures
 import json
 import logging
-import wandb
+import time
 
 
 class OptimizationPipeline:
@@ -31,6 +35,7 @@ class OptimizationPipeline:
         """
 
         if config.use_wandb:  # In case of using W&B
+            import wandb  # wandb is imported only if it is used
             wandb.login()
             self.wandb_run = wandb.init(
                 project="AutoGPT",
@@ -62,7 +67,33 @@ class OptimizationPipeline:
         error_analysis = self.meta_chain.chain.get('error_analysis', None)
         self.eval = Eval(config.eval, error_analysis, self.metric_handler, self.dataset.label_schema)
         self.batch_id = 0
+        self.checkpoint = None
         self.patient = 0
+        self.step_executor = None
+        self.stage_timings = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_step_executor(self) -> concurrent.futures.ThreadPoolExecutor:
+        """
+        Return the worker pool of the step stages, it is created on the first use (and after close)
+        """
+        if self.step_executor is None:
+            self.step_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.config.get('num_step_workers', 4))
+        return self.step_executor
+
+    def close(self):
+        """
+        Shut down the worker pool of the step stages
+        """
+        if self.step_executor is not None:
+            self.step_executor.shutdown()
+            self.step_executor = None
 
     @staticmethod
     def log_and_print(message):
@@ -87,6 +118,8 @@ class OptimizationPipeline:
         total_usage += self.meta_chain.calc_usage()
         total_usage += self.annotator.calc_usage()
         total_usage += self.predictor.calc_usage()
+        if self.metric_handler is not None:
+            total_usage += self.metric_handler.calc_usage()
         return total_usage
 
     def extract_best_prompt(self):
@@ -96,6 +129,45 @@ class OptimizationPipeline:
             reverse=False)
         return {'prompt': sorted_history[-1]['prompt'], 'score': sorted_history[-1]['score']}
 
+    def get_samples_context(self, last_history: list) -> list[dict]:
+        """
+        Prepare the history and the extra samples for each of the samples generation batches
+        :param last_history: The history used in the meta-prompt
+        :return: A list with the history and the extra samples of each batch
+        """
+        num_batches = len(self.generate_samples_batch({}, self.config.meta_prompts.num_generated_samples,
+                                                      self.config.meta_prompts.samples_generation_batch))
+        if sum([len(t['error_ids']) for t in last_history]) > 0:
+            history_samples = '\n'.join([self.eval.sample_to_text(sample,
+                                                                  num_errors_per_label=self.config.meta_prompts.num_err_samples,
+                                                                  is_score=False) for sample in last_history])
+        else:
+            history_samples = 'No previous errors information'
+        samples_context = []
+        for _ in range(num_batches):
+            extra_samples = self.dataset.sample_records()
+            samples_context.append({'history': history_samples,
+                                    'extra_samples': DatasetBase.samples_to_text(extra_samples)})
+        return samples_context
+
+    def generate_step_samples(self, prompt_suggestion: dict, samples_context: list[dict]) -> list[str]:
+        """
+        Generate a set of challenging samples for the suggested prompt
+        :param prompt_suggestion: The suggested prompt
+        :param samples_context: The history and the extra samples of each batch
+        :return: The list of the new samples
+        """
+        batch_input = {"num_samples": self.config.meta_prompts.samples_generation_batch,
+                       "task_description": self.task_description,
+                       "prompt": prompt_suggestion['prompt']}
+        batch_inputs = self.generate_samples_batch(batch_input, self.config.meta_prompts.num_generated_samples,
+                                                   self.config.meta_prompts.samples_generation_batch)
+        for batch, context in zip(batch_inputs, samples_context):
+            batch.update(context)
+        samples_batches = self.meta_chain.chain.step_samples.batch_invoke(batch_inputs,
+                                                                          self.config.meta_prompts.num_workers)
+        return [element for sublist in samples_batches for element in sublist['samples']]
+
     def run_step_prompt(self):
         """
         Run the meta-prompts and get new prompt suggestion, estimated prompt score and a set of challenging samples
@@ -115,37 +187,23 @@ class OptimizationPipeline:
                         'error_analysis': last_history[-1]['analysis']}
         if 'label_schema' in self.config.dataset.keys():
             prompt_input["labels"] = json.dumps(self.config.dataset.label_schema)
-        prompt_suggestion = self.meta_chain.chain.step_prompt_chain.invoke(prompt_input)
+
+        # The samples context (semantic sampling of extra samples) is prepared while waiting for the new prompt
+        scheduler = StepScheduler(self.get_step_executor())
+        scheduler.add_stage('step_prompt', lambda: self.meta_chain.chain.step_prompt.invoke(prompt_input))
+        generate_samples = len(self.dataset) < self.config.dataset.max_samples
+        if generate_samples:
+            scheduler.add_stage('samples_context', lambda: self.get_samples_context(last_history))
+            scheduler.add_stage('step_samples', self.generate_step_samples, ['step_prompt', 'samples_context'])
+        results = scheduler.run()
+        self.stage_timings.update(scheduler.timings)
+
+        prompt_suggestion = results['step_prompt']
         self.log_and_print(f'Previous prompt score:\n{self.eval.mean_score}\n#########\n')
         self.log_and_print(f'Get new prompt:\n{prompt_suggestion["prompt"]}')
         self.batch_id += 1
-        if len(self.dataset) < self.config.dataset.max_samples:
-            batch_input = {"num_samples": self.config.meta_prompts.samples_generation_batch,
-                           "task_description": self.task_description,
-                           "prompt": prompt_suggestion['prompt']}
-            batch_inputs = self.generate_samples_batch(batch_input, self.config.meta_prompts.num_generated_samples,
-                                                       self.config.meta_prompts.samples_generation_batch)
-
-            if sum([len(t['errors']) for t in last_history]) > 0:
-                history_samples = '\n'.join([self.eval.sample_to_text(sample,
-                                                                      num_errors_per_label=self.config.meta_prompts.num_err_samples,
-                                                                      is_score=False) for sample in last_history])
-                for batch in batch_inputs:
-                    extra_samples = self.dataset.sample_records()
-                    extra_samples_text = DatasetBase.samples_to_text(extra_samples)
-                    batch['history'] = history_samples
-                    batch['extra_samples'] = extra_samples_text
-            else:
-                for batch in batch_inputs:
-                    extra_samples = self.dataset.sample_records()
-                    extra_samples_text = DatasetBase.samples_to_text(extra_samples)
-                    batch['history'] = 'No previous errors information'
-                    batch['extra_samples'] = extra_samples_text
-
-            samples_batches = self.meta_chain.chain.step_samples.batch_invoke(batch_inputs,
-                                                                        self.config.meta_prompts.num_workers)
-            new_samples = [element for sublist in samples_batches for element in sublist['samples']]
-            new_samples = self.dataset.remove_duplicates(new_samples)
+        if generate_samples:
+            new_samples = self.dataset.remove_duplicates(results['step_samples'])
             self.dataset.add(new_samples, self.batch_id)
             logging.info('Get new samples')
         self.cur_prompt = prompt_suggestion['prompt']
@@ -205,78 +263,135 @@ class OptimizationPipeline:
         if self.output_path is None:
             return
         logging.info('Save state')
-        self.dataset.save_dataset(self.output_path / 'dataset.csv')
-        state = {'history': self.eval.history, 'batch_id': self.batch_id,
-                 'prompt': self.cur_prompt, 'task_description': self.task_description,
+        state = {'batch_id': self.batch_id, 'prompt': self.cur_prompt, 'task_description': self.task_description,
                  'patient': self.patient}
-        pickle.dump(state, open(self.output_path / 'history.pkl', 'wb'))
+        if self.config.get('checkpoint_format', 'arrow') == 'arrow':
+            if self.checkpoint is None:
+                self.checkpoint = Checkpoint(self.output_path)
+            self.checkpoint.save(self.dataset, self.eval.history, state)
+        else:
+            self.dataset.save_dataset(self.output_path / 'dataset.csv')
+            state['history'] = self.eval.history
+            pickle.dump(state, open(self.output_path / 'history.pkl', 'wb'))
+        if getattr(self.predictor, 'cache', None) is not None:
+            self.predictor.cache.save(self.output_path / 'prediction_cache.pkl')
+        self.dataset.dedup.save_embeddings(self.output_path)
 
     def load_state(self, path: str):
         """
         Load pretrain state
         """
         path = Path(path)
-        if (path / 'dataset.csv').is_file():
-            self.dataset.load_dataset(path / 'dataset.csv')
-        if (path / 'history.pkl').is_file():
-            state = pickle.load(open(path / 'history.pkl', 'rb'))
-            self.eval.history = state['history']
+        # The embeddings are loaded first, so the dataset index is rebuilt without encoding the records again
+        if self.config.dataset.get('semantic_sampling', False) or self.config.dataset.get('dedup_new_samples', False):
+            self.dataset.dedup.load_embeddings(path)
+        state = None
+        if Checkpoint.is_checkpoint(path):
+            checkpoint = Checkpoint(path)
+            self.dataset.records = checkpoint.load_dataset()
+            self.dataset.rebuild_index()
+            self.eval.history = checkpoint.load_history()
+            state = checkpoint.manifest['state']
+        else:
+            # Legacy dump (dataset.csv and history.pkl)
+            if (path / 'dataset.csv').is_file():
+                self.dataset.load_dataset(path / 'dataset.csv')
+            if (path / 'history.pkl').is_file():
+                state = pickle.load(open(path / 'history.pkl', 'rb'))
+                self.eval.history = state['history']
+        self.eval.compact_history(self.config.meta_prompts.num_err_samples)
+        if state is not None:
             self.batch_id = state['batch_id']
             self.cur_prompt = state['prompt']
             self.task_description = state['task_description']
             self.patient = state['patient']
+        if getattr(self.predictor, 'cache', None) is not None:
+            self.predictor.cache.load(path / 'prediction_cache.pkl')
+
+    def update_and_eval(self, annotator_records: pd.DataFrame, predictor_records: pd.DataFrame) -> pd.DataFrame:
+        """
+        Update the dataset with the annotations and the predictions, and calculate the score
+        :param annotator_records: The annotator results
+        :param predictor_records: The predictor results
+        :return: The large errors
+        """
+        self.dataset.update(annotator_records)
+        # The predictor records were read before the annotator was done, only their predictions are up to date
+        self.dataset.update(predictor_records.filter(['id', 'prediction']))
+        self.eval.dataset = self.dataset.get_leq(self.batch_id)
+        self.eval.eval_score()
+        logging.info('Calculating Score')
+        logging.info(f'Rate limiters state: {get_rate_limiters_stats()}')
+        return self.eval.extract_errors()
+
+    def log_results(self, large_errors: pd.DataFrame):
+        """
+        Log the step results to W&B
+        :param large_errors: The large errors
+        """
+        large_errors = large_errors.sample(n=min(6, len(large_errors)))
+        correct_samples = self.eval.extract_correct()
+        correct_samples = correct_samples.sample(n=min(6, len(correct_samples)))
+        vis_data = pd.concat([large_errors, correct_samples])
+        import wandb
+        self.wandb_run.log({"score": self.eval.mean_score,
+                            "prediction_result": wandb.Table(dataframe=vis_data),
+                            'Total usage': self.calc_usage()}, step=self.batch_id)
 
     def step(self, current_iter, total_iter):
         """
         This is the main optimization process step.
         """
         self.log_and_print(f'Starting step {self.batch_id}')
-        if len(self.dataset.records) == 0:
+        if len(self.dataset) == 0:
             self.log_and_print('Dataset is empty generating initial samples')
             self.generate_initial_samples()
         if self.config.use_wandb:
             cur_batch = self.dataset.get_leq(self.batch_id)
             random_subset = cur_batch.sample(n=min(10, len(cur_batch)))[['text']]
+            import wandb
             self.wandb_run.log(
                 {"Prompt": wandb.Html(f"<p>{self.cur_prompt}</p>"), "Samples": wandb.Table(dataframe=random_subset)},
                 step=self.batch_id)
 
-        logging.info('Running annotator')
-        records = self.annotator.apply(self.dataset, self.batch_id)
-        self.dataset.update(records)
-
         self.predictor.cur_instruct = self.cur_prompt
-        logging.info('Running Predictor')
-        records = self.predictor.apply(self.dataset, self.batch_id, leq=True)
-        self.dataset.update(records)
-
-        self.eval.dataset = self.dataset.get_leq(self.batch_id)
-        self.eval.eval_score()
-        logging.info('Calculating Score')
-        large_errors = self.eval.extract_errors()
-        self.eval.add_history(self.cur_prompt, self.task_description)
+        self.stage_timings = {}
+        # The annotator and the predictor are independent, as well as the error analysis and the results logging.
+        # The predictor doesn't wait for the annotations, so it also predicts the records that the annotator discards
+        # in this step (they are ignored by the evaluation), at the cost of a few extra predictions
+        scheduler = StepScheduler(self.get_step_executor())
+        scheduler.add_stage('annotator', lambda: self.annotator.apply(self.dataset, self.batch_id))
+        scheduler.add_stage('predictor', lambda: self.predictor.apply(self.dataset, self.batch_id, leq=True))
+        scheduler.add_stage('eval_score', self.update_and_eval, ['annotator', 'predictor'])
+        scheduler.add_stage('add_history',
+                            lambda _: self.eval.add_history(self.cur_prompt, self.task_description,
+                                                            self.config.meta_prompts.num_err_samples),
+                            ['eval_score'])
         if self.config.use_wandb:
-            large_errors = large_errors.sample(n=min(6, len(large_errors)))
-            correct_samples = self.eval.extract_correct()
-            correct_samples = correct_samples.sample(n=min(6, len(correct_samples)))
-            vis_data = pd.concat([large_errors, correct_samples])
-            self.wandb_run.log({"score": self.eval.history[-1]['score'],
-                                "prediction_result": wandb.Table(dataframe=vis_data),
-                                'Total usage': self.calc_usage()}, step=self.batch_id)
+            scheduler.add_stage('log_results', self.log_results, ['eval_score'])
+        scheduler.run()
+        self.stage_timings.update(scheduler.timings)
         if self.stop_criteria():
             self.log_and_print('Stop criteria reached')
             return True
         if current_iter != total_iter - 1:
+            start_time = time.time()
             self.run_step_prompt()
+            self.stage_timings['run_step_prompt'] = time.time() - start_time
+        start_time = time.time()
         self.save_state()
+        self.stage_timings['save_state'] = time.time() - start_time
         return False
 
     def run_pipeline(self, num_steps: int):
         # Run the optimization pipeline for num_steps
         num_steps_remaining = num_steps - self.batch_id
-        for i in range(num_steps_remaining):
-            stop_criteria = self.step(i, num_steps_remaining)
-            if stop_criteria:
-                break
+        try:
+            for i in range(num_steps_remaining):
+                stop_criteria = self.step(i, num_steps_remaining)
+                if stop_criteria:
+                    break
+        finally:
+            self.close()
         final_result = self.extract_best_prompt()
         return final_result
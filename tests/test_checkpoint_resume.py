@@ -0,0 +1,46 @@
+import contextlib
+import io
+
+from optimization_pipeline import OptimizationPipeline
+from utils.checkpoint import Checkpoint
+from utils.config import override_config
+
+
+def build_pipeline(output_path=''):
+    config = override_config('config/config_diff/config_offline.yml')
+    config.predictor.config.use_cache = False
+    config.stop_criteria.max_usage = 0
+    return OptimizationPipeline(config, 'Test task', 'Test prompt', output_path=output_path)
+
+
+def test_resume_checkpoint_with_history(tmp_path):
+    pipeline = build_pipeline(str(tmp_path / 'run'))
+    pipeline.dataset.add([f'sample {i}' for i in range(20)], 0)
+    with contextlib.redirect_stdout(io.StringIO()):
+        pipeline.step(0, 2)
+    pipeline.close()
+    assert len(pipeline.eval.history) == 1
+
+    resumed = build_pipeline()
+    resumed.load_state(tmp_path / 'run')
+    assert len(resumed.eval.history) == 1
+    assert 'error_ids' in resumed.eval.history[0]
+    assert len(resumed.dataset) == len(pipeline.dataset)
+
+
+def test_resume_checkpoint_with_errors_records(tmp_path):
+    # A checkpoint whose history keeps the errors records (written before the history kept errors references)
+    pipeline = build_pipeline()
+    pipeline.dataset.add([f'sample {i}' for i in range(5)], 0)
+    errors = pipeline.dataset.get_leq(0).iloc[:2].assign(prediction='Yes', annotation='No', score=0.)
+    history = [{'prompt': 'Test prompt', 'score': 0.5, 'errors': errors, 'confusion_matrix': None,
+                'analysis': 'Test analysis'}]
+    Checkpoint(tmp_path).save(pipeline.dataset, history, {'batch_id': 1, 'prompt': 'Test prompt',
+                                                          'task_description': 'Test task', 'patient': 0})
+
+    resumed = build_pipeline()
+    resumed.load_state(tmp_path)
+    entry = resumed.eval.history[0]
+    assert 'errors' not in entry
+    assert entry['error_ids'] == errors['id'].tolist()
+    assert 'Test prompt' in resumed.eval.sample_to_text(entry, is_score=False)
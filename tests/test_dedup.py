@@ -0,0 +1,13 @@
+import faiss
+import numpy as np
+
+from utils.dedup import Dedup
+
+
+def test_cluster_data_merges_pairs_at_the_threshold():
+    dedup = Dedup({'dedup_threshold': 1.0})
+    # The squared L2 distance of the first two records is exactly the threshold
+    dedup.xb = np.array([[0, 0], [1, 0], [5, 0]], dtype=np.float32)
+    dedup.index = faiss.IndexFlatL2(2)
+    dedup.index.add(dedup.xb)
+    assert dedup.cluster_data(None) == [{0, 1}, {2}]
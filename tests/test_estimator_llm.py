@@ -0,0 +1,41 @@
+import re
+
+import pandas as pd
+from easydict import EasyDict as edict
+
+from estimator.estimator_llm import LLMEstimator
+
+
+class MiniBatchChain:
+    """
+    A chain that fails the requests of the failed ids, and leaves the skipped ids out of the results (once)
+    """
+
+    def __init__(self, failed_ids: set[int], skipped_ids: set[int]):
+        self.failed_ids = failed_ids
+        self.skipped_ids = set(skipped_ids)
+        self.requests = []
+
+    def batch_invoke(self, inputs, num_workers, get_index=False, limiter=None, refresh_cache=False):
+        results = []
+        for i, chain_input in enumerate(inputs):
+            ids = [int(sample_id) for sample_id in re.findall(r'ID: (\d+);', chain_input['samples'])]
+            self.requests.append(ids)
+            if self.failed_ids.intersection(ids):
+                continue
+            predictions = [{'id': sample_id, 'prediction': 'Yes'} for sample_id in ids
+                           if sample_id not in self.skipped_ids]
+            self.skipped_ids.difference_update(ids)
+            results.append({'index': i, 'result': {'results': predictions}})
+        return results
+
+
+def test_failed_requests_are_not_sent_again():
+    estimator = LLMEstimator(edict({'llm': {'name': 'test'}, 'mini_batch_size': 2, 'mode': 'prediction',
+                                    'num_workers': 1, 'max_parse_retries': 2}))
+    estimator.chain = MiniBatchChain(failed_ids={0}, skipped_ids={3})
+    records = estimator.apply_dataframe(pd.DataFrame({'text': [f'sample {i}' for i in range(4)]}))
+
+    assert records['prediction'].tolist() == ['Discarded', 'Discarded', 'Yes', 'Yes']
+    # The mini-batch of the failed request is sent once, the skipped sample is sent again
+    assert estimator.chain.requests == [[0, 1], [2, 3], [3]]
@@ -0,0 +1,13 @@
+import pytest
+
+from benchmarks.bench_import_time import ENTRY_MODULES, TARGET_MS, measure
+
+
+@pytest.mark.parametrize('module', ENTRY_MODULES)
+def test_entry_point_import_time(module):
+    # Each module is imported in a fresh interpreter with -X importtime, the fastest of the repeats is used
+    result = measure(module, repeats=3, top=10)
+    assert result['eager_backends'] == [], f'Optional backends imported eagerly by {module}'
+    assert result['total_ms'] <= TARGET_MS, \
+        f"{module} import took {result['total_ms']:.0f}ms (target {TARGET_MS}ms), slowest imports: " \
+        f"{[item['name'] for item in result['slowest_imports']]}"
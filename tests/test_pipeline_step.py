@@ -0,0 +1,20 @@
+from optimization_pipeline import OptimizationPipeline
+from utils.config import override_config
+
+
+def test_predictor_update_keeps_the_new_annotations():
+    config = override_config('config/config_diff/config_offline.yml')
+    pipeline = OptimizationPipeline(config, 'Test task', 'Test prompt')
+    pipeline.dataset.add(['first sample', 'second sample'], 0)
+    old_records = pipeline.dataset.get_leq(0).assign(annotation='No', score=0.)
+    pipeline.dataset.update(old_records)
+
+    # The predictor records are read before the annotator is done (the two stages run concurrently)
+    predictor_records = pipeline.dataset.get_leq(0).assign(prediction='Yes')
+    annotator_records = pipeline.dataset[0].assign(annotation='Yes')
+    pipeline.update_and_eval(annotator_records, predictor_records)
+    pipeline.close()
+
+    records = pipeline.dataset.records
+    assert records['annotation'].tolist() == ['Yes', 'Yes']
+    assert records['prediction'].tolist() == ['Yes', 'Yes']
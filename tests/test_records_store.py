@@ -0,0 +1,32 @@
+import numpy as np
+import pandas as pd
+
+from dataset.records_store import RecordsStore
+
+
+def test_append_after_compact_has_no_stale_values():
+    store = RecordsStore()
+    store.append(pd.DataFrame({'id': [0, 1, 2, 3], 'text': ['a', 'b', 'c', 'd'], 'prediction': ['Yes'] * 4,
+                               'annotation': ['Discarded', 'Discarded', 'Discarded', 'No'], 'batch_id': [0] * 4}))
+    # Removing most of the rows compacts the store
+    store.remove(store.get_rows([0, 1, 2]))
+    assert store.size == 1
+
+    store.append(pd.DataFrame({'id': [4, 5], 'text': ['e', 'f']}))
+    records = store.to_frame()
+    assert records['id'].tolist() == [3, 4, 5]
+    assert records['text'].tolist() == ['d', 'e', 'f']
+    assert records['prediction'].isna().tolist() == [False, True, True]
+    assert records['annotation'].isna().tolist() == [False, True, True]
+    assert records['batch_id'].tolist() == [0, 0, 0]
+    assert store.get_rows([3, 4, 5]).tolist() == [0, 1, 2]
+
+
+def test_compact_resets_the_freed_rows():
+    store = RecordsStore()
+    store.append(pd.DataFrame({'id': [0, 1, 2], 'text': ['a', 'b', 'c'], 'batch_id': [0, 0, 1]}))
+    store.remove(store.get_rows([0, 1]))
+    assert store.data['id'][1:3].tolist() == [0, 0]
+    assert all(pd.isna(value) for value in store.data['text'][1:3])
+    assert store.column('text').tolist() == ['c']
+    assert np.array_equal(store.batch_rows(1), [0])
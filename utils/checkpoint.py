@@ -0,0 +1,307 @@
+import json
+import logging
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+def write_arrow(df: pd.DataFrame, path: Path):
+    """
+    Write a dataframe to an Arrow IPC file (atomically, the current file may be memory-mapped)
+    :param df: The dataframe
+    :param path: The file path
+    """
+    import pyarrow as pa
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # Columns with mixed types (e.g. numbers and 'Discarded') are saved as strings
+        df = df.copy()
+        for column in df.columns[df.dtypes == object]:
+            df[column] = df[column].map(lambda value: value if pd.isna(value) else str(value))
+        table = pa.Table.from_pandas(df, preserve_index=False)
+    tmp_path = path.with_suffix('.tmp')
+    with pa.OSFile(str(tmp_path), 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, path)
+
+
+def read_arrow(path: Path) -> pd.DataFrame:
+    """
+    Read (memory-mapped) an Arrow IPC file to a dataframe
+    :param path: The file path
+    """
+    import pyarrow as pa
+    with pa.memory_map(str(path), 'r') as source:
+        df = pa.ipc.open_file(source).read_all().to_pandas()
+    # Missing strings are read as None, the dataset uses NaN
+    for column in df.columns[df.dtypes == object]:
+        df[column] = df[column].where(df[column].notna(), np.nan)
+    return df
+
+
+def to_json_value(value):
+    """
+    Convert numpy values (scores, confusion matrix) to json values
+    """
+    if isinstance(value, dict):
+        return {key: to_json_value(val) for key, val in value.items()}
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+class PartitionLog:
+    """
+    An append-only log of Arrow partitions of records, keyed by the record id. On each save only the records that
+    changed (or were removed) since the previous save are appended as a new partition. The log is compacted to a
+    single partition when it has too many partitions, or when there is no previous save in this process
+    """
+
+    removed_column = '_removed'
+
+    def __init__(self, path: Path, prefix: str, files: list[str] = None, max_partitions: int = 32):
+        """
+        Initialize a new instance of the PartitionLog class.
+        :param path: The checkpoint directory
+        :param prefix: The partitions files prefix, relative to the checkpoint directory
+        :param files: The partitions of the log in the checkpoint
+        :param max_partitions: The maximal number of partitions before the log is compacted
+        """
+        self.path = Path(path)
+        self.prefix = prefix
+        self.files = list(files or [])
+        self.max_partitions = max_partitions
+        self.snapshot = None
+        self.obsolete_files = []
+
+    @staticmethod
+    def as_files(files) -> list[str]:
+        """
+        Return the partitions list of a manifest entry (a single file name or None in checkpoints of version 1)
+        """
+        if files is None:
+            return []
+        return [files] if isinstance(files, str) else list(files)
+
+    def next_file(self) -> str:
+        numbers = [int(stem.rsplit('_', 1)[-1]) for stem in (Path(file_name).stem for file_name in self.files)
+                   if stem.rsplit('_', 1)[-1].isdigit()]
+        number = max(numbers) + 1 if len(numbers) > 0 else 0
+        return f'{self.prefix}_{number:05d}.arrow'
+
+    def changes(self, records: pd.DataFrame) -> pd.DataFrame:
+        """
+        Return the records that changed since the last save, and the removed records (only their id is set)
+        :param records: The records, indexed by id
+        """
+        previous = self.snapshot.reindex(index=records.index, columns=records.columns)
+        same = ((records == previous) | (records.isna() & previous.isna())).all(axis=1)
+        changed = records[~same | ~records.index.isin(self.snapshot.index)].assign(**{self.removed_column: False})
+        removed_ids = self.snapshot.index.difference(records.index)
+        removed = pd.DataFrame({self.removed_column: True}, index=removed_ids)
+        return pd.concat([changed, removed]) if len(removed) > 0 else changed
+
+    def save(self, records: pd.DataFrame) -> list[str]:
+        """
+        Append the changes of the records to the log
+        :param records: The records, must contain an 'id' column
+        :return: The partitions of the log
+        """
+        records = records.set_index('id')
+        if self.snapshot is None or len(self.files) >= self.max_partitions:
+            delta = records.assign(**{self.removed_column: False})
+            self.obsolete_files.extend(self.files)
+            file_name, self.files = self.next_file(), []
+        else:
+            delta = self.changes(records)
+            file_name = self.next_file()
+        if self.snapshot is None or len(delta) > 0:
+            write_arrow(delta.rename_axis('id').reset_index(), self.path / file_name)
+            self.files.append(file_name)
+        self.snapshot = records.copy()
+        return self.files
+
+    def remove_obsolete_files(self):
+        """
+        Remove the partitions that were replaced by a compaction, should be called after the manifest is saved
+        """
+        for file_name in self.obsolete_files:
+            if file_name not in self.files and (self.path / file_name).is_file():
+                os.remove(self.path / file_name)
+        self.obsolete_files = []
+
+    @classmethod
+    def read(cls, path: Path, files) -> pd.DataFrame:
+        """
+        Read the records of a log, the last version of each record
+        :param path: The checkpoint directory
+        :param files: The partitions of the log (a single file name in checkpoints of version 1)
+        :return: The records, or None if the log is empty
+        """
+        files = cls.as_files(files)
+        if len(files) == 0:
+            return None
+        records = pd.concat([read_arrow(Path(path) / file_name) for file_name in files], ignore_index=True)
+        records = records.drop_duplicates(subset='id', keep='last')
+        if cls.removed_column in records.columns:
+            records = records[~records[cls.removed_column].fillna(False).astype(bool)]
+            records = records.drop(columns=cls.removed_column)
+        return records.reset_index(drop=True).infer_objects()
+
+
+class HistoryEntry(dict):
+    """
+    A history entry loaded from a checkpoint, the errors are read from their partition on the first access
+    """
+
+    def __init__(self, entry: dict, errors_path: Path = None):
+        super().__init__(entry)
+        self.errors_path = errors_path
+
+    def __missing__(self, key):
+        if key != 'errors' or self.errors_path is None:
+            raise KeyError(key)
+        self['errors'] = read_arrow(self.errors_path)
+        return self['errors']
+
+
+class Checkpoint:
+    """
+    An incremental checkpoint of the optimization process. The dataset is partitioned by batch: a batch partition
+    (the immutable columns: text, annotation, metadata) is written once the batch is done. The current batch and the
+    columns that change every step (the prediction and the score) are kept in partition logs, so only the records
+    that changed since the previous save are written. Each history entry is appended once (errors records, if the
+    entry has them, in their own partition). A small JSON manifest (manifest.json) lists the partitions, the history
+    and the process state.
+    """
+
+    immutable_columns = ['id', 'text', 'annotation', 'metadata', 'batch_id']
+    version = 2
+
+    def __init__(self, path: Path):
+        """
+        Initialize a new instance of the Checkpoint class.
+        :param path: The checkpoint directory
+        """
+        self.path = Path(path)
+        self.manifest = {'version': self.version,
+                         'dataset': {'batches': {}, 'pending': [], 'pending_batch': None, 'state': []},
+                         'history': [], 'state': {}}
+        if self.is_checkpoint(self.path):
+            self.manifest = json.load(open(self.path / 'manifest.json', 'r'))
+        self.pending_log = None
+        self.state_log = None
+
+    @staticmethod
+    def is_checkpoint(path: Path) -> bool:
+        return (Path(path) / 'manifest.json').is_file()
+
+    def save_manifest(self):
+        json.dump(self.manifest, open(self.path / 'manifest_tmp.json', 'w'), indent=2)
+        os.replace(self.path / 'manifest_tmp.json', self.path / 'manifest.json')
+
+    def save_dataset(self, dataset, batch_id: int):
+        """
+        Save the dataset records. The batches before batch_id are done, each one of them is written once
+        :param dataset: The dataset (DatasetBase)
+        :param batch_id: The current batch id
+        """
+        os.makedirs(self.path / 'dataset', exist_ok=True)
+        dataset_manifest = self.manifest['dataset']
+        batches = dataset_manifest['batches']
+        for cur_batch in range(batch_id):
+            if str(cur_batch) in batches:
+                continue
+            file_name = f'dataset/batch_{cur_batch:05d}.arrow'
+            write_arrow(dataset[cur_batch][self.immutable_columns], self.path / file_name)
+            batches[str(cur_batch)] = file_name
+        # The current batch may still change (e.g. if the process is stopped before the batch is annotated)
+        if self.pending_log is None or dataset_manifest.get('pending_batch') != batch_id:
+            if self.pending_log is not None:
+                pending_files = self.pending_log.files
+            else:
+                pending_files = PartitionLog.as_files(dataset_manifest['pending'])
+            same_batch = dataset_manifest.get('pending_batch') == batch_id
+            self.pending_log = PartitionLog(self.path, f'dataset/pending_{batch_id:05d}',
+                                            pending_files if same_batch else [])
+            if not same_batch:
+                self.pending_log.obsolete_files.extend(pending_files)
+        dataset_manifest['pending'] = self.pending_log.save(dataset[batch_id][self.immutable_columns])
+        dataset_manifest['pending_batch'] = batch_id
+        if self.state_log is None:
+            self.state_log = PartitionLog(self.path, 'dataset/state', PartitionLog.as_files(dataset_manifest['state']))
+        records = dataset.records
+        mutable_columns = ['id'] + [column for column in records.columns if column not in self.immutable_columns]
+        dataset_manifest['state'] = self.state_log.save(records[mutable_columns])
+
+    def load_dataset(self) -> pd.DataFrame:
+        """
+        Load the dataset records
+        :return: The records
+        """
+        dataset_manifest = self.manifest['dataset']
+        files = [dataset_manifest['batches'][key] for key in sorted(dataset_manifest['batches'], key=int)]
+        partitions = [read_arrow(self.path / file_name) for file_name in files]
+        pending = PartitionLog.read(self.path, dataset_manifest['pending'])
+        if pending is not None:
+            partitions.append(pending)
+        records = pd.concat(partitions, ignore_index=True).drop_duplicates(subset='id', keep='first')
+        # Only the records in the state log are kept (the removed records are not there)
+        state = PartitionLog.read(self.path, dataset_manifest['state'])
+        records = records.merge(state, on='id', how='inner')
+        columns = ['id', 'text', 'prediction', 'annotation', 'metadata', 'score', 'batch_id']
+        return records[columns + [column for column in records.columns if column not in columns]]
+
+    def save_history(self, history: list):
+        """
+        Append the history entries that are not in the checkpoint
+        :param history: The history (Eval.history)
+        """
+        os.makedirs(self.path / 'history', exist_ok=True)
+        for step in range(len(self.manifest['history']), len(history)):
+            entry = {key: to_json_value(value) for key, value in history[step].items() if key != 'errors'}
+            try:
+                errors = history[step]['errors']
+            except KeyError:
+                errors = None
+            if isinstance(errors, pd.DataFrame):
+                entry['errors_file'] = f'history/step_{step:05d}.arrow'
+                write_arrow(errors, self.path / entry['errors_file'])
+            self.manifest['history'].append(entry)
+
+    def load_history(self) -> list:
+        """
+        Load the history, the errors are loaded lazily
+        :return: The history
+        """
+        history = []
+        for entry in self.manifest['history']:
+            entry = dict(entry)
+            errors_file = entry.pop('errors_file', None)
+            if entry.get('confusion_matrix') is not None:
+                entry['confusion_matrix'] = np.array(entry['confusion_matrix'])
+            history.append(HistoryEntry(entry, None if errors_file is None else self.path / errors_file))
+        return history
+
+    def save(self, dataset, history: list, state: dict):
+        """
+        Save the checkpoint
+        :param dataset: The dataset (DatasetBase)
+        :param history: The history (Eval.history)
+        :param state: The process state (json serializable)
+        """
+        self.save_dataset(dataset, state['batch_id'])
+        self.save_history(history)
+        self.manifest['state'] = state
+        self.manifest['version'] = self.version
+        self.save_manifest()
+        for log in [self.pending_log, self.state_log]:
+            log.remove_obsolete_files()
+        logging.info(f'Checkpoint saved: {len(self.manifest["dataset"]["batches"])} dataset partitions, '
+                     f'{len(self.manifest["history"])} history entries')
@@ -3,14 +3,24 @@ import os.path
 import yaml
 from easydict import EasyDict as edict
 from langchain.prompts import PromptTemplate
-from langchain_openai import ChatOpenAI
 from pathlib import Path
-from langchain.llms.huggingface_pipeline import HuggingFacePipeline
-from langchain_community.chat_models import AzureChatOpenAI
-from langchain.chains import LLMChain
+import asyncio
+import atexit
+import functools
+import hashlib
+import httpx
+import json
 import logging
+import threading
 
-LLM_ENV = yaml.safe_load(open('config/llm_env.yml', 'r'))
+
+@functools.lru_cache(maxsize=None)
+def get_llm_env() -> dict:
+    """
+    Load the LLM providers credentials (config/llm_env.yml), the file is read only once, on the first LLM client
+    """
+    with open('config/llm_env.yml', 'r') as f:
+        return yaml.safe_load(f)
 
 
 class Color:
@@ -21,12 +31,81 @@ class Color:
     END = '\033[0m'  # Reset to default color
 
 
+# The LLM clients registry, the clients (and their connection pools) are shared by all the chains of the process
+llm_clients = {}
+http_clients = {}
+llm_clients_lock = threading.Lock()
+# Config sections that are used by the chains and don't change the client
+NON_CLIENT_KEYS = ['async_params', 'retry', 'rate_limit', 'cache', 'pool', 'record_trace']
+
+
+def get_http_clients(provider: str, endpoint: str, api_key: str, pool_config: dict) -> tuple:
+    """
+    Return the (sync, async) HTTP clients of the given provider endpoint and credentials, each one has a single
+    connection pool that is shared by all the LLM clients of this endpoint
+    :param provider: The LLM provider
+    :param endpoint: The API endpoint
+    :param api_key: The API key
+    :param pool_config: The connection pool config (max_connections, max_keepalive_connections, timeout)
+    :return: The sync and async HTTP clients
+    """
+    key_hash = hashlib.sha1(str(api_key).encode('utf-8')).hexdigest()
+    key = (provider, endpoint, key_hash, json.dumps(pool_config, sort_keys=True))
+    if key not in http_clients:
+        limits = httpx.Limits(max_connections=pool_config.get('max_connections', 100),
+                              max_keepalive_connections=pool_config.get('max_keepalive_connections', 20))
+        timeout = pool_config.get('timeout', 600)
+        http_clients[key] = (httpx.Client(limits=limits, timeout=timeout),
+                             httpx.AsyncClient(limits=limits, timeout=timeout))
+    return http_clients[key]
+
+
 def get_llm(config: dict):
     """
-    Returns the LLM model
+    Returns the LLM model. The models are kept in a registry, so all the chains with the same model config share the
+    same client (and connection pool)
+    :param config: dictionary with the configuration
+    :return: The llm model
+    """
+    key = json.dumps({k: v for k, v in config.items() if k not in NON_CLIENT_KEYS}, sort_keys=True, default=str)
+    with llm_clients_lock:
+        if key not in llm_clients:
+            llm_clients[key] = build_llm(config)
+        return llm_clients[key]
+
+
+def shutdown_llm_clients():
+    """
+    Close all the HTTP connection pools and clear the LLM clients registry (called at exit)
+    """
+    with llm_clients_lock:
+        from utils.llm_chain import async_engine  # Local import to avoid circular import
+        loop = async_engine['loop']
+        for client, async_client in http_clients.values():
+            client.close()
+            try:
+                # The async clients are used on the shared event loop, so they are closed on it (if it is running)
+                if loop is not None and loop.is_running():
+                    asyncio.run_coroutine_threadsafe(async_client.aclose(), loop).result(timeout=10)
+                else:
+                    asyncio.run(async_client.aclose())
+            except Exception as e:
+                logging.warning(f'Failed to close an async HTTP client: {repr(e)}')
+        http_clients.clear()
+        llm_clients.clear()
+
+
+atexit.register(shutdown_llm_clients)
+
+
+def build_llm(config: dict):
+    """
+    Build a new LLM model. The provider packages are imported only when the config selects them
     :param config: dictionary with the configuration
     :return: The llm model
     """
+    llm_env = get_llm_env()
+    pool_config = config.get('pool', {})
     if 'temperature' not in config:
         temperature = 0
     else:
@@ -37,31 +116,41 @@ def get_llm(config: dict):
         model_kwargs = {}
 
     if config['type'].lower() == 'openai':
-        if LLM_ENV['openai']['OPENAI_ORGANIZATION'] == '':
+        from langchain_openai import ChatOpenAI
+        openai_api_key = config.get('openai_api_key', llm_env['openai']['OPENAI_API_KEY'])
+        openai_api_base = config.get('openai_api_base', 'https://api.openai.com/v1')
+        http_client, http_async_client = get_http_clients('openai', openai_api_base, openai_api_key, pool_config)
+        if llm_env['openai']['OPENAI_ORGANIZATION'] == '':
             return ChatOpenAI(temperature=temperature, model_name=config['name'],
-                              openai_api_key=config.get('openai_api_key', LLM_ENV['openai']['OPENAI_API_KEY']),
-                              openai_api_base=config.get('openai_api_base', 'https://api.openai.com/v1'),
-                              model_kwargs=model_kwargs)
+                              openai_api_key=openai_api_key,
+                              openai_api_base=openai_api_base,
+                              model_kwargs=model_kwargs, http_client=http_client, http_async_client=http_async_client)
         else:
             return ChatOpenAI(temperature=temperature, model_name=config['name'],
-                              openai_api_key=config.get('openai_api_key', LLM_ENV['openai']['OPENAI_API_KEY']),
-                              openai_api_base=config.get('openai_api_base', 'https://api.openai.com/v1'),
-                              openai_organization=config.get('openai_organization', LLM_ENV['openai']['OPENAI_ORGANIZATION']),
-                              model_kwargs=model_kwargs)
+                              openai_api_key=openai_api_key,
+                              openai_api_base=openai_api_base,
+                              openai_organization=config.get('openai_organization', llm_env['openai']['OPENAI_ORGANIZATION']),
+                              model_kwargs=model_kwargs, http_client=http_client, http_async_client=http_async_client)
     elif config['type'].lower() == 'azure':
+        from langchain_community.chat_models import AzureChatOpenAI
+        openai_api_key = config.get('openai_api_key', llm_env['azure']['AZURE_OPENAI_API_KEY'])
+        azure_endpoint = config.get('azure_endpoint', llm_env['azure']['AZURE_OPENAI_ENDPOINT'])
+        http_client, _ = get_http_clients('azure', azure_endpoint, openai_api_key, pool_config)
         return AzureChatOpenAI(temperature=temperature, azure_deployment=config['name'],
-                        openai_api_key=config.get('openai_api_key', LLM_ENV['azure']['AZURE_OPENAI_API_KEY']),
-                        azure_endpoint=config.get('azure_endpoint', LLM_ENV['azure']['AZURE_OPENAI_ENDPOINT']),
-                        openai_api_version=config.get('openai_api_version', LLM_ENV['azure']['OPENAI_API_VERSION']))
+                        openai_api_key=openai_api_key,
+                        azure_endpoint=azure_endpoint,
+                        openai_api_version=config.get('openai_api_version', llm_env['azure']['OPENAI_API_VERSION']),
+                        http_client=http_client)
 
     elif config['type'].lower() == 'google':
         from langchain_google_genai import ChatGoogleGenerativeAI
         return ChatGoogleGenerativeAI(temperature=temperature, model=config['name'],
-                              google_api_key=LLM_ENV['google']['GOOGLE_API_KEY'],
+                              google_api_key=llm_env['google']['GOOGLE_API_KEY'],
                               model_kwargs=model_kwargs)
 
 
     elif config['type'].lower() == 'huggingfacepipeline':
+        from langchain.llms.huggingface_pipeline import HuggingFacePipeline
         device = config.get('gpu_device', -1)
         device_map = config.get('device_map', None)
 
@@ -72,6 +161,10 @@ def get_llm(config: dict):
             device=device,
             device_map=device_map
         )
+    elif config['type'].lower() == 'fake':
+        # A local fake LLM for offline runs and benchmarks (no requests are sent)
+        from utils.fake_llm import build_fake_llm
+        return build_fake_llm(config)
     else:
         raise NotImplementedError("LLM not implemented")
 
@@ -114,20 +207,26 @@ def validate_generation_config(base_config, generation_config):
 
 
 def modify_input_for_ranker(config, task_description, initial_prompt):
+    from utils.llm_chain import ChainWrapper  # Local import to avoid circular import
     modifiers_config = yaml.safe_load(open('prompts/modifiers/modifiers.yml', 'r'))
-    task_desc_setup = load_prompt(modifiers_config['ranker']['task_desc_mod'])
-    init_prompt_setup = load_prompt(modifiers_config['ranker']['prompt_mod'])
 
-    llm = get_llm(config.llm)
-    task_llm_chain = LLMChain(llm=llm, prompt=task_desc_setup)
-    task_result = task_llm_chain(
+    task_llm_chain = ChainWrapper(config.llm, modifiers_config['ranker']['task_desc_mod'])
+    task_result = task_llm_chain.invoke(
         {"task_description": task_description})
-    mod_task_desc = task_result['text']
+    if task_result is None:
+        logging.warning('Failed to modify the task description for ranking, using the original task description')
+        mod_task_desc = task_description
+    else:
+        mod_task_desc = task_result['text']
     logging.info(f"Task description modified for ranking to: \n{mod_task_desc}")
 
-    prompt_llm_chain = LLMChain(llm=llm, prompt=init_prompt_setup)
-    prompt_result = prompt_llm_chain({"prompt": initial_prompt, 'label_schema': config.dataset.label_schema})
-    mod_prompt = prompt_result['text']
+    prompt_llm_chain = ChainWrapper(config.llm, modifiers_config['ranker']['prompt_mod'])
+    prompt_result = prompt_llm_chain.invoke({"prompt": initial_prompt, 'label_schema': config.dataset.label_schema})
+    if prompt_result is None:
+        logging.warning('Failed to modify the initial prompt for ranking, using the original prompt')
+        mod_prompt = initial_prompt
+    else:
+        mod_prompt = prompt_result['text']
     logging.info(f"Initial prompt modified for ranking to: \n{mod_prompt}")
 
     return mod_prompt, mod_task_desc
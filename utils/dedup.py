@@ -1,9 +1,125 @@
 import random
-from sentence_transformers import SentenceTransformer
-import faiss
+import hashlib
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+import numpy as np
 import pandas as pd
 
 
+embeddings_models = {}
+embeddings_caches = {}
+embeddings_lock = threading.Lock()
+
+
+def get_embeddings_model(model_name: str):
+    """
+    Return the embeddings model, the model (and sentence_transformers) is loaded only once per process, on first use
+    :param model_name: The SentenceTransformer model name
+    """
+    with embeddings_lock:
+        if model_name not in embeddings_models:
+            from sentence_transformers import SentenceTransformer
+            embeddings_models[model_name] = SentenceTransformer(model_name)
+        return embeddings_models[model_name]
+
+
+class EmbeddingsCache:
+    """
+    A cache of the texts embeddings (float32), keyed by the text hash.
+    The persisted embeddings are loaded as a memory-mapped array, new embeddings are appended to an in-memory buffer.
+    """
+
+    def __init__(self):
+        self.keys = {}
+        self.data = None
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.size
+
+    @staticmethod
+    def get_key(text: str) -> str:
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def append(self, keys: list[str], embeddings: np.ndarray):
+        """
+        Append new embeddings to the cache, the buffer capacity is doubled when it is full
+        :param keys: The texts hashes
+        :param embeddings: The texts embeddings
+        """
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if self.data is None or isinstance(self.data, np.memmap) or self.size + len(keys) > len(self.data):
+            capacity = max(2 * (self.size + len(keys)), 1024)
+            data = np.empty((capacity, embeddings.shape[1]), dtype=np.float32)
+            if self.size > 0:
+                data[:self.size] = self.data[:self.size]
+            self.data = data
+        self.data[self.size:self.size + len(keys)] = embeddings
+        for i, key in enumerate(keys):
+            self.keys[key] = self.size + i
+        self.size += len(keys)
+
+    def encode(self, texts: list[str], encode_func) -> np.ndarray:
+        """
+        Return the embeddings of the texts, only the texts that are not in the cache are encoded
+        :param texts: The texts
+        :param encode_func: A function that encodes a list of texts
+        :return: The embeddings matrix (float32)
+        """
+        text_keys = [self.get_key(text) for text in texts]
+        with self.lock:
+            missing = {}
+            for key, text in zip(text_keys, texts):
+                if key not in self.keys and key not in missing:
+                    missing[key] = text
+            if len(missing) > 0:
+                self.append(list(missing.keys()), encode_func(list(missing.values())))
+            return np.asarray(self.data[[self.keys[key] for key in text_keys]])
+
+    def save(self, path: Path):
+        """
+        Save the cache (embeddings.npy and embeddings_keys.json)
+        :param path: The dump directory
+        """
+        with self.lock:
+            if self.size == 0:
+                return
+            # Write to a temporary file and replace, the current file may be memory-mapped
+            np.save(Path(path) / 'embeddings_tmp.npy', self.data[:self.size])
+            os.replace(Path(path) / 'embeddings_tmp.npy', Path(path) / 'embeddings.npy')
+            keys = sorted(self.keys.keys(), key=lambda key: self.keys[key])
+            json.dump(keys, open(Path(path) / 'embeddings_keys.json', 'w'))
+
+    def load(self, path: Path):
+        """
+        Load the cache from the dump directory (memory-mapped)
+        :param path: The dump directory
+        """
+        if not (Path(path) / 'embeddings.npy').is_file():
+            logging.warning('Embeddings dump not found, initializing from zero')
+            return
+        with self.lock:
+            keys = json.load(open(Path(path) / 'embeddings_keys.json', 'r'))
+            self.data = np.load(Path(path) / 'embeddings.npy', mmap_mode='r')
+            self.keys = {key: i for i, key in enumerate(keys)}
+            self.size = len(keys)
+
+
+def get_embeddings_cache(model_name: str) -> EmbeddingsCache:
+    """
+    Return the embeddings cache of the model, the cache is shared by all the Dedup instances of the process
+    :param model_name: The SentenceTransformer model name
+    """
+    with embeddings_lock:
+        if model_name not in embeddings_caches:
+            embeddings_caches[model_name] = EmbeddingsCache()
+        return embeddings_caches[model_name]
+
+
 class Dedup:
 
     def __init__(self, config=None):
@@ -12,6 +128,7 @@ class Dedup:
         self.clusters = None
         self.th = (config or {}).get("dedup_threshold", 0.5)
         self.model_name = (config or {}).get("embeddings_model", 'all-MiniLM-L6-v2')
+        self.embeddings_cache = get_embeddings_cache(self.model_name)
 
     def copy(self):
         return Dedup(
@@ -19,13 +136,33 @@ class Dedup:
              "embeddings_model": self.model_name}
         )
 
+    def search_radius(self) -> float:
+        """
+        Return the radius of the FAISS range search for the threshold. The range search keeps only the distances that
+        are strictly below the radius, so the radius is the next float32 value above the threshold, and the pairs at
+        exactly the threshold distance are included (distance <= threshold)
+        """
+        return float(np.nextafter(np.float32(self.th), np.float32(np.inf)))
+
     def generate_embeddings(self, texts):
         """
         Generate embeddings for the given texts using the SentenceTransformer model.
+        Only the texts that are not in the embeddings cache are encoded.
+        """
+        return self.embeddings_cache.encode(
+            texts, lambda new_texts: get_embeddings_model(self.model_name).encode(new_texts, show_progress_bar=True))
+
+    def save_embeddings(self, path: Path):
+        """
+        Save the embeddings cache to the dump directory
+        """
+        self.embeddings_cache.save(path)
+
+    def load_embeddings(self, path: Path):
+        """
+        Load the embeddings cache from the dump directory
         """
-        model = SentenceTransformer(self.model_name)
-        embeddings = model.encode(texts, show_progress_bar=True)
-        return embeddings
+        self.embeddings_cache.load(path)
 
     def build_index(self, records):
         """
@@ -38,6 +175,7 @@ class Dedup:
         embeddings = self.generate_embeddings(records['text'].tolist())
 
         # Build the FAISS index
+        import faiss
         embeddings_dim = embeddings.shape[1]
         index = faiss.IndexFlatL2(embeddings_dim)
         index.add(embeddings)
@@ -45,35 +183,27 @@ class Dedup:
 
     def cluster_data(self, records):
         """
-        Cluster the given dataset.
+        Cluster the given dataset. The clusters are the connected components of the graph that connects every pair of
+        records that are closer than the threshold.
         input: records - a pandas dataframe with a 'text' column
         output: clusters - a list of clusters, where each cluster is a set of indices
         """
+        from scipy.sparse import csr_matrix
+        from scipy.sparse.csgraph import connected_components
 
         if self.index is None:
             self.index, self.xb = self.build_index(records)
 
-        distances, indices = self.index.search(self.xb, 30) #TODO: dereive it from the batch size
-
-        clusters = []
-        visited = set()
-
-        for i in range(len(self.xb)):
-            if i in visited:
-                continue
-
-            # Find neighbors and create a new cluster
-            neighbors = [idx for idx, distance in zip(indices[i], distances[i]) if distance <= self.th]
-            new_cluster = {i}
-
-            # Add all neighbors to the new cluster
-            for neighbor in neighbors:
-                if neighbor not in visited:
-                    visited.add(neighbor)
-                    new_cluster.add(neighbor)
+        num_records = len(self.xb)
+        lims, distances, indices = self.index.range_search(self.xb, self.search_radius())
+        rows = np.repeat(np.arange(num_records), np.diff(lims).astype(np.int64))
+        graph = csr_matrix((np.ones(len(indices), dtype=np.int8), (rows, indices)), shape=(num_records, num_records))
+        num_clusters, labels = connected_components(graph, directed=False)
 
-            clusters.append(new_cluster)
-        return clusters
+        # Group the indices by their cluster label (the labels are ordered by the first index of each cluster)
+        order = np.argsort(labels, kind='stable')
+        cluster_sizes = np.bincount(labels, minlength=num_clusters)
+        return [set(cluster.tolist()) for cluster in np.split(order, np.cumsum(cluster_sizes)[:-1])]
 
     def sample(self, records: pd.DataFrame, operation_function=random.choice):
         """
@@ -91,3 +221,173 @@ class Dedup:
 
         samples = [operation_function(list(cluster)) for cluster in self.clusters]
         return records.iloc[sorted(samples)]
+
+
+class DatasetIndex:
+    """
+    A long-lived FAISS index of the dataset records, keyed by the record id. The index grows incrementally when
+    records are added, and shrinks when records are removed. It also keeps the semantic clusters of the records
+    (records that are closer than the dedup threshold are connected) with a union-find structure, so adding records
+    costs O(new records) instead of re-clustering the whole dataset.
+    """
+
+    def __init__(self, dedup: Dedup, index_type: str = 'flat', nlist: int = 100, nprobe: int = 8, hnsw_m: int = 32,
+                 num_neighbors: int = 64, points_per_cell: int = 39):
+        """
+        Initialize a new instance of the DatasetIndex class.
+        :param dedup: The Dedup instance, used for the embeddings and the threshold
+        :param index_type: The FAISS index type, either 'flat', 'ivf' or 'hnsw'
+        :param nlist: The number of IVF cells (ivf only)
+        :param nprobe: The number of IVF cells that are visited in a search (ivf only)
+        :param hnsw_m: The number of neighbors in the HNSW graph (hnsw only)
+        :param num_neighbors: The number of neighbors that are searched (hnsw only, flat and ivf use range search)
+        :param points_per_cell: The IVF index is trained once there are points_per_cell * nlist records, until then
+        a flat index is used (ivf only)
+        """
+        if index_type not in ['flat', 'ivf', 'hnsw']:
+            raise NotImplementedError(f'Index type {index_type} not implemented')
+        self.dedup = dedup
+        self.index_type = index_type
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.hnsw_m = hnsw_m
+        self.num_neighbors = num_neighbors
+        self.points_per_cell = points_per_cell
+        self.reset()
+
+    def reset(self):
+        """
+        Remove all the records from the index
+        """
+        self.index = None
+        self.trained = False
+        self.ids = set()
+        self.removed = set()
+        self.parent = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def build_index(self, dim: int):
+        """
+        Build an empty index according to the index type. The IVF index starts as a flat index, since it can't be
+        trained before there are enough records (see train_index)
+        :param dim: The embeddings dimension
+        """
+        import faiss
+        if self.index_type == 'hnsw':
+            return faiss.IndexIDMap2(faiss.IndexHNSWFlat(dim, self.hnsw_m))
+        return faiss.IndexIDMap2(faiss.IndexFlatL2(dim))
+
+    def train_index(self):
+        """
+        Replace the flat index of the IVF index type by an IVF index with nlist cells, trained on all the records
+        """
+        import faiss
+        embeddings = self.index.index.reconstruct_n(0, self.index.ntotal)
+        ids = faiss.vector_to_array(self.index.id_map).astype(np.int64)
+        quantizer = faiss.IndexFlatL2(embeddings.shape[1])
+        index = faiss.IndexIVFFlat(quantizer, embeddings.shape[1], self.nlist)
+        index.train(embeddings)
+        index.nprobe = self.nprobe
+        index.add_with_ids(embeddings, ids)
+        self.index = index
+        self.trained = True
+
+    def find(self, record_id: int) -> int:
+        """
+        Return the cluster root of the record (union-find with path halving)
+        """
+        while self.parent[record_id] != record_id:
+            self.parent[record_id] = self.parent[self.parent[record_id]]
+            record_id = self.parent[record_id]
+        return record_id
+
+    def union(self, first_id: int, second_id: int):
+        first_root, second_root = self.find(first_id), self.find(second_id)
+        if first_root != second_root:
+            self.parent[max(first_root, second_root)] = min(first_root, second_root)
+
+    def neighbors(self, embeddings: np.ndarray) -> list[np.ndarray]:
+        """
+        Return the ids of the records that are closer than the dedup threshold to each one of the embeddings
+        :param embeddings: The query embeddings
+        :return: A list with an array of neighbors ids for each query
+        """
+        if self.index is None or len(self.ids) == 0:
+            return [np.array([], dtype=np.int64) for _ in range(len(embeddings))]
+        if self.index_type == 'hnsw':
+            distances, indices = self.index.search(embeddings, min(self.num_neighbors, self.index.ntotal))
+            results = []
+            for query_distances, query_indices in zip(distances, indices):
+                query_indices = query_indices[(query_indices >= 0) & (query_distances <= self.dedup.th)]
+                results.append(np.array([i for i in query_indices if i not in self.removed], dtype=np.int64))
+            return results
+        lims, distances, indices = self.index.range_search(embeddings, self.dedup.search_radius())
+        return [indices[lims[i]:lims[i + 1]] for i in range(len(embeddings))]
+
+    def add(self, ids: list[int], texts: list[str]):
+        """
+        Add records to the index and update the clusters
+        :param ids: The records ids
+        :param texts: The records texts
+        """
+        if len(ids) == 0:
+            return
+        ids = np.asarray(ids, dtype=np.int64)
+        embeddings = self.dedup.generate_embeddings(list(texts))
+        if self.index is None:
+            self.index = self.build_index(embeddings.shape[1])
+        self.index.add_with_ids(embeddings, ids)
+        self.ids.update(ids.tolist())
+        if self.index_type == 'ivf' and not self.trained and len(self.ids) >= self.points_per_cell * self.nlist:
+            self.train_index()
+        for record_id in ids.tolist():
+            self.parent[record_id] = record_id
+        for record_id, record_neighbors in zip(ids.tolist(), self.neighbors(embeddings)):
+            for neighbor_id in record_neighbors.tolist():
+                self.union(record_id, neighbor_id)
+
+    def remove(self, ids: list[int]):
+        """
+        Remove records from the index. HNSW doesn't support removal, so the removed ids are filtered from the results.
+        The removed records are also removed from the clusters, a cluster whose root was removed is re-rooted at its
+        smallest remaining record (the cluster is not split)
+        :param ids: The records ids
+        """
+        ids = [record_id for record_id in np.asarray(ids, dtype=np.int64).tolist() if record_id in self.ids]
+        if len(ids) == 0:
+            return
+        self.ids.difference_update(ids)
+        if self.index_type == 'hnsw':
+            self.removed.update(ids)
+        else:
+            self.index.remove_ids(np.asarray(ids, dtype=np.int64))
+        removed = set(ids)
+        roots = {record_id: self.find(record_id) for record_id in sorted(self.ids)}
+        new_roots = {}
+        for record_id, root in roots.items():
+            if root in removed:
+                new_roots.setdefault(root, record_id)
+        self.parent = {record_id: new_roots.get(root, root) for record_id, root in roots.items()}
+
+    def is_duplicate(self, texts: list[str]) -> list[bool]:
+        """
+        Check which of the texts are near-duplicates (closer than the dedup threshold) of records in the index
+        :param texts: The texts to check
+        :return: A list with True for each text that has a near-duplicate in the index
+        """
+        if len(texts) == 0:
+            return []
+        embeddings = self.dedup.generate_embeddings(list(texts))
+        return [len(record_neighbors) > 0 for record_neighbors in self.neighbors(embeddings)]
+
+    def get_clusters(self) -> list[list[int]]:
+        """
+        Return the clusters of the records in the index
+        :return: A list of clusters, where each cluster is a list of records ids
+        """
+        clusters = {}
+        for record_id in sorted(self.ids):
+            clusters.setdefault(self.find(record_id), []).append(record_id)
+        return list(clusters.values())
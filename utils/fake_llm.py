@@ -0,0 +1,305 @@
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import random
+import re
+import threading
+import time
+from typing import Any
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+WORDS = ['the', 'service', 'order', 'delivery', 'was', 'very', 'late', 'great', 'price', 'quality', 'support', 'team',
+         'product', 'movie', 'plot', 'actor', 'review', 'address', 'phone', 'number', 'account', 'password', 'email',
+         'refund', 'never', 'again', 'recommend', 'friendly', 'slow', 'fast', 'broken', 'works', 'perfectly', 'city',
+         'street', 'weather', 'today', 'question', 'answer', 'prompt', 'score', 'reason', 'result', 'sample', 'task']
+# The samples ids in the estimator prompt (see LLMEstimator.generate_sample_text)
+SAMPLE_ID_PATTERN = re.compile(r'ID: (\d+);')
+
+
+class FakeLLMError(Exception):
+    """
+    A simulated provider error (retried by ChainWrapper like any other failed request)
+    """
+    status_code = 500
+
+
+def load_trace(path: str) -> dict:
+    """
+    Load a JSONL trace of recorded responses (see ChainWrapper record_trace), each line is a dict with the rendered
+    prompt, the response and its latency
+    :param path: The trace path
+    :return: A dict from the prompt hash to the list of its recorded responses (in the recording order)
+    """
+    trace = {}
+    with open(path, 'r') as f:
+        for line in f:
+            if line.strip() == '':
+                continue
+            entry = json.loads(line)
+            trace.setdefault(prompt_hash(entry['prompt']), []).append(entry)
+    return trace
+
+
+def prompt_hash(prompt: str) -> str:
+    return hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+
+
+class FakeResponder:
+    """
+    Generate the responses of the fake LLM: schema-valid random outputs (or recorded responses replayed from a
+    trace), with simulated latency and errors. The responses are deterministic: they depend only on the seed, the
+    prompt and the number of previous requests with the same prompt
+    """
+
+    def __init__(self, config: dict):
+        """
+        Initialize a new instance of the FakeResponder class.
+        :param config: The llm config (seed, latency, error_rate, drop_rate, array_length, array_lengths,
+        number_range, labels, trace)
+        """
+        self.seed = config.get('seed', 0)
+        self.latency = dict(config.get('latency', {'distribution': 'constant', 'value': 0}))
+        self.error_rate = config.get('error_rate', 0)
+        # The probability to drop each item of a generated array (e.g. a missing sample in a mini-batch result)
+        self.drop_rate = config.get('drop_rate', 0)
+        self.array_length = config.get('array_length', [1, 5])
+        self.array_lengths = dict(config.get('array_lengths', {}))
+        self.number_range = config.get('number_range', [1, 5])
+        self.labels = config.get('labels', None)
+        trace_config = config.get('trace', None)
+        self.trace = load_trace(trace_config['path']) if trace_config is not None else {}
+        self.strict = trace_config is not None and trace_config.get('strict', False)
+        self.request_counts = {}
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'replayed': 0, 'generated': 0, 'errors': 0}
+
+    def count(self, key: str) -> int:
+        """
+        Return the number of previous requests with the same prompt, and count the current one
+        :param key: The prompt hash
+        """
+        with self.lock:
+            count = self.request_counts.get(key, 0)
+            self.request_counts[key] = count + 1
+            self.stats['requests'] += 1
+            return count
+
+    def respond(self, prompt: str, schema: dict = None) -> tuple:
+        """
+        Return the response of a request
+        :param prompt: The rendered prompt
+        :param schema: The json schema of the structured output, None for a text response
+        :return: The response (a dict for structured output, otherwise a string), the simulated latency (sec), and
+        an exception if the request fails (None otherwise)
+        """
+        key = prompt_hash(prompt)
+        count = self.count(key)
+        rng = random.Random(f'{self.seed}:{key}:{count}')
+        error = None
+        if rng.random() < self.error_rate:
+            error = FakeLLMError(f'Fake LLM error (request {count} of the prompt {key[:8]})')
+        if key in self.trace:
+            entries = self.trace[key]
+            entry = entries[count % len(entries)]
+            response, recorded_latency = entry['response'], entry.get('latency', 0)
+            stat = 'replayed'
+        elif self.strict:
+            response, recorded_latency = None, 0
+            error = FakeLLMError(f'The prompt {key[:8]} is not in the trace')
+            stat = 'errors'
+        else:
+            sample_ids = [int(i) for i in SAMPLE_ID_PATTERN.findall(prompt)]
+            if schema is None:
+                response = self.generate_text(rng, sample_ids)
+            else:
+                response = self.generate(schema, schema, rng, sample_ids=sample_ids)
+            recorded_latency = 0
+            stat = 'generated'
+        with self.lock:
+            self.stats[stat if error is None else 'errors'] += 1
+        latency = self.sample_latency(rng, recorded_latency, len(prompt) + len(json.dumps(response)))
+        return response, latency, error
+
+    def sample_latency(self, rng: random.Random, recorded_latency: float, num_chars: int) -> float:
+        """
+        Sample the latency of a request from the latency distribution
+        :param rng: The request random generator
+        :param recorded_latency: The latency of the replayed response
+        :param num_chars: The number of characters of the prompt and the response
+        """
+        distribution = self.latency.get('distribution', 'constant')
+        if distribution == 'constant':
+            latency = self.latency.get('value', 0)
+        elif distribution == 'uniform':
+            latency = rng.uniform(self.latency.get('low', 0), self.latency.get('high', 1))
+        elif distribution == 'normal':
+            latency = rng.gauss(self.latency.get('mean', 1), self.latency.get('std', 0.1))
+        elif distribution == 'lognormal':
+            latency = rng.lognormvariate(math.log(self.latency.get('median', 1)), self.latency.get('sigma', 0.5))
+        elif distribution == 'exponential':
+            latency = rng.expovariate(1 / self.latency.get('mean', 1))
+        elif distribution == 'trace':
+            latency = recorded_latency
+        else:
+            raise Exception(f'Unknown latency distribution {distribution}')
+        # ~4 characters per token
+        latency += self.latency.get('per_token', 0) * num_chars / 4
+        return max(latency, 0)
+
+    def random_text(self, rng: random.Random, min_words: int = 4, max_words: int = 16) -> str:
+        return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(min_words, max_words)))
+
+    def generate_text(self, rng: random.Random, sample_ids: list[int]) -> str:
+        """
+        Generate a text response, in case of an estimator prompt one line per sample (Sample <ID>: <label>)
+        :param rng: The request random generator
+        :param sample_ids: The samples ids in the prompt
+        """
+        if len(sample_ids) == 0:
+            return self.random_text(rng)
+        lines = []
+        for sample_id in sample_ids:
+            if rng.random() >= self.drop_rate:
+                label = rng.choice(self.labels) if self.labels else rng.choice(WORDS)
+                lines.append(f'Sample {sample_id}: {label}')
+        return '\n'.join(lines)
+
+    @staticmethod
+    def resolve(schema: dict, root: dict) -> dict:
+        """
+        Resolve the schema references ($ref, and a single allOf as pydantic uses for the nested models)
+        :param schema: The schema
+        :param root: The root schema (that contains the $defs/definitions)
+        """
+        while True:
+            if '$ref' in schema:
+                resolved = root
+                for part in schema['$ref'].lstrip('#/').split('/'):
+                    resolved = resolved[part]
+                schema = resolved
+            elif 'allOf' in schema and len(schema['allOf']) == 1:
+                schema = schema['allOf'][0]
+            else:
+                return schema
+
+    def get_array_length(self, rng: random.Random, schema: dict, name: str) -> int:
+        length = self.array_lengths.get(name, self.array_length)
+        length = rng.randint(*length) if isinstance(length, (list, tuple)) else length
+        return min(max(length, schema.get('minItems', 0)), schema.get('maxItems', length))
+
+    def generate(self, schema: dict, root: dict, rng: random.Random, name: str = None,
+                 sample_ids: list[int] = None):
+        """
+        Generate a random instance of the json schema
+        :param schema: The (sub-)schema
+        :param root: The root schema
+        :param rng: The request random generator
+        :param name: The property name of the (sub-)schema
+        :param sample_ids: The samples ids in the prompt, an array of objects with an integer id gets one item per
+        sample
+        """
+        schema = self.resolve(schema, root)
+        if 'enum' in schema:
+            return rng.choice(schema['enum'])
+        if 'const' in schema:
+            return schema['const']
+        for key in ['anyOf', 'oneOf']:
+            if key in schema:
+                options = [option for option in schema[key] if option.get('type') != 'null']
+                return self.generate(rng.choice(options or schema[key]), root, rng, name, sample_ids)
+        schema_type = schema.get('type')
+        if isinstance(schema_type, list):
+            schema_type = next((t for t in schema_type if t != 'null'), 'null')
+        if schema_type is None:
+            schema_type = 'object' if 'properties' in schema else 'array' if 'items' in schema else 'string'
+        if schema_type == 'object':
+            return {key: self.generate(value, root, rng, key, sample_ids)
+                    for key, value in schema.get('properties', {}).items()}
+        if schema_type == 'array':
+            items = self.resolve(schema.get('items', {}), root)
+            if sample_ids and items.get('properties', {}).get('id', {}).get('type') == 'integer':
+                result = [dict(self.generate(items, root, rng, name), id=sample_id) for sample_id in sample_ids]
+            else:
+                result = [self.generate(items, root, rng, name)
+                          for _ in range(self.get_array_length(rng, schema, name))]
+            return [item for item in result if rng.random() >= self.drop_rate]
+        if schema_type == 'integer':
+            return rng.randint(int(schema.get('minimum', self.number_range[0])),
+                               int(schema.get('maximum', self.number_range[1])))
+        if schema_type == 'number':
+            return round(rng.uniform(schema.get('minimum', self.number_range[0]),
+                                     schema.get('maximum', self.number_range[1])), 2)
+        if schema_type == 'boolean':
+            return rng.random() < 0.5
+        if schema_type == 'null':
+            return None
+        return self.random_text(rng)
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    A local fake chat model for offline runs and benchmarks. Structured outputs (function calling) are generated
+    from the bound function schema, so every output schema is supported
+    """
+    responder: Any
+    model_name: str = 'fake'
+
+    @property
+    def _llm_type(self) -> str:
+        return 'fake'
+
+    def bind_tools(self, tools, **kwargs):
+        # The fake model never calls the tools, the agents get a final answer
+        return self.bind(tools=[convert_to_openai_tool(tool) for tool in tools], **kwargs)
+
+    def respond(self, messages, kwargs: dict) -> tuple:
+        prompt = '\n'.join(str(message.content) for message in messages)
+        functions = kwargs.get('functions', None)
+        if not functions:
+            return self.responder.respond(prompt) + (None,)
+        function = functions[0]
+        function_call = kwargs.get('function_call', None)
+        if isinstance(function_call, dict):
+            function = next((f for f in functions if f['name'] == function_call['name']), function)
+        return self.responder.respond(prompt, function.get('parameters', {})) + (function['name'],)
+
+    @staticmethod
+    def build_result(response, function_name: str) -> ChatResult:
+        if function_name is None:
+            content = response if isinstance(response, str) else json.dumps(response)
+            message = AIMessage(content=content)
+        else:
+            arguments = response if isinstance(response, str) else json.dumps(response)
+            message = AIMessage(content='', additional_kwargs={'function_call': {'name': function_name,
+                                                                                 'arguments': arguments}})
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        response, latency, error, function_name = self.respond(messages, kwargs)
+        time.sleep(latency)
+        if error is not None:
+            raise error
+        return self.build_result(response, function_name)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        response, latency, error, function_name = self.respond(messages, kwargs)
+        await asyncio.sleep(latency)
+        if error is not None:
+            raise error
+        return self.build_result(response, function_name)
+
+
+def build_fake_llm(config: dict) -> FakeChatModel:
+    """
+    Build the fake LLM of the llm config
+    :param config: The llm config
+    """
+    if config.get('trace', None) is not None:
+        logging.info(f"Fake LLM replays the responses of the trace {config['trace']['path']}")
+    return FakeChatModel(responder=FakeResponder(config), model_name=config.get('name', 'fake'))
@@ -1,15 +1,22 @@
-from langchain.chains.openai_functions import (
-    create_structured_output_runnable)
 from utils.config import get_llm, load_prompt
+from utils.rate_limiter import get_rate_limiter
 from langchain_community.callbacks import get_openai_callback
 import asyncio
 from langchain.chains import LLMChain
 import importlib
 from pathlib import Path
-from tqdm import trange, tqdm
+from tqdm import tqdm
 import concurrent.futures
+import copy
 import logging
-from easydict import EasyDict as edict
+import hashlib
+import json
+import pickle
+import random
+import sqlite3
+import threading
+import time
+from collections.abc import Mapping
 
 
 class DummyCallback:
@@ -30,6 +37,209 @@ def get_dummy_callback():
     return DummyCallback()
 
 
+def is_authentication_error(e: Exception) -> bool:
+    """
+    Check if the exception is an authentication error (HTTP 401) of the provider, these errors are not retried
+    :param e: The exception
+    """
+    return getattr(e, 'http_status', None) == 401 or getattr(e, 'status_code', None) == 401
+
+
+class LLMCache:
+    """
+    A persistent cache of the LLM responses, stored in a local SQLite file.
+    The cache is bounded by size (least recently used entries are evicted first) and by the entries age (ttl).
+    """
+
+    def __init__(self, path: str, max_size_mb: float = 512, ttl: float = 0):
+        """
+        Initialize a new instance of the LLMCache class.
+        :param path: The path to the SQLite file
+        :param max_size_mb: The maximal size of the stored responses (in MB)
+        :param ttl: The time to live of an entry in seconds, 0 means no expiration
+        """
+        self.path = str(path)
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, size INTEGER, '
+                                'created_at REAL, last_access REAL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS last_access_idx ON cache (last_access)')
+        self.connection.commit()
+
+    @staticmethod
+    def get_key(rendered_prompt: str, llm_config: dict, json_schema=None) -> str:
+        """
+        Return the cache key of a request
+        :param rendered_prompt: The prompt after it was formatted with the chain input
+        :param llm_config: The config for the LLM
+        :param json_schema: The json schema of the structured output (either a dict or a pydantic class)
+        :return: The key of the request
+        """
+        if hasattr(json_schema, 'schema'):
+            json_schema = json_schema.schema()
+        key_data = {'prompt': rendered_prompt, 'type': llm_config.get('type', '').lower(),
+                    'name': llm_config.get('name', ''), 'temperature': llm_config.get('temperature', 0),
+                    'model_kwargs': llm_config.get('model_kwargs', {}), 'json_schema': json_schema}
+        return hashlib.sha256(json.dumps(key_data, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def get(self, key: str):
+        """
+        Return the cached response, or None in case of a miss
+        :param key: The cache key
+        """
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute('SELECT value, created_at FROM cache WHERE key = ?', (key,)).fetchone()
+            if row is not None and 0 < self.ttl < now - row[1]:
+                self.connection.execute('DELETE FROM cache WHERE key = ?', (key,))
+                self.connection.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.connection.execute('UPDATE cache SET last_access = ? WHERE key = ?', (now, key))
+            self.connection.commit()
+            self.hits += 1
+        return pickle.loads(row[0])
+
+    def set(self, key: str, value):
+        """
+        Store a response in the cache, and evict the least recently used entries if the size limit is exceeded
+        :param key: The cache key
+        :param value: The (picklable) response
+        """
+        try:
+            blob = pickle.dumps(value)
+        except Exception as e:
+            logging.warning('Response is not cached, failed to serialize it: {}'.format(e))
+            return
+        now = time.time()
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)',
+                                    (key, blob, len(blob), now, now))
+            total_size = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM cache').fetchone()[0]
+            if total_size > self.max_size:
+                rows = self.connection.execute('SELECT key, size FROM cache ORDER BY last_access').fetchall()
+                evict_keys = []
+                for evict_key, size in rows:
+                    if total_size <= self.max_size:
+                        break
+                    evict_keys.append((evict_key,))
+                    total_size -= size
+                self.connection.executemany('DELETE FROM cache WHERE key = ?', evict_keys)
+            self.connection.commit()
+
+
+class TraceRecorder:
+    """
+    Append the LLM responses, with their rendered prompts and latency, to a JSONL trace. The trace can be replayed
+    offline by the fake LLM (llm type 'fake' with a trace path)
+    """
+
+    def __init__(self, path: str):
+        """
+        Initialize a new instance of the TraceRecorder class.
+        :param path: The trace path
+        """
+        self.path = str(path)
+        self.lock = threading.Lock()
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+
+    def write(self, rendered_prompt: str, response, latency: float):
+        """
+        Append a response to the trace
+        :param rendered_prompt: The prompt after it was formatted with the chain input
+        :param response: The response (a json serializable dict for structured output, otherwise the text)
+        :param latency: The request latency in seconds
+        """
+        line = json.dumps({'prompt': rendered_prompt, 'response': response, 'latency': latency}, default=str)
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(line + '\n')
+
+
+trace_recorders = {}
+trace_recorders_lock = threading.Lock()
+
+
+def get_trace_recorder(path: str) -> TraceRecorder:
+    """
+    Return the trace recorder of the given path, all the chains that record to the same file share the same recorder
+    :param path: The trace path
+    """
+    with trace_recorders_lock:
+        if str(path) not in trace_recorders:
+            trace_recorders[str(path)] = TraceRecorder(path)
+        return trace_recorders[str(path)]
+
+
+async_engine = {'loop': None, 'thread': None}
+async_engine_lock = threading.Lock()
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """
+    Return the long-lived event loop that runs all the async chains calls. The loop is running in a background thread
+    and is shared by all the chains of the process
+    """
+    with async_engine_lock:
+        if async_engine['loop'] is None or async_engine['loop'].is_closed():
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name='llm-async-engine', daemon=True)
+            thread.start()
+            async_engine['loop'] = loop
+            async_engine['thread'] = thread
+        return async_engine['loop']
+
+
+def run_async(coroutine):
+    """
+    Run a coroutine on the shared event loop and wait for the result
+    :param coroutine: The coroutine to run
+    :return: The coroutine result
+    """
+    return asyncio.run_coroutine_threadsafe(coroutine, get_event_loop()).result()
+
+
+class ConcurrencyLimiter:
+    """
+    A global cap on the number of concurrent requests, shared by several chains that run at the same time (e.g. the
+    estimators of all the instructions). It bounds both the sync workers and the async requests
+    """
+
+    def __init__(self, max_concurrency: int):
+        """
+        Initialize a new instance of the ConcurrencyLimiter class.
+        :param max_concurrency: The maximal number of concurrent requests
+        """
+        self.max_concurrency = max_concurrency
+        self.thread_semaphore = threading.BoundedSemaphore(max_concurrency)
+        # The async semaphore is used only on the shared event loop
+        self.async_semaphore = asyncio.Semaphore(max_concurrency)
+
+
+llm_cache_registry = {}
+llm_cache_registry_lock = threading.Lock()
+
+
+def get_llm_cache(cache_config: dict) -> LLMCache:
+    """
+    Return the LLM cache of the given config, all the chains that use the same file share the same cache instance
+    :param cache_config: The cache config (path, max_size_mb, ttl)
+    """
+    path = str(cache_config['path'])
+    with llm_cache_registry_lock:
+        if path not in llm_cache_registry:
+            llm_cache_registry[path] = LLMCache(path, cache_config.get('max_size_mb', 512),
+                                                cache_config.get('ttl', 0))
+        return llm_cache_registry[path]
+
+
 class ChainWrapper:
     """
     A wrapper for a LLM chain
@@ -54,124 +264,315 @@ class ChainWrapper:
             self.callback = get_openai_callback
         else:
             self.callback = get_dummy_callback
+        if 'cache' in self.llm_config.keys():
+            self.cache = get_llm_cache(self.llm_config.cache)
+        else:
+            self.cache = None
+        if 'record_trace' in self.llm_config.keys():
+            self.trace_recorder = get_trace_recorder(self.llm_config.record_trace)
+        else:
+            self.trace_recorder = None
+        self.rate_limiter = get_rate_limiter(self.llm_config)
+        self.retry_params = self.get_retry_params()
+        self.retry_stats = {'attempts': 0, 'retries': 0, 'failures': 0}
+        self.counters_lock = threading.Lock()
+
+    def render_prompt(self, chain_input: dict):
+        """
+        Return the prompt formatted with the chain input, or None if the input doesn't match the prompt
+        :param chain_input: The input for the chain
+        """
+        try:
+            return self.prompt.format(**chain_input)
+        except KeyError:
+            return None
+
+    def get_cache_key(self, chain_input: dict):
+        """
+        Return the cache key of the chain input, or None if the cache is disabled
+        :param chain_input: The input for the chain
+        """
+        if self.cache is None:
+            return None
+        rendered_prompt = self.render_prompt(chain_input)
+        if rendered_prompt is None:
+            return None
+        return LLMCache.get_key(rendered_prompt, self.llm_config, self.json_schema)
 
-    def invoke(self, chain_input: dict) -> dict:
+    def estimate_tokens(self, chain_input: dict) -> int:
         """
-        Invoke the chain on a single input
+        Roughly estimate the number of prompt tokens of the chain input (~4 characters per token)
         :param chain_input: The input for the chain
-        :return: A dict with the defined json schema
+        """
+        rendered_prompt = self.render_prompt(chain_input)
+        return 0 if rendered_prompt is None else len(rendered_prompt) // 4
+
+    def record(self, chain_input: dict, result, latency: float):
+        """
+        Record the chain response in the trace (if record_trace is set)
+        :param chain_input: The input for the chain
+        :param result: The raw chain response
+        :param latency: The request latency in seconds
+        """
+        if self.trace_recorder is None:
+            return
+        if isinstance(self.chain, LLMChain):
+            response = result['text']
+        elif hasattr(result, 'dict'):
+            response = result.dict()
+        else:
+            response = result
+        self.trace_recorder.write(self.render_prompt(chain_input), response, latency)
+
+    def parse(self, result):
+        """
+        Parse the raw chain response with the parser function (if there is one)
+        :param result: The raw chain response
+        """
+        if self.parser_func is None:
+            return result
+        return self.parser_func(result)
+
+    def chain_invoke(self, chain_input: dict, refresh_cache: bool = False):
+        """
+        Invoke the chain and parse the response. The response is taken from the cache if it exists, and a new
+        response is cached only after it was parsed successfully
+        :param chain_input: The input for the chain
+        :param refresh_cache: If True, the cached response is ignored (and replaced by the new response)
+        :return: The parsed chain response
+        """
+        cache_key = self.get_cache_key(chain_input)
+        if cache_key is not None and not refresh_cache:
+            result = self.cache.get(cache_key)
+            if result is not None:
+                return self.parse(result)
+        start_time = time.time()
+        with self.rate_limiter.limit(self.estimate_tokens(chain_input)):
+            result = self.chain.invoke(chain_input)
+        self.record(chain_input, result, time.time() - start_time)
+        parsed_result = self.parse(result)
+        if cache_key is not None and parsed_result is not None:
+            self.cache.set(cache_key, result)
+        return parsed_result
+
+    async def chain_ainvoke(self, chain_input: dict, refresh_cache: bool = False):
+        """
+        Invoke the chain in async mode and parse the response. The response is taken from the cache if it exists, and
+        a new response is cached only after it was parsed successfully. The (blocking) cache calls run in a worker
+        thread, so they don't block the event loop
+        :param chain_input: The input for the chain
+        :param refresh_cache: If True, the cached response is ignored (and replaced by the new response)
+        :return: The parsed chain response
+        """
+        cache_key = self.get_cache_key(chain_input)
+        if cache_key is not None and not refresh_cache:
+            result = await asyncio.to_thread(self.cache.get, cache_key)
+            if result is not None:
+                return self.parse(result)
+        start_time = time.time()
+        async with self.rate_limiter.alimit(self.estimate_tokens(chain_input)):
+            result = await self.chain.ainvoke(chain_input)
+        self.record(chain_input, result, time.time() - start_time)
+        parsed_result = self.parse(result)
+        if cache_key is not None and parsed_result is not None:
+            await asyncio.to_thread(self.cache.set, cache_key, result)
+        return parsed_result
+
+    def get_retry_params(self) -> dict:
+        """
+        Return the retry parameters, taken from the 'retry' section of the llm config. In async mode the defaults are
+        taken from the async_params section
+        """
+        retry_params = {'max_retries': 2, 'base_delay': 1, 'max_delay': 30}
+        if 'async_params' in self.llm_config.keys():
+            retry_params['max_retries'] = self.llm_config.async_params.max_retries
+            retry_params['base_delay'] = self.llm_config.async_params.retry_interval
+        retry_params.update(self.llm_config.get('retry', {}))
+        return retry_params
+
+    def get_backoff(self, attempt: int) -> float:
+        """
+        Return the delay before the next retry (exponential backoff with full jitter)
+        :param attempt: The number of the failed attempt (starting from 0)
+        """
+        return random.uniform(0, min(self.retry_params['max_delay'], self.retry_params['base_delay'] * 2 ** attempt))
+
+    def count(self, counter: str):
+        """
+        Increase one of the retry counters
+        :param counter: The counter name (attempts, retries or failures)
+        """
+        with self.counters_lock:
+            self.retry_stats[counter] += 1
+
+    def try_invoke(self, chain_input: dict, refresh_cache: bool = False) -> dict:
+        """
+        Invoke the chain on a single input (single attempt)
+        :param chain_input: The input for the chain
+        :param refresh_cache: If True, the cached response is ignored (and replaced by the new response)
+        :return: A dict with the defined json schema, or None in case of an error
         """
         with self.callback() as cb:
             try:
-                result = self.chain.invoke(chain_input)
-                if self.parser_func is not None:
-                    result = self.parser_func(result)
+                result = self.chain_invoke(chain_input, refresh_cache)
             except Exception as e:
-                if e.http_status == 401:
+                if is_authentication_error(e):
                     raise e
                 else:
-                    logging.error('Error in chain invoke: {}'.format(e.user_message))
+                    logging.error('Error in chain invoke: {}'.format(getattr(e, 'user_message', repr(e))))
                     result = None
             self.accumulate_usage += cb.total_cost
             return result
 
-    async def retry_operation(self, tasks):
+    def invoke(self, chain_input: dict, limiter: ConcurrencyLimiter = None, refresh_cache: bool = False) -> dict:
         """
-        Retry an async operation
-        :param tasks:
-        :return:
+        Invoke the chain on a single input, failed attempts are retried with exponential backoff
+        :param chain_input: The input for the chain
+        :param limiter: An optional shared limiter, a slot is held only during the attempts (not during the backoff)
+        :param refresh_cache: If True, the cached response is ignored (and replaced by the new response)
+        :return: A dict with the defined json schema, or None if all the attempts failed
         """
-        delay = self.llm_config.async_params.retry_interval
-        timeout = delay * self.llm_config.async_params.max_retries
-
-        # Ensure all tasks are explicitly created
-        tasks = [asyncio.create_task(task) for task in tasks]
-
-        start_time = asyncio.get_event_loop().time()
-        end_time = start_time + timeout
-        results = []
-        while True:
-            remaining_time = end_time - asyncio.get_event_loop().time()
-            if remaining_time <= 0:
-                print("Timeout reached. Operation incomplete.")
-                break
-
-            done, pending = await asyncio.wait(tasks, timeout=delay)
-            results += list(done)
-
-            if len(done) == len(tasks):
-                print("All tasks completed successfully.")
-                break
+        for attempt in range(self.retry_params['max_retries'] + 1):
+            self.count('attempts')
+            if limiter is None:
+                result = self.try_invoke(chain_input, refresh_cache)
+            else:
+                with limiter.thread_semaphore:
+                    result = self.try_invoke(chain_input, refresh_cache)
+            if result is not None:
+                return result
+            if attempt < self.retry_params['max_retries']:
+                self.count('retries')
+                time.sleep(self.get_backoff(attempt))
+        self.count('failures')
+        return None
 
-            if not pending:
-                print("No pending tasks. Operation incomplete.")
+    async def invoke_with_retry(self, chain_input: dict, semaphore: asyncio.Semaphore, pbar=None,
+                                refresh_cache: bool = False):
+        """
+        Invoke the chain on a single input in async mode, with a per-request timeout. Failed attempts are retried
+        with exponential backoff, except for authentication errors that are raised (as in the sync mode)
+        :param chain_input: The input for the chain
+        :param semaphore: The semaphore that bounds the number of concurrent requests
+        :param pbar: An optional progress bar to update
+        :param refresh_cache: If True, the cached response is ignored (and replaced by the new response)
+        :return: The chain result, or None if all the attempts failed
+        """
+        timeout = self.llm_config.async_params.get('timeout', 60)
+        result = None
+        for attempt in range(self.retry_params['max_retries'] + 1):
+            self.count('attempts')
+            async with semaphore:
+                try:
+                    result = await asyncio.wait_for(self.chain_ainvoke(chain_input, refresh_cache), timeout=timeout)
+                except Exception as e:
+                    if is_authentication_error(e):
+                        raise e
+                    logging.error('Error in chain ainvoke (attempt {}): {}'.format(attempt + 1, repr(e)))
+                    result = None
+            if result is not None:
                 break
+            if attempt < self.retry_params['max_retries']:
+                self.count('retries')
+                await asyncio.sleep(self.get_backoff(attempt))
+            else:
+                self.count('failures')
+        if pbar is not None:
+            pbar.update(1)
+        return result
 
-            tasks = list(pending)  # Retry with the pending tasks
-        return results
-
-    async def async_batch_invoke(self, inputs: list[dict]) -> list[dict]:
+    async def async_batch_invoke(self, inputs: list[dict], num_workers: int, limiter: ConcurrencyLimiter = None,
+                                 refresh_cache: bool = False) -> list[dict]:
         """
-        Invoke the chain on a batch of inputs in async mode
+        Invoke the chain on a batch of inputs in async mode. At most num_workers requests are running at any time,
+        a new request starts as soon as a previous request is done.
         :param inputs: A batch of inputs
-        :return: A list of dicts with the defined json schema
+        :param num_workers: The maximal number of concurrent requests
+        :param limiter: An optional shared limiter, if given it bounds the concurrent requests instead of num_workers
+        :param refresh_cache: If True, the cached responses are ignored (and replaced by the new responses)
+        :return: A list of dicts with the defined json schema, in the same order as the inputs
         """
+        semaphore = asyncio.Semaphore(num_workers) if limiter is None else limiter.async_semaphore
         with self.callback() as cb:
-            tasks = [self.chain.ainvoke(chain_input) for chain_input in inputs]
-            all_res = await self.retry_operation(tasks)
+            with tqdm(total=len(inputs), desc='Predicting') as pbar:
+                results = await asyncio.gather(*[self.invoke_with_retry(chain_input, semaphore, pbar, refresh_cache)
+                                                 for chain_input in inputs])
             self.accumulate_usage += cb.total_cost
-            if self.parser_func is not None:
-                return [self.parser_func(t.result()) for t in list(all_res)]
-            return [t.result() for t in list(all_res)]
+        return results
 
-    def batch_invoke(self, inputs: list[dict], num_workers: int, get_index=False) -> list[dict]:
+    def batch_invoke(self, inputs: list[dict], num_workers: int, get_index=False, return_dead_letters=False,
+                     limiter: ConcurrencyLimiter = None, refresh_cache: bool = False):
         """
         Invoke the chain on a batch of inputs either async or not
         :param inputs: The list of all inputs
         :param num_workers: The number of workers
         :param get_index: If True, return the index of the input
-        :return: A list of results
+        :param return_dead_letters: If True, return also the list of inputs that failed after all the retries
+        :param limiter: An optional limiter that is shared with other chains, it caps the concurrent requests of
+        all of them
+        :param refresh_cache: If True, the cached responses are ignored (and replaced by the new responses), e.g. when
+        a response that was parsed without errors is still not valid
+        :return: A list of results (and the dead letters list if return_dead_letters is True)
         """
 
-        def sample_generator():
-            if get_index:
-                for i, sample in enumerate(inputs):
-                    yield (i,sample)
-            else:
-                for sample in inputs:
-                    yield sample
-
         def process_sample_with_progress(sample):
-            if get_index:
-                i, sample = sample
-            result = self.invoke(sample)
+            result = self.invoke(sample, limiter, refresh_cache)
             pbar.update(1)  # Update the progress bar
-            if get_index:
-                return {'index': i, 'result': result}
             return result
 
         if not ('async_params' in self.llm_config.keys()):  # non async mode, use regular workers
             with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
                 with tqdm(total=len(inputs), desc="Processing samples") as pbar:
-                    all_results = list(executor.map(process_sample_with_progress, sample_generator()))
+                    all_results = list(executor.map(process_sample_with_progress, inputs))
+        else:
+            all_results = run_async(self.async_batch_invoke(inputs, num_workers, limiter, refresh_cache))
+        dead_letters = [sample for sample, result in zip(inputs, all_results) if result is None]
+        if len(dead_letters) > 0:
+            logging.warning('{} out of {} inputs failed after all the retries'.format(len(dead_letters), len(inputs)))
+        if get_index:
+            all_results = [{'index': i, 'result': result} for i, result in enumerate(all_results)]
+            all_results = [res for res in all_results if res['result'] is not None]
         else:
-            all_results = []
-            for i in trange(0, len(inputs), num_workers, desc='Predicting'):
-                results = asyncio.run(self.async_batch_invoke(inputs[i:i + num_workers]))
-                all_results += results
-        all_results = [res for res in all_results if res is not None]
+            all_results = [res for res in all_results if res is not None]
+        if return_dead_letters:
+            return all_results, dead_letters
         return all_results
 
     def build_chain(self):
         """
         Build the chain according to the LLM type
         """
-        if (self.llm_config.type.lower() == 'openai' or self.llm_config.type.lower() == 'azure') and self.json_schema is not None:
+        if self.llm_config.type.lower() in ['openai', 'azure', 'fake'] and self.json_schema is not None:
+            from langchain.chains.openai_functions import create_structured_output_runnable
             self.chain = create_structured_output_runnable(self.json_schema, self.llm, self.prompt)
         else:
             self.chain = LLMChain(llm=self.llm, prompt=self.prompt)
 
 
+schema_modules = {}
+schema_modules_lock = threading.Lock()
+
+
+def load_schema_module(prompt_directory: str):
+    """
+    Load the output schemes module of a prompts folder, each module is executed once per process
+    :param prompt_directory: The prompts folder
+    :return: The module (None if it can't be loaded)
+    """
+    with schema_modules_lock:
+        if prompt_directory not in schema_modules:
+            try:
+                spec = importlib.util.spec_from_file_location('output_schemes',
+                                                              prompt_directory + '/output_schemes.py')
+                schema_parser = importlib.util.module_from_spec(spec)
+                spec.loader.exec_module(schema_parser)
+            except ImportError as e:
+                print(f"Error loading module {prompt_directory + '/output_schemes'}: {e}")
+                schema_parser = None
+            schema_modules[prompt_directory] = schema_parser
+        return schema_modules[prompt_directory]
+
+
 def get_chain_metadata(prompt_fn: Path, retrieve_module: bool = False) -> dict:
     """
     Get the metadata of the chain
@@ -181,15 +582,11 @@ def get_chain_metadata(prompt_fn: Path, retrieve_module: bool = False) -> dict:
     """
     prompt_directory = str(prompt_fn.parent)
     prompt_name = str(prompt_fn.stem)
-    try:
-        spec = importlib.util.spec_from_file_location('output_schemes', prompt_directory + '/output_schemes.py')
-        schema_parser = importlib.util.module_from_spec(spec)
-        spec.loader.exec_module(schema_parser)
-    except ImportError as e:
-        print(f"Error loading module {prompt_directory + '/output_schemes'}: {e}")
+    schema_parser = load_schema_module(prompt_directory)
 
     if hasattr(schema_parser, '{}_schema'.format(prompt_name)):
-        json_schema = getattr(schema_parser, '{}_schema'.format(prompt_name))
+        # A copy, since the module is shared and the schema may be updated by the caller (e.g. the label schema)
+        json_schema = copy.deepcopy(getattr(schema_parser, '{}_schema'.format(prompt_name)))
     else:
         json_schema = None
     if hasattr(schema_parser, '{}_parser'.format(prompt_name)):
@@ -202,6 +599,53 @@ def get_chain_metadata(prompt_fn: Path, retrieve_module: bool = False) -> dict:
     return result
 
 
+class LazyChains(Mapping):
+    """
+    A mapping from the meta-prompts names to their chains, each chain is built on its first access. The chains can
+    be accessed as attributes (e.g. chains.step_prompt) or as items
+    """
+
+    def __init__(self, prompt_files: dict, load_chain):
+        """
+        Initialize a new instance of the LazyChains class.
+        :param prompt_files: A dict from the chain name to the prompt file
+        :param load_chain: A function that builds the chain of a prompt file
+        """
+        self.prompt_files = prompt_files
+        self.load_chain = load_chain
+        self.chains = {}
+        self.lock = threading.Lock()
+
+    def __getitem__(self, name: str) -> ChainWrapper:
+        if name not in self.chains:
+            if name not in self.prompt_files:
+                raise KeyError(name)
+            with self.lock:
+                if name not in self.chains:
+                    self.chains[name] = self.load_chain(self.prompt_files[name])
+        return self.chains[name]
+
+    def __getattr__(self, name: str) -> ChainWrapper:
+        if name.startswith('__') or name in ['prompt_files', 'load_chain', 'chains', 'lock']:
+            raise AttributeError(name)
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __iter__(self):
+        return iter(self.prompt_files)
+
+    def __len__(self):
+        return len(self.prompt_files)
+
+    def built_chains(self) -> list[ChainWrapper]:
+        """
+        Return the chains that were already built
+        """
+        return list(self.chains.values())
+
+
 class MetaChain:
     """
     A wrapper for the meta-prompts chain
@@ -209,16 +653,13 @@ class MetaChain:
 
     def __init__(self, config):
         """
-        Initialize a new instance of the MetaChain class. Loading all the meta-prompts
+        Initialize a new instance of the MetaChain class. The meta-prompts chains are built on their first use
         :param config: An EasyDict configuration
         """
         self.config = config
-        prompt_files = [file for file in self.config.meta_prompts.folder.iterdir() if file.is_file()
-                        and file.suffix == '.prompt']
-        chain = {}
-        for file in prompt_files:
-            chain[file.stem] = self.load_chain(file)
-        self.chain = edict(chain)
+        prompt_files = {file.stem: file for file in self.config.meta_prompts.folder.iterdir() if file.is_file()
+                        and file.suffix == '.prompt'}
+        self.chain = LazyChains(prompt_files, self.load_chain)
 
     def load_chain(self, prompt_file: Path) -> ChainWrapper:
         """
@@ -234,4 +675,4 @@ class MetaChain:
         Calculate the usage of all the meta-prompts
         :return: The total usage value
         """
-        return sum(item.accumulate_usage for item in self.chain.values())
+        return sum(item.accumulate_usage for item in self.chain.built_chains())
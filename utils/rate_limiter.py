@@ -0,0 +1,232 @@
+import asyncio
+import logging
+import threading
+import time
+from contextlib import contextmanager, asynccontextmanager
+
+
+def is_rate_limit_error(e: Exception) -> bool:
+    """
+    Check if the exception is a rate limit error (HTTP 429) of the provider
+    :param e: The exception
+    """
+    status = getattr(e, 'status_code', None) or getattr(e, 'http_status', None)
+    return status == 429 or 'RateLimit' in type(e).__name__
+
+
+class RateLimiter:
+    """
+    A rate limiter for a single (provider, model) pair. It enforces the requests per minute and the tokens per minute
+    limits using token buckets, and bounds the number of concurrent requests. The concurrency limit is adapted with
+    AIMD: it is increased additively on success, and halved on rate limit errors.
+    """
+
+    def __init__(self, requests_per_minute: float = 0, tokens_per_minute: float = 0, max_concurrency: int = 64,
+                 backoff_interval: float = 1.):
+        """
+        Initialize a new instance of the RateLimiter class.
+        :param requests_per_minute: The maximal number of requests per minute, 0 means unlimited
+        :param tokens_per_minute: The maximal number of tokens per minute, 0 means unlimited
+        :param max_concurrency: The maximal number of concurrent requests
+        :param backoff_interval: The minimal time in seconds between two concurrency decreases
+        """
+        self.lock = threading.Lock()
+        self.requests_per_minute = 0
+        self.tokens_per_minute = 0
+        self.max_concurrency = 1
+        self.concurrency_limit = 1.
+        self.backoff_interval = backoff_interval
+        self.request_bucket = 0.
+        self.token_bucket = 0.
+        self.last_refill = time.monotonic()
+        self.last_backoff = 0.
+        self.in_flight = 0
+        self.queue_depth = 0
+        self.num_rate_limit_errors = 0
+        self.set_limits(requests_per_minute, tokens_per_minute, max_concurrency)
+
+    def set_limits(self, requests_per_minute: float = 0, tokens_per_minute: float = 0, max_concurrency: int = 64):
+        """
+        Update the limits of the rate limiter
+        :param requests_per_minute: The maximal number of requests per minute, 0 means unlimited
+        :param tokens_per_minute: The maximal number of tokens per minute, 0 means unlimited
+        :param max_concurrency: The maximal number of concurrent requests
+        """
+        if requests_per_minute < 0 or tokens_per_minute < 0 or max_concurrency < 1:
+            raise Exception('Invalid rate limit: requests_per_minute={}, tokens_per_minute={}, '
+                            'max_concurrency={}'.format(requests_per_minute, tokens_per_minute, max_concurrency))
+        with self.lock:
+            self.requests_per_minute = requests_per_minute
+            self.tokens_per_minute = tokens_per_minute
+            self.request_bucket = self.request_capacity()
+            self.token_bucket = float(tokens_per_minute)
+            self.max_concurrency = max_concurrency
+            self.concurrency_limit = float(max_concurrency)
+
+    def request_capacity(self) -> float:
+        """
+        Return the capacity of the requests bucket. It holds at least a single request, so a limit below one request
+        per minute is a fractional refill rate (e.g. 0.5 is a request every two minutes)
+        """
+        return max(1., float(self.requests_per_minute))
+
+    def refill(self):
+        """
+        Refill the token buckets according to the elapsed time, should be called under the lock
+        """
+        now = time.monotonic()
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        if self.requests_per_minute > 0:
+            self.request_bucket = min(self.request_capacity(),
+                                      self.request_bucket + elapsed * self.requests_per_minute / 60)
+        if self.tokens_per_minute > 0:
+            self.token_bucket = min(self.tokens_per_minute,
+                                    self.token_bucket + elapsed * self.tokens_per_minute / 60)
+
+    def try_acquire(self, num_tokens: int) -> float:
+        """
+        Try to acquire a request slot
+        :param num_tokens: The (estimated) number of tokens of the request
+        :return: 0 if the slot was acquired, otherwise the time to wait (in seconds) before trying again
+        """
+        with self.lock:
+            self.refill()
+            if self.in_flight >= max(1, int(self.concurrency_limit)):
+                return 0.05
+            wait_time = 0.
+            if self.requests_per_minute > 0 and self.request_bucket < 1:
+                wait_time = (1 - self.request_bucket) * 60 / self.requests_per_minute
+            if self.tokens_per_minute > 0:
+                num_tokens = min(num_tokens, self.tokens_per_minute)
+                if self.token_bucket < num_tokens:
+                    wait_time = max(wait_time, (num_tokens - self.token_bucket) * 60 / self.tokens_per_minute)
+            if wait_time > 0:
+                return wait_time
+            if self.requests_per_minute > 0:
+                self.request_bucket -= 1
+            if self.tokens_per_minute > 0:
+                self.token_bucket -= num_tokens
+            self.in_flight += 1
+            return 0
+
+    def release(self, rate_limited: bool = False):
+        """
+        Release a request slot and update the concurrency limit (AIMD)
+        :param rate_limited: True if the request failed due to a rate limit error
+        """
+        with self.lock:
+            self.in_flight -= 1
+            if rate_limited:
+                self.num_rate_limit_errors += 1
+                now = time.monotonic()
+                if now - self.last_backoff > self.backoff_interval:
+                    self.last_backoff = now
+                    self.concurrency_limit = max(1., self.concurrency_limit / 2)
+                    logging.warning('Rate limit reached, reducing the concurrency to {}'.format(
+                        int(self.concurrency_limit)))
+            else:
+                self.concurrency_limit = min(float(self.max_concurrency),
+                                             self.concurrency_limit + 1 / self.concurrency_limit)
+
+    @contextmanager
+    def limit(self, num_tokens: int = 0):
+        """
+        A context manager that waits for a request slot, and releases it when the request is done
+        :param num_tokens: The (estimated) number of tokens of the request
+        """
+        with self.lock:
+            self.queue_depth += 1
+        try:
+            while (wait_time := self.try_acquire(num_tokens)) > 0:
+                time.sleep(wait_time)
+        finally:
+            with self.lock:
+                self.queue_depth -= 1
+        try:
+            yield self
+        except BaseException as e:
+            self.release(is_rate_limit_error(e))
+            raise
+        self.release()
+
+    @asynccontextmanager
+    async def alimit(self, num_tokens: int = 0):
+        """
+        The async version of limit
+        :param num_tokens: The (estimated) number of tokens of the request
+        """
+        with self.lock:
+            self.queue_depth += 1
+        try:
+            while (wait_time := self.try_acquire(num_tokens)) > 0:
+                await asyncio.sleep(wait_time)
+        finally:
+            with self.lock:
+                self.queue_depth -= 1
+        try:
+            yield self
+        except BaseException as e:
+            self.release(is_rate_limit_error(e))
+            raise
+        self.release()
+
+    def stats(self) -> dict:
+        """
+        Return the current state of the rate limiter
+        """
+        with self.lock:
+            return {'concurrency_limit': int(self.concurrency_limit), 'in_flight': self.in_flight,
+                    'queue_depth': self.queue_depth, 'rate_limit_errors': self.num_rate_limit_errors}
+
+
+rate_limiter_registry = {}
+rate_limiter_registry_lock = threading.Lock()
+
+
+LIMIT_KEYS = ['requests_per_minute', 'tokens_per_minute', 'max_concurrency']
+
+
+def merge_limits(limiter: RateLimiter, rate_limit: dict) -> dict:
+    """
+    Merge the limits of a rate limit config into the current limits of a rate limiter, the strictest limit is kept.
+    The keys that are not limits (e.g. backoff_interval) are ignored
+    :param limiter: The rate limiter
+    :param rate_limit: The 'rate_limit' section of the llm config
+    :return: The merged limits
+    """
+    limits = {name: getattr(limiter, name) for name in LIMIT_KEYS}
+    for name in LIMIT_KEYS:
+        value = rate_limit.get(name, 0)
+        # 0 means unlimited for the requests and tokens
+        if value > 0 and (limits[name] == 0 or value < limits[name]):
+            limits[name] = value
+    return limits
+
+
+def get_rate_limiter(llm_config: dict) -> RateLimiter:
+    """
+    Return the process-wide rate limiter of the (provider, model) pair of the llm config. The limits are taken from
+    the 'rate_limit' section of the config (requests_per_minute, tokens_per_minute, max_concurrency). If several
+    chains share the pair with different limits, the strictest limit of each kind is used
+    :param llm_config: The config for the LLM
+    """
+    key = (llm_config['type'].lower(), llm_config['name'])
+    rate_limit = llm_config.get('rate_limit', None)
+    with rate_limiter_registry_lock:
+        if key not in rate_limiter_registry:
+            rate_limiter_registry[key] = RateLimiter(**(rate_limit or {}))
+        elif rate_limit is not None:
+            limiter = rate_limiter_registry[key]
+            limits = merge_limits(limiter, rate_limit)
+            if limits != {name: getattr(limiter, name) for name in LIMIT_KEYS}:
+                logging.info('Merging the rate limits of {}/{} to {}'.format(*key, limits))
+                limiter.set_limits(**limits)
+    return rate_limiter_registry[key]
+
+
+def get_rate_limiters_stats() -> dict:
+    """
+    Return the state of all the rate limiters of the process
+    """
+    return {'{}/{}'.format(*key): limiter.stats() for key, limiter in rate_limiter_registry.items()}
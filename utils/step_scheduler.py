@@ -0,0 +1,61 @@
+import concurrent.futures
+import logging
+import time
+
+
+class StepScheduler:
+    """
+    A scheduler for the stages of an optimization step. The stages and their dependencies define a DAG, each stage
+    starts as soon as all its dependencies are done, so independent stages run concurrently on the worker pool
+    """
+
+    def __init__(self, executor: concurrent.futures.Executor):
+        """
+        Initialize a new instance of the StepScheduler class.
+        :param executor: The (shared) worker pool that runs the stages
+        """
+        self.executor = executor
+        self.stages = {}
+        self.timings = {}
+
+    def add_stage(self, name: str, func, dependencies: list[str] = None):
+        """
+        Add a stage to the step
+        :param name: The stage name
+        :param func: The stage function, it is called with the results of the dependencies (in the given order)
+        :param dependencies: The names of the stages that must be done before this stage starts
+        """
+        self.stages[name] = {'func': func, 'dependencies': dependencies or []}
+
+    def run_stage(self, name: str, *args):
+        """
+        Run a single stage and measure its wall-clock time
+        :param name: The stage name
+        :param args: The results of the stage dependencies
+        """
+        start_time = time.time()
+        result = self.stages[name]['func'](*args)
+        self.timings[name] = time.time() - start_time
+        return result
+
+    def run(self) -> dict:
+        """
+        Run all the stages according to their dependencies
+        :return: A dict with the result of each stage
+        """
+        results = {}
+        running = {}
+        pending = dict(self.stages)
+        while len(pending) > 0 or len(running) > 0:
+            ready = [name for name, stage in pending.items()
+                     if all(dependency in results for dependency in stage['dependencies'])]
+            for name in ready:
+                args = [results[dependency] for dependency in pending.pop(name)['dependencies']]
+                running[self.executor.submit(self.run_stage, name, *args)] = name
+            if len(running) == 0:
+                raise Exception(f'Unresolved dependencies for the stages: {list(pending.keys())}')
+            done, _ = concurrent.futures.wait(running.keys(), return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+        logging.info('Step stages timing: ' + ', '.join(f'{name}: {t:.2f}s' for name, t in self.timings.items()))
+        return results